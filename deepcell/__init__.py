@@ -35,6 +35,7 @@ from deepcell import losses
 from deepcell import image_generators
 from deepcell import model_zoo
 from deepcell import notebooks
+from deepcell import postprocessing
 from deepcell import running
 from deepcell import training
 from deepcell import utils
@@ -29,15 +29,23 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import division
 
+import collections
+import hashlib
+import multiprocessing
 import os
+import shutil
+import tempfile
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from fnmatch import fnmatch
 
 import cv2
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 
 from skimage.measure import label
 from skimage.measure import regionprops
-from skimage.transform import resize
 from skimage.io import imread
 
 try:
@@ -49,12 +57,14 @@ try:
 except ImportError:
     scipy = None
 
+import tensorflow as tf
 from tensorflow.python.platform import tf_logging as logging
 from tensorflow.python.keras import backend as K
 from tensorflow.python.keras.utils import to_categorical
 from tensorflow.python.keras.preprocessing.image import array_to_img
 from tensorflow.python.keras.preprocessing.image import Iterator
 from tensorflow.python.keras.preprocessing.image import ImageDataGenerator
+from tensorflow.python.util import nest
 
 
 try:
@@ -71,12 +81,95 @@ if not hasattr(ImageDataGenerator, 'apply_transform'):
 from keras_retinanet.preprocessing.generator import Generator as _RetinaNetGenerator
 from keras_maskrcnn.preprocessing.generator import Generator as _MaskRCNNGenerator
 
+from deepcell.utils.data_utils import MemmapSubset
 from deepcell.utils.data_utils import sample_label_movie
 from deepcell.utils.data_utils import sample_label_matrix
 from deepcell.utils.transform_utils import deepcell_transform
 from deepcell.utils.transform_utils import distance_transform_2d
 from deepcell.utils.transform_utils import distance_transform_3d
 from deepcell.utils.retinanet_anchor_utils import anchor_targets_bbox
+from deepcell.utils.tracking_utils import get_frame_features
+
+
+_TRANSFORM_CACHE = {'cache_dir': None, 'max_size': 10 * 2 ** 30}
+
+
+def set_transform_cache(cache_dir=None, max_size=10 * 2 ** 30):
+    """Cache the transformed masks and the Siamese track features of the
+    data generators on disk. Results are keyed by the content of the data
+    and the parameters used to compute them, and memory mapped when reused.
+    Transformed masks are stored as uint8 when lossless. The least recently
+    used results are evicted when the cache grows beyond `max_size`.
+
+    Args:
+        cache_dir: directory of the cache, e.g. ~/.deepcell/transform_cache.
+            If None, the cache is disabled.
+        max_size: maximum total size of the cache in bytes
+    """
+    if cache_dir is not None:
+        cache_dir = os.path.expanduser(cache_dir)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+    _TRANSFORM_CACHE['cache_dir'] = cache_dir
+    _TRANSFORM_CACHE['max_size'] = max_size
+
+
+def _get_cache_key(arrays, params):
+    """Hash the content of `arrays` with the parameters of the result"""
+    arrays = [np.ascontiguousarray(a) for a in arrays]
+    key = hashlib.sha1()
+    key.update(str((params, [(a.shape, a.dtype.str) for a in arrays])).encode())
+    for a in arrays:
+        key.update(a.view(np.uint8).reshape(-1))
+    return key.hexdigest()
+
+
+def _get_transform_cache_key(y, transform, data_format, kwargs):
+    """Hash the content of `y` with the transform and its kwargs"""
+    params = (transform, data_format, sorted((k, repr(v)) for k, v in kwargs.items()))
+    return _get_cache_key([y], params)
+
+
+def _evict_transform_cache(cache_dir, max_size):
+    """Remove the least recently used results until the cache fits"""
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.npy'):
+            path = os.path.join(cache_dir, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:  # removed by another process
+            pass
+        total_size -= size
+
+
+def _write_cache_file(array, path):
+    """Save an array to the cache, writing to a temporary file first
+    so other processes never read partial files"""
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(temp_path, path)
+
+
+def _save_transform_cache(y_transform, path, max_size):
+    """Save a transform result to the cache and memory map it"""
+    if np.array_equal(y_transform, y_transform.astype('uint8')):
+        y_transform = y_transform.astype('uint8')
+
+    _write_cache_file(y_transform, path)
+
+    _evict_transform_cache(os.path.dirname(path), max_size)
+    if not os.path.isfile(path):  # larger than the cache itself
+        return y_transform
+    return np.load(path, mmap_mode='r')
 
 
 def _transform_masks(y, transform, data_format=None, **kwargs):
@@ -89,7 +182,9 @@ def _transform_masks(y, transform, data_format=None, **kwargs):
         transform: one of {`deepcell`, `disc`, `watershed`, `centroid`, `None`}
 
     Returns:
-        y_transform: the output of the given transform function on y
+        y_transform: the output of the given transform function on y.
+            If the transform cache is enabled (see `set_transform_cache`),
+            this is a read-only memory map, stored as uint8 when lossless.
 
     Raises:
         IOError: An error occurred
@@ -113,6 +208,14 @@ def _transform_masks(y, transform, data_format=None, **kwargs):
         if transform not in valid_transforms:
             raise ValueError('`{}` is not a valid transform'.format(transform))
 
+    cache_dir = _TRANSFORM_CACHE['cache_dir']
+    if cache_dir is not None:
+        key = _get_transform_cache_key(y, transform, data_format, kwargs)
+        cache_path = os.path.join(cache_dir, '{}.npy'.format(key))
+        if os.path.isfile(cache_path):
+            os.utime(cache_path, None)  # mark as recently used
+            return np.load(cache_path, mmap_mode='r')
+
     if transform == 'deepcell':
         dilation_radius = kwargs.pop('dilation_radius', None)
         y_transform = deepcell_transform(y, dilation_radius, data_format=data_format)
@@ -168,10 +271,622 @@ def _transform_masks(y, transform, data_format=None, **kwargs):
     elif transform == 'centroid':
         raise NotImplementedError('`centroid` transform has not been finished')
 
+    if cache_dir is not None:
+        return _save_transform_cache(y_transform, cache_path,
+                                     _TRANSFORM_CACHE['max_size'])
     return y_transform
 
 
-class ImageSampleArrayIterator(Iterator):
+def _has_random_transform(image_data_generator):
+    """Check if `random_transform` of the generator can change its input.
+
+    Args:
+        image_data_generator: Instance of `ImageDataGenerator`
+
+    Returns:
+        bool: whether any random augmentation is enabled
+    """
+    gen = image_data_generator
+    zoom_range = getattr(gen, 'zoom_range', [1, 1])
+    brightness_range = getattr(gen, 'brightness_range', None)
+    return bool(np.any(gen.rotation_range) or
+                np.any(gen.width_shift_range) or
+                np.any(gen.height_shift_range) or
+                np.any(gen.shear_range) or
+                zoom_range[0] != 1 or zoom_range[1] != 1 or
+                np.any(gen.channel_shift_range) or
+                gen.horizontal_flip or gen.vertical_flip or
+                brightness_range is not None)
+
+
+def _standardize_batch(image_data_generator, batch_x):
+    """Standardize a whole batch at once if the generator allows it.
+    Samplewise normalization, ZCA whitening and `preprocessing_function`
+    are defined per image, so those fall back to standardizing each image.
+
+    Args:
+        image_data_generator: Instance of `ImageDataGenerator`
+        batch_x: batch of images
+
+    Returns:
+        The standardized batch
+    """
+    gen = image_data_generator
+    if (gen.preprocessing_function or gen.samplewise_center or
+            gen.samplewise_std_normalization or gen.zca_whitening):
+        for i in range(batch_x.shape[0]):
+            batch_x[i] = gen.standardize(batch_x[i])
+        return batch_x
+    return gen.standardize(batch_x)
+
+
+def _gather_windows(x, batch, centers, window_size, channel_axis):
+    """Gather the windows around many pixels in one indexing operation.
+    Each window spans `center - w` to `center + w` along each spatial axis.
+    A strided view of every possible window is indexed once, which copies
+    each window as a block instead of gathering it pixel by pixel.
+
+    Args:
+        x: image data, with a batch axis, spatial axes and a channel axis
+        batch: array of the batch index of each window
+        centers: list of arrays of the window centers, one per spatial axis
+        window_size: half width of the window along each spatial axis
+        channel_axis: 1 for channels_first, otherwise channels_last
+
+    Returns:
+        numpy.array: windows of shape (len(batch), *(2 * w + 1), channels),
+            or (len(batch), channels, *(2 * w + 1)) for channels_first
+    """
+    x = np.asarray(x)
+    if channel_axis == 1:
+        spatial_axes = list(range(2, x.ndim))
+    else:
+        spatial_axes = list(range(1, x.ndim - 1))
+    channel_axis = 1 if channel_axis == 1 else x.ndim - 1
+
+    starts = [x.shape[a] - 2 * w for a, w in zip(spatial_axes, window_size)]
+    window_shape = [2 * w + 1 for w in window_size]
+    spatial_strides = [x.strides[a] for a in spatial_axes]
+
+    # view of shape (batch, *starts, *window_shape, channels)
+    # or (batch, *starts, channels, *window_shape) for channels_first
+    shape = [x.shape[0]] + starts
+    strides = [x.strides[0]] + spatial_strides
+    if channel_axis == 1:
+        shape += [x.shape[1]] + window_shape
+        strides += [x.strides[1]] + spatial_strides
+    else:
+        shape += window_shape + [x.shape[-1]]
+        strides += spatial_strides + [x.strides[-1]]
+    windows = as_strided(x, shape=shape, strides=strides, writeable=False)
+
+    index = [np.asarray(batch)]
+    index.extend(np.asarray(c) - w for c, w in zip(centers, window_size))
+    return windows[tuple(index)]
+
+
+def _get_class_map(y, channel_axis):
+    """Convert one-hot masks into a compact integer class map.
+
+    Args:
+        y: one-hot masks
+        channel_axis: axis of the classes
+
+    Returns:
+        tuple: the class map without the channel axis and the number of
+            classes, or `y` and None if `y` is not one-hot
+    """
+    num_classes = y.shape[channel_axis]
+    is_one_hot = (np.all(np.max(y, axis=channel_axis) == 1) and
+                  np.all(np.sum(y, axis=channel_axis) == 1))
+    if not is_one_hot:
+        return y, None
+    dtype = 'uint8' if num_classes <= 256 else 'uint16'
+    return np.argmax(y, axis=channel_axis).astype(dtype), num_classes
+
+
+def _class_map_to_one_hot(class_map, num_classes, channel_axis, dtype=None):
+    """Expand a batch of integer class maps into one-hot masks"""
+    if dtype is None:
+        dtype = K.floatx()
+    one_hot = np.eye(num_classes, dtype=dtype)[class_map]
+    if channel_axis == 1:
+        one_hot = np.moveaxis(one_hot, -1, 1)
+    return one_hot
+
+
+"""
+Batched augmentation
+"""
+
+
+def _draw_shifts(shift_range, num_images, size):
+    """Draw random shifts in pixels like `ImageDataGenerator` does.
+
+    Args:
+        shift_range: float, int or 1-D array-like shift range
+        num_images: number of shifts to draw
+        size: length of the shifted axis, used for fractional shifts
+
+    Returns:
+        numpy.array: shift of each image
+    """
+    if not np.any(shift_range):
+        return np.zeros(num_images)
+    if np.ndim(shift_range) > 0 or isinstance(shift_range, (int, np.integer)):
+        # random elements of the array, or ints below shift_range
+        shifts = np.random.choice(shift_range, num_images).astype('float')
+        shifts *= np.random.choice([-1, 1], num_images)
+    else:
+        shifts = np.random.uniform(-shift_range, shift_range, num_images)
+    if np.max(shift_range) < 1:
+        shifts *= size
+    return shifts
+
+
+def _get_random_transforms(image_data_generator, num_images, img_shape):
+    """Draw the random transformation parameters for a batch of images.
+    Uses the same parameters and distributions as `get_random_transform`.
+
+    Args:
+        image_data_generator: Instance of `ImageDataGenerator`
+        num_images: number of images in the batch
+        img_shape: (rows, cols) of the images
+
+    Returns:
+        dict: the parameters of `apply_transform` as arrays over the batch
+    """
+    gen = image_data_generator
+    zeros = np.zeros(num_images)
+    ones = np.ones(num_images)
+
+    params = {}
+    if gen.rotation_range:
+        params['theta'] = np.random.uniform(
+            -gen.rotation_range, gen.rotation_range, num_images)
+    else:
+        params['theta'] = zeros
+
+    params['tx'] = _draw_shifts(gen.height_shift_range, num_images, img_shape[0])
+    params['ty'] = _draw_shifts(gen.width_shift_range, num_images, img_shape[1])
+
+    if gen.shear_range:
+        params['shear'] = np.random.uniform(
+            -gen.shear_range, gen.shear_range, num_images)
+    else:
+        params['shear'] = zeros
+
+    if gen.zoom_range[0] == 1 and gen.zoom_range[1] == 1:
+        params['zx'], params['zy'] = ones, ones
+    else:
+        params['zx'], params['zy'] = np.random.uniform(
+            gen.zoom_range[0], gen.zoom_range[1], (2, num_images))
+
+    params['flip_horizontal'] = np.logical_and(
+        np.random.random(num_images) < 0.5, gen.horizontal_flip)
+    params['flip_vertical'] = np.logical_and(
+        np.random.random(num_images) < 0.5, gen.vertical_flip)
+
+    params['channel_shift_intensity'] = None
+    if gen.channel_shift_range != 0:
+        params['channel_shift_intensity'] = np.random.uniform(
+            -gen.channel_shift_range, gen.channel_shift_range, num_images)
+
+    params['brightness'] = None
+    brightness_range = getattr(gen, 'brightness_range', None)
+    if brightness_range is not None:
+        params['brightness'] = np.random.uniform(
+            brightness_range[0], brightness_range[1], num_images)
+
+    return params
+
+
+def _repeat_transform(transform_parameters, num_images):
+    """Use a single `apply_transform` parameter dict for a batch of images"""
+    defaults = {'theta': 0, 'tx': 0, 'ty': 0, 'shear': 0, 'zx': 1, 'zy': 1,
+                'flip_horizontal': False, 'flip_vertical': False}
+    params = {}
+    for key, default in defaults.items():
+        value = transform_parameters.get(key, default)
+        params[key] = np.full(num_images, default if value is None else value)
+    for key in ('channel_shift_intensity', 'brightness'):
+        value = transform_parameters.get(key)
+        params[key] = None if value is None else np.full(num_images, value)
+    return params
+
+
+def _get_transform_matrices(params, img_shape):
+    """Build the affine matrix of each image, centered on the image.
+
+    Args:
+        params: batch of transformation parameters
+        img_shape: (rows, cols) of the images
+
+    Returns:
+        tuple: (n, 3, 3) matrices mapping output to input coordinates
+            and a boolean array of which images have a non-identity transform
+    """
+    theta = np.deg2rad(params['theta'])
+    shear = np.deg2rad(params['shear'])
+    tx, ty = params['tx'], params['ty']
+    zx, zy = params['zx'], params['zy']
+    zeros = np.zeros(len(theta))
+    ones = np.ones(len(theta))
+
+    def stack(*rows):
+        return np.stack([np.stack(r, axis=-1) for r in rows], axis=-2)
+
+    rotation = stack([np.cos(theta), -np.sin(theta), zeros],
+                     [np.sin(theta), np.cos(theta), zeros],
+                     [zeros, zeros, ones])
+    shift = stack([ones, zeros, tx], [zeros, ones, ty], [zeros, zeros, ones])
+    shear_matrix = stack([ones, -np.sin(shear), zeros],
+                         [zeros, np.cos(shear), zeros],
+                         [zeros, zeros, ones])
+    zoom = stack([zx, zeros, zeros], [zeros, zy, zeros], [zeros, zeros, ones])
+    matrices = rotation @ shift @ shear_matrix @ zoom
+
+    o_x = float(img_shape[0]) / 2 + 0.5
+    o_y = float(img_shape[1]) / 2 + 0.5
+    offset = np.array([[1, 0, o_x], [0, 1, o_y], [0, 0, 1]])
+    reset = np.array([[1, 0, -o_x], [0, 1, -o_y], [0, 0, 1]])
+    matrices = offset @ matrices @ reset
+
+    is_affine = ((theta != 0) | (tx != 0) | (ty != 0) | (shear != 0) |
+                 (zx != 1) | (zy != 1))
+    return matrices, is_affine
+
+
+def _affine_transform_image(x, matrix, order, fill_mode, cval):
+    """Apply an affine matrix to each channel of a channels_last image"""
+    transformed = np.empty_like(x)
+    for c in range(x.shape[-1]):
+        transformed[..., c] = ndimage.affine_transform(
+            x[..., c], matrix[:2, :2], matrix[:2, 2],
+            order=order, mode=fill_mode, cval=cval)
+    return transformed
+
+
+_TRANSFORM_EXECUTOR = None
+_TRANSFORM_EXECUTOR_PID = None
+_TRANSFORM_EXECUTOR_LOCK = threading.Lock()
+
+
+def _get_transform_executor():
+    """Get the thread pool shared by every `_apply_transforms` call,
+    creating it on first use. Forked worker processes do not inherit the
+    threads of the pool, so each process creates its own."""
+    global _TRANSFORM_EXECUTOR, _TRANSFORM_EXECUTOR_PID
+    with _TRANSFORM_EXECUTOR_LOCK:
+        if _TRANSFORM_EXECUTOR_PID != os.getpid():
+            _TRANSFORM_EXECUTOR = ThreadPoolExecutor(os.cpu_count() or 1)
+            _TRANSFORM_EXECUTOR_PID = os.getpid()
+        return _TRANSFORM_EXECUTOR
+
+
+def _apply_transforms(image_data_generator, x, params, y=None, data_format=None):
+    """Apply a batch of transformations to a batch of images and masks.
+    The affine transforms of the batch run in a thread pool and the flips,
+    channel shifts and brightness changes are vectorized over the batch.
+    `y` is transformed with the same parameters as `x`, except for the
+    channel shifts and brightness changes that only apply to `x`.
+    Brightness is applied by scaling the intensities of `x`.
+
+    Args:
+        image_data_generator: Instance of `ImageDataGenerator`
+        x: batch of images, or of movies where each frame is an image
+        params: parameters of each image, see `_get_random_transforms`
+        y: batch of masks for `x`, optional
+        data_format: `channels_first` or `channels_last`, defaults to the
+            data_format of the generator
+
+    Returns:
+        The transformed `x`, and the transformed `y` if `y` is given
+    """
+    gen = image_data_generator
+    if data_format is None:
+        data_format = gen.data_format
+
+    # transform a flat batch of channels_last images
+    arrays = [x] if y is None else [x, y]
+    for i, arr in enumerate(arrays):
+        arr = np.asarray(arr, dtype=K.floatx())
+        if data_format == 'channels_first':
+            arr = np.moveaxis(arr, 1, -1)
+        arrays[i] = arr.reshape((-1,) + arr.shape[-3:])
+
+    img_shape = arrays[0].shape[1:3]
+    matrices, is_affine = _get_transform_matrices(params, img_shape)
+    order = getattr(gen, 'interpolation_order', 1)
+
+    transformed = [np.array(arr) for arr in arrays]
+    tasks = [(a, i) for i in np.flatnonzero(is_affine) for a in range(len(arrays))]
+
+    def transform_image(task):
+        a, i = task
+        transformed[a][i] = _affine_transform_image(
+            arrays[a][i], matrices[i], order, gen.fill_mode, gen.cval)
+
+    if len(tasks) > 1:
+        list(_get_transform_executor().map(transform_image, tasks))
+    elif tasks:
+        transform_image(tasks[0])
+
+    # channel shifts are clipped to the intensity range of each image
+    if params['channel_shift_intensity'] is not None:
+        batch_x = transformed[0]
+        min_x = batch_x.min(axis=(1, 2, 3), keepdims=True)
+        max_x = batch_x.max(axis=(1, 2, 3), keepdims=True)
+        intensity = params['channel_shift_intensity'][:, None, None, None]
+        transformed[0] = np.clip(batch_x + intensity, min_x, max_x)
+
+    for arr in transformed:
+        flip_h = params['flip_horizontal'].astype('bool')
+        flip_v = params['flip_vertical'].astype('bool')
+        arr[flip_h] = arr[flip_h, :, ::-1]
+        arr[flip_v] = arr[flip_v, ::-1]
+
+    if params['brightness'] is not None:
+        transformed[0] *= params['brightness'][:, None, None, None]
+
+    # restore the original shapes
+    for i, arr in enumerate(transformed):
+        shape = np.shape(x if i == 0 else y)
+        if data_format == 'channels_first':
+            shape = (shape[0],) + tuple(shape[2:]) + (shape[1],)
+            transformed[i] = np.moveaxis(arr.reshape(shape), -1, 1)
+        else:
+            transformed[i] = arr.reshape(shape)
+
+    if y is None:
+        return transformed[0]
+    return transformed[0], transformed[1]
+
+
+def _random_transform_batch(image_data_generator, x, y=None, data_format=None):
+    """Randomly transform a batch of images like `random_transform`, drawing
+    the parameters of the whole batch at once. Each image of `x` and its mask
+    in `y` share the same parameters. For movies, each frame is transformed
+    independently as in `MovieDataGenerator.random_transform`.
+
+    Args:
+        image_data_generator: Instance of `ImageDataGenerator`
+        x: batch of images or movies
+        y: batch of masks for `x`, optional
+        data_format: `channels_first` or `channels_last`, defaults to the
+            data_format of the generator
+
+    Returns:
+        The transformed `x`, and the transformed `y` if `y` is given
+    """
+    if data_format is None:
+        data_format = image_data_generator.data_format
+    if data_format == 'channels_first':
+        num_images = x.shape[0] * int(np.prod(x.shape[2:-2]))
+        img_shape = x.shape[-2:]
+    else:
+        num_images = int(np.prod(x.shape[:-3]))
+        img_shape = x.shape[-3:-1]
+    params = _get_random_transforms(image_data_generator, num_images, img_shape)
+    return _apply_transforms(image_data_generator, x, params, y=y,
+                             data_format=data_format)
+
+
+class SharedArrayIterator(Iterator):
+    """Base class for array iterators that can run in worker processes,
+    e.g. `fit_generator(..., workers=4, use_multiprocessing=True)`.
+
+    `share_memory` moves the arrays of the iterator into memory-mapped
+    `.npy` files, so worker processes attach to the same pages instead of
+    receiving a pickled copy of the data. Batches built in a worker process
+    are seeded by the batch index and epoch, so every worker draws an
+    independent random stream and the augmentations are reproducible no
+    matter which worker builds the batch.
+
+    Arguments:
+        n: Integer, total number of samples in the dataset to loop over.
+        batch_size: Integer, size of a batch.
+        shuffle: Boolean, whether to shuffle the data between epochs.
+        seed: Random seed for data shuffling and augmentation.
+    """
+
+    def __init__(self, n, batch_size, shuffle, seed):
+        super(SharedArrayIterator, self).__init__(n, batch_size, shuffle, seed)
+        self.shared_dir = None
+        self._shared_arrays = {}
+        self._owner_pid = os.getpid()
+        self._batch_lock = threading.Lock()
+        self._epoch = 0
+        if seed is None:  # do not consume the global random state
+            seed = np.random.RandomState().randint(2 ** 31 - 1)
+        self._base_seed = seed
+
+    def share_memory(self, directory=None):
+        """Move the arrays of the iterator into memory-mapped `.npy` files.
+
+        Args:
+            directory: directory for the files, defaults to a temporary
+                directory that is removed along with the iterator.
+
+        Returns:
+            The iterator, so the call can be chained with `flow`.
+        """
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix='deepcell_')
+            self._finalizer = weakref.finalize(
+                self, _remove_shared_dir, directory, os.getpid())
+        elif not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.shared_dir = directory
+
+        for name, value in list(vars(self).items()):
+            if (name == 'index_array' or not isinstance(value, np.ndarray) or
+                    value.dtype == object or name in self._shared_arrays):
+                continue
+            if isinstance(value, np.memmap) and value.filename is not None:
+                # arrays loaded from `.npy` files are shared as they are
+                path = value.filename
+                try:
+                    is_npy = np.load(path, mmap_mode='r').shape == value.shape
+                except (IOError, ValueError):
+                    is_npy = False
+                if is_npy:
+                    self._shared_arrays[name] = path
+                    continue
+            path = os.path.join(directory, '{}.npy'.format(name))
+            np.save(path, value)
+            self._shared_arrays[name] = path
+            setattr(self, name, np.load(path, mmap_mode='r'))
+
+        # the workers must agree on the order of the first epoch
+        if self.index_array is None:
+            self._set_index_array()
+        return self
+
+    def to_dataset(self, num_parallel_calls=None, prefetch_size=None):
+        """Return the batches of the iterator as a `tf.data.Dataset`.
+
+        The sample indices are shuffled and batched by `tf.data`, each batch
+        is built by one of `num_parallel_calls` parallel `map` calls and the
+        next `prefetch_size` batches are prepared while the model trains.
+        The dataset repeats indefinitely and keeps the last partial batch of
+        each pass, so one pass over the data takes `len(self)` batches and
+        `fit` needs `steps_per_epoch=len(self)`.
+
+        Batch `idx` of pass `epoch` is seeded with (seed, epoch, idx) like
+        the batches built in worker processes, so the augmentations do not
+        depend on which thread builds the batch. The augmentations draw from
+        the global numpy random state, so the `map` calls build their batches
+        one at a time under `_get_seeded_batch`; they still overlap with
+        training and the transforms of each batch run in a thread pool.
+
+        Args:
+            num_parallel_calls: number of batches built in parallel,
+                defaults to the number of CPUs.
+            prefetch_size: number of batches to prefetch,
+                defaults to `num_parallel_calls`.
+
+        Returns:
+            tf.data.Dataset: yields the same structure as the iterator
+        """
+        if num_parallel_calls is None:
+            num_parallel_calls = os.cpu_count() or 1
+        if prefetch_size is None:
+            prefetch_size = num_parallel_calls
+        num_batches = len(self)
+
+        # build one batch to find the structure, dtypes and shapes of a batch
+        example = self._get_seeded_batch(
+            np.arange(min(self.batch_size, self.n)), self._get_batch_seed(0))
+        example = _lists_to_tuples(example)
+        flat_example = [np.asarray(e) for e in nest.flatten(example)]
+        dtypes = [tf.as_dtype(e.dtype) for e in flat_example]
+
+        def get_batch(count, index_array):
+            epoch, idx = divmod(int(count), num_batches)
+            seed = [self._base_seed, epoch, idx]
+            batch = self._get_seeded_batch(index_array, seed)
+            flat_batch = nest.flatten(_lists_to_tuples(batch))
+            return [np.asarray(b, dtype=d.as_numpy_dtype)
+                    for b, d in zip(flat_batch, dtypes)]
+
+        def map_batch(count, index_array):
+            flat_batch = tf.py_func(get_batch, [count, index_array], dtypes)
+            for tensor, e in zip(flat_batch, flat_example):
+                tensor.set_shape((None,) + e.shape[1:])
+            return nest.pack_sequence_as(example, flat_batch)
+
+        indices = tf.data.Dataset.range(self.n)
+        if self.shuffle:
+            indices = indices.shuffle(self.n, seed=self._base_seed,
+                                      reshuffle_each_iteration=True)
+        indices = indices.batch(self.batch_size).repeat()
+        # count the batches to know the pass and index of each batch
+        counts = tf.data.Dataset.range(np.iinfo('int64').max)
+        dataset = tf.data.Dataset.zip((counts, indices))
+        dataset = dataset.map(map_batch, num_parallel_calls=num_parallel_calls)
+        return dataset.prefetch(prefetch_size)
+
+    def _get_seeded_batch(self, index_array, seed):
+        """Build the batch of `index_array` with numpy seeded by `seed`.
+
+        Batches are built one at a time, so concurrent callers neither
+        interleave their random draws nor share the caches of the iterator
+        unguarded. The global random state is restored afterwards.
+        """
+        with self._batch_lock:
+            state = np.random.get_state()
+            np.random.seed(seed)
+            try:
+                return self._get_batches_of_transformed_samples(index_array)
+            finally:
+                np.random.set_state(state)
+
+    def on_epoch_end(self):
+        self._epoch += 1
+        super(SharedArrayIterator, self).on_epoch_end()
+
+    def _get_batch_seed(self, idx=None):
+        """Seed of batch `idx` in the current epoch, or of the shuffled
+        order of the epoch if `idx` is None. numpy seeds must not be
+        negative, so the epoch seed is simply shorter."""
+        if idx is None:
+            return [self._base_seed, self._epoch]
+        return [self._base_seed, self._epoch, idx]
+
+    def __getitem__(self, idx):
+        if os.getpid() == self._owner_pid:
+            return super(SharedArrayIterator, self).__getitem__(idx)
+
+        if idx >= len(self):
+            raise ValueError('Asked to retrieve element {idx}, '
+                             'but the Sequence '
+                             'has length {length}'.format(idx=idx,
+                                                          length=len(self)))
+        if self.index_array is None:
+            np.random.seed(self._get_batch_seed())
+            self._set_index_array()
+        np.random.seed(self._get_batch_seed(idx))
+        index_array = self.index_array[self.batch_size * idx:
+                                       self.batch_size * (idx + 1)]
+        return self._get_batches_of_transformed_samples(index_array)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # locks, generators and finalizers can not be pickled
+        for key in ('lock', '_batch_lock', 'index_generator', '_finalizer'):
+            state.pop(key, None)
+        for name in state.get('_shared_arrays', {}):
+            state[name] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for name, path in state.get('_shared_arrays', {}).items():
+            setattr(self, name, np.load(path, mmap_mode='r'))
+        self.lock = threading.Lock()
+        self._batch_lock = threading.Lock()
+        self.index_generator = self._flow_index()
+
+
+def _lists_to_tuples(structure):
+    """Convert the lists of a batch to tuples, which `tf.data` treats as
+    separate components instead of a single stacked tensor."""
+    if isinstance(structure, (list, tuple)):
+        return tuple(_lists_to_tuples(s) for s in structure)
+    if isinstance(structure, dict):
+        return {k: _lists_to_tuples(v) for k, v in structure.items()}
+    return structure
+
+
+def _remove_shared_dir(directory, pid):
+    """Remove the memory-mapped arrays of an iterator, but only from the
+    process that created them."""
+    if os.getpid() == pid:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+class ImageSampleArrayIterator(SharedArrayIterator):
     """Iterator yielding data from a sampled Numpy array.
     Sampling will generate a `window_size` image classifying the center pixel,
 
@@ -186,6 +901,8 @@ class ImageSampleArrayIterator(Iterator):
         max_class_samples: maximum number of samples per class.
         seed: Random seed for data shuffling.
         data_format: String, one of `channels_first`, `channels_last`.
+        compact: Boolean, keep `X` in its own dtype and `y` as integer
+            class maps, converting each batch to floatx and one-hot.
         save_to_dir: Optional directory where to save the pictures
             being yielded, in a viewable format. This is useful
             for visualizing the random transformations being
@@ -208,6 +925,7 @@ class ImageSampleArrayIterator(Iterator):
                  max_class_samples=None,
                  seed=None,
                  data_format='channels_last',
+                 compact=False,
                  save_to_dir=None,
                  save_prefix='',
                  save_format='png'):
@@ -216,7 +934,7 @@ class ImageSampleArrayIterator(Iterator):
             raise ValueError('Training batches and labels should have the same'
                              'length. Found X.shape: {} y.shape: {}'.format(
                                  X.shape, y.shape))
-        self.x = np.asarray(X, dtype=K.floatx())
+        self.x = np.asarray(X) if compact else np.asarray(X, dtype=K.floatx())
 
         if self.x.ndim != 4:
             raise ValueError('Input data in `ImageSampleArrayIterator` '
@@ -249,7 +967,14 @@ class ImageSampleArrayIterator(Iterator):
 
         self.class_balance(max_class_samples, balance_classes, seed=seed)
 
-        self.y = to_categorical(self.y).astype('int32')
+        if compact:
+            # keep the class of each sample, one-hot encoded per batch
+            self.num_classes = int(np.max(self.y)) + 1
+            dtype = 'uint8' if self.num_classes <= 256 else 'uint16'
+            self.y = self.y.astype(dtype)
+        else:
+            self.num_classes = None
+            self.y = to_categorical(self.y).astype('int32')
         super(ImageSampleArrayIterator, self).__init__(
             len(self.y), batch_size, shuffle, seed)
 
@@ -313,24 +1038,17 @@ class ImageSampleArrayIterator(Iterator):
         self.y = self.y[balanced_indices]
 
     def _get_batches_of_transformed_samples(self, index_array):
-        if self.channel_axis == 1:
-            batch_x = np.zeros((len(index_array),
-                                self.x.shape[self.channel_axis],
-                                2 * self.win_x + 1,
-                                2 * self.win_y + 1))
-        else:
-            batch_x = np.zeros((len(index_array),
-                                2 * self.win_x + 1,
-                                2 * self.win_y + 1,
-                                self.x.shape[self.channel_axis]))
+        batch_x = _gather_windows(
+            self.x, self.batch[index_array],
+            [self.pixels_x[index_array], self.pixels_y[index_array]],
+            (self.win_x, self.win_y), self.channel_axis)
 
-        for i, j in enumerate(index_array):
-            b, px, py = self.batch[j], self.pixels_x[j], self.pixels_y[j]
-            x = self._sample_image(b, px, py)
-            x = self.image_data_generator.random_transform(x.astype(K.floatx()))
-            x = self.image_data_generator.standardize(x)
+        batch_x = batch_x.astype(K.floatx(), copy=False)
 
-            batch_x[i] = x
+        if _has_random_transform(self.image_data_generator):
+            batch_x = _random_transform_batch(self.image_data_generator, batch_x,
+                                              data_format=self.data_format)
+        batch_x = _standardize_batch(self.image_data_generator, batch_x)
 
         if self.save_to_dir:
             for i, j in enumerate(index_array):
@@ -345,6 +1063,8 @@ class ImageSampleArrayIterator(Iterator):
         if self.y is None:
             return batch_x
         batch_y = self.y[index_array]
+        if self.num_classes is not None:
+            batch_y = np.eye(self.num_classes, dtype='int32')[batch_y]
         return batch_x, batch_y
 
     def next(self):
@@ -428,6 +1148,8 @@ class SampleDataGenerator(ImageDataGenerator):
              balance_classes=False,
              max_class_samples=None,
              seed=None,
+             compact=False,
+             as_dataset=False,
              save_to_dir=None,
              save_prefix='',
              save_format='png'):
@@ -444,6 +1166,10 @@ class SampleDataGenerator(ImageDataGenerator):
             max_class_samples: maximum number of samples per class.
             seed: Random seed for data shuffling.
             data_format: String, one of `channels_first`, `channels_last`.
+            compact: Boolean, keep `X` in its own dtype and `y` as integer
+                class maps, converting each batch to floatx and one-hot.
+            as_dataset: Boolean, return the batches as a `tf.data.Dataset`
+                built by `SharedArrayIterator.to_dataset`.
             save_to_dir: Optional directory where to save the pictures
                 being yielded, in a viewable format. This is useful
                 for visualizing the random transformations being
@@ -453,7 +1179,7 @@ class SampleDataGenerator(ImageDataGenerator):
             save_format: Format to use for saving sample images
                 (if `save_to_dir` is set).
         """
-        return ImageSampleArrayIterator(
+        iterator = ImageSampleArrayIterator(
             train_dict,
             self,
             batch_size=batch_size,
@@ -465,12 +1191,14 @@ class SampleDataGenerator(ImageDataGenerator):
             max_class_samples=max_class_samples,
             seed=seed,
             data_format=self.data_format,
+            compact=compact,
             save_to_dir=save_to_dir,
             save_prefix=save_prefix,
             save_format=save_format)
+        return iterator.to_dataset() if as_dataset else iterator
 
 
-class ImageFullyConvIterator(Iterator):
+class ImageFullyConvIterator(SharedArrayIterator):
     """Iterator yielding data from Numpy arrayss (`X and `y`).
 
     Arguments:
@@ -481,6 +1209,8 @@ class ImageFullyConvIterator(Iterator):
         shuffle: Boolean, whether to shuffle the data between epochs.
         seed: Random seed for data shuffling.
         data_format: String, one of `channels_first`, `channels_last`.
+        compact: Boolean, keep `X` in its own dtype and `y` as integer
+            class maps, converting each batch to floatx and one-hot.
         save_to_dir: Optional directory where to save the pictures
             being yielded, in a viewable format. This is useful
             for visualizing the random transformations being
@@ -501,6 +1231,7 @@ class ImageFullyConvIterator(Iterator):
                  transform_kwargs={},
                  seed=None,
                  data_format='channels_last',
+                 compact=False,
                  save_to_dir=None,
                  save_prefix='',
                  save_format='png'):
@@ -509,7 +1240,7 @@ class ImageFullyConvIterator(Iterator):
             raise ValueError('Training batches and labels should have the same'
                              'length. Found X.shape: {} y.shape: {}'.format(
                                  X.shape, y.shape))
-        self.x = np.asarray(X, dtype=K.floatx())
+        self.x = np.asarray(X) if compact else np.asarray(X, dtype=K.floatx())
 
         if self.x.ndim != 4:
             raise ValueError('Input data in `ImageFullyConvIterator` '
@@ -518,6 +1249,9 @@ class ImageFullyConvIterator(Iterator):
 
         self.y = _transform_masks(y, transform, data_format=data_format, **transform_kwargs)
         self.channel_axis = 3 if data_format == 'channels_last' else 1
+        self.num_classes = None
+        if compact:
+            self.y, self.num_classes = _get_class_map(self.y, self.channel_axis)
         self.skip = skip
         self.image_data_generator = image_data_generator
         self.data_format = data_format
@@ -528,22 +1262,25 @@ class ImageFullyConvIterator(Iterator):
             self.x.shape[0], batch_size, shuffle, seed)
 
     def _get_batches_of_transformed_samples(self, index_array):
-        batch_x = np.zeros(tuple([len(index_array)] + list(self.x.shape)[1:]))
-        batch_y = np.zeros(tuple([len(index_array)] + list(self.y.shape)[1:]))
-
-        for i, j in enumerate(index_array):
-            x = self.x[j]
-
-            if self.y is not None:
-                y = self.y[j]
-                x, y = self.image_data_generator.random_transform(x.astype(K.floatx()), y)
+        batch_x = self.x[index_array].astype(K.floatx(), copy=False)
+        batch_y = None if self.y is None else self.y[index_array]
+        if batch_y is not None and self.num_classes is not None:
+            batch_y = _class_map_to_one_hot(batch_y, self.num_classes,
+                                            self.channel_axis)
+
+        if _has_random_transform(self.image_data_generator):
+            if batch_y is None:
+                batch_x = _random_transform_batch(
+                    self.image_data_generator, batch_x,
+                    data_format=self.data_format)
             else:
-                x = self.image_data_generator.random_transform(x.astype(K.floatx()))
-
-            x = self.image_data_generator.standardize(x)
+                batch_x, batch_y = _random_transform_batch(
+                    self.image_data_generator, batch_x, batch_y,
+                    data_format=self.data_format)
 
-            batch_x[i] = x
-            batch_y[i] = y
+        batch_x = _standardize_batch(self.image_data_generator, batch_x)
+        if batch_y is not None:
+            batch_y = batch_y.astype(K.floatx(), copy=False)
 
         if self.save_to_dir:
             for i, j in enumerate(index_array):
@@ -654,6 +1391,8 @@ class ImageFullyConvDataGenerator(ImageDataGenerator):
              transform_kwargs={},
              shuffle=True,
              seed=None,
+             compact=False,
+             as_dataset=False,
              save_to_dir=None,
              save_prefix='',
              save_format='png'):
@@ -664,6 +1403,10 @@ class ImageFullyConvDataGenerator(ImageDataGenerator):
             batch_size: int (default: 1).
             shuffle: boolean (default: True).
             seed: int (default: None).
+            compact: Boolean, keep `X` in its own dtype and `y` as integer
+                class maps, converting each batch to floatx and one-hot.
+            as_dataset: Boolean, return the batches as a `tf.data.Dataset`
+                built by `SharedArrayIterator.to_dataset`.
             save_to_dir: None or str (default: None).
                 This allows you to optionally specify a directory
                 to which to save the augmented pictures being generated
@@ -677,7 +1420,7 @@ class ImageFullyConvDataGenerator(ImageDataGenerator):
             An Iterator yielding tuples of `(x, y)` where `x` is a numpy array
             of image data and `y` is a numpy array of labels of the same shape.
         """
-        return ImageFullyConvIterator(
+        iterator = ImageFullyConvIterator(
             train_dict,
             self,
             batch_size=batch_size,
@@ -687,9 +1430,11 @@ class ImageFullyConvDataGenerator(ImageDataGenerator):
             shuffle=shuffle,
             seed=seed,
             data_format=self.data_format,
+            compact=compact,
             save_to_dir=save_to_dir,
             save_prefix=save_prefix,
             save_format=save_format)
+        return iterator.to_dataset() if as_dataset else iterator
 
     def random_transform(self, x, y=None, seed=None):
         """Applies a random transformation to an image.
@@ -798,6 +1543,8 @@ class MovieDataGenerator(ImageDataGenerator):
              transform_kwargs={},
              shuffle=True,
              seed=None,
+             compact=False,
+             as_dataset=False,
              save_to_dir=None,
              save_prefix='',
              save_format='png'):
@@ -810,6 +1557,10 @@ class MovieDataGenerator(ImageDataGenerator):
             batch_size: int (default: 1).
             shuffle: boolean (default: True).
             seed: int (default: None).
+            compact: Boolean, keep `X` in its own dtype and `y` as integer
+                class maps, converting each batch to floatx and one-hot.
+            as_dataset: Boolean, return the batches as a `tf.data.Dataset`
+                built by `SharedArrayIterator.to_dataset`.
             save_to_dir: None or str (default: None).
                 This allows you to optionally specify a directory
                 to which to save the augmented pictures being generated
@@ -823,7 +1574,7 @@ class MovieDataGenerator(ImageDataGenerator):
             An Iterator yielding tuples of `(x, y)` where `x` is a numpy array
             of image data and `y` is a numpy array of labels of the same shape.
         """
-        return MovieArrayIterator(
+        iterator = MovieArrayIterator(
             train_dict,
             self,
             batch_size=batch_size,
@@ -834,9 +1585,11 @@ class MovieDataGenerator(ImageDataGenerator):
             shuffle=shuffle,
             seed=seed,
             data_format=self.data_format,
+            compact=compact,
             save_to_dir=save_to_dir,
             save_prefix=save_prefix,
             save_format=save_format)
+        return iterator.to_dataset() if as_dataset else iterator
 
     def standardize(self, x):
         """Apply the normalization configuration to a batch of inputs.
@@ -899,41 +1652,13 @@ class MovieDataGenerator(ImageDataGenerator):
             A randomly transformed version of the input (same shape).
             If `y` is passed, it is transformed if necessary and returned.
         """
-        # Note: Workaround to use self.apply_transform on our 4D tensor
-        self.row_axis -= 1
-        self.col_axis -= 1
-        self.time_axis -= 1
-        self.channel_axis -= 1
-        x_new = np.empty(x.shape)
-        if y is not None:
-            y_new = np.empty(y.shape)
-        # apply_transform expects ndim=3, but we are ndim=4
-        for frame in range(x.shape[self.time_axis]):
-            if self.data_format == 'channels_first':
-                params = self.get_random_transform(x[:, frame].shape, seed)
-                x_trans = self.apply_transform(x[:, frame], params)
-                x_new[:, frame] = np.rollaxis(x_trans, -1, 0)
-            else:
-                params = self.get_random_transform(x[frame].shape, seed)
-                x_new[frame] = self.apply_transform(x[frame], params)
-
-            if y is not None:
-                params['brightness'] = None
-                params['channel_shift_intensity'] = None
-                if self.data_format == 'channels_first':
-                    y_trans = self.apply_transform(y[:, frame], params)
-                    y_new[:, frame] = np.rollaxis(y_trans, 1, 0)
-                else:
-                    y_new[frame] = self.apply_transform(y[frame], params)
-
-        # Note: Undo workaround
-        self.row_axis += 1
-        self.col_axis += 1
-        self.time_axis += 1
-        self.channel_axis += 1
+        # Each frame of the movie is transformed independently
+        if seed is not None:
+            np.random.seed(seed)
         if y is None:
-            return x_new
-        return x_new, y_new
+            return _random_transform_batch(self, x[np.newaxis])[0]
+        x_new, y_new = _random_transform_batch(self, x[np.newaxis], y[np.newaxis])
+        return x_new[0], y_new[0]
 
     def fit(self, x, augment=False, rounds=1, seed=None):
         """Fits internal statistics to some sample data.
@@ -1008,11 +1733,13 @@ class MovieDataGenerator(ImageDataGenerator):
             self.principal_components = (u * s_inv).dot(u.T)
 
 
-class MovieArrayIterator(Iterator):
+class MovieArrayIterator(SharedArrayIterator):
     """Iterator yielding data from two 5D Numpy arrays (`X and `y`).
 
     Arguments:
         train_dict: dictionary consisting of numpy arrays for `X` and `y`.
+            A memory-mapped `X` (e.g. from `get_data` with a directory of
+            `.npy` files) is not loaded, only the sampled frames are read.
         movie_data_generator: Instance of `MovieDataGenerator`
             to use for random transformations and normalization.
         batch_size: Integer, size of a batch.
@@ -1020,6 +1747,8 @@ class MovieArrayIterator(Iterator):
         frames_per_batch: size of z axis in generated batches
         seed: Random seed for data shuffling.
         data_format: String, one of `channels_first`, `channels_last`.
+        compact: Boolean, keep `X` in its own dtype and `y` as integer
+            class maps, converting each batch to floatx and one-hot.
         save_to_dir: Optional directory where to save the pictures
             being yielded, in a viewable format. This is useful
             for visualizing the random transformations being
@@ -1041,6 +1770,7 @@ class MovieArrayIterator(Iterator):
                  shuffle=False,
                  seed=None,
                  data_format='channels_last',
+                 compact=False,
                  save_to_dir=None,
                  save_prefix='',
                  save_format='png'):
@@ -1053,8 +1783,17 @@ class MovieArrayIterator(Iterator):
 
         self.channel_axis = 4 if data_format == 'channels_last' else 1
         self.time_axis = 1 if data_format == 'channels_last' else 2
-        self.x = np.asarray(X, dtype=K.floatx())
+        if isinstance(X, (np.memmap, MemmapSubset)):
+            # frames are read and cast to floatx one batch at a time
+            self.x = X
+        else:
+            self.x = np.asarray(X) if compact else np.asarray(X, dtype=K.floatx())
+        if isinstance(y, MemmapSubset):
+            y = np.asarray(y)  # the masks are transformed up front
         self.y = _transform_masks(y, transform, data_format=data_format, **transform_kwargs)
+        self.num_classes = None
+        if compact:
+            self.y, self.num_classes = _get_class_map(self.y, self.channel_axis)
 
         if self.x.ndim != 5:
             raise ValueError('Input data in `MovieArrayIterator` '
@@ -1077,52 +1816,42 @@ class MovieArrayIterator(Iterator):
             len(self.y), batch_size, shuffle, seed)
 
     def _get_batches_of_transformed_samples(self, index_array):
-        if self.data_format == 'channels_first':
-            batch_x = np.zeros((len(index_array),
-                                self.x.shape[1],
-                                self.frames_per_batch,
-                                self.x.shape[3],
-                                self.x.shape[4]))
-            if self.y is not None:
-                batch_y = np.zeros((len(index_array),
-                                    self.y.shape[1],
-                                    self.frames_per_batch,
-                                    self.y.shape[3],
-                                    self.y.shape[4]))
-
+        # Sample along the time axis
+        last_frame = self.x.shape[self.time_axis] - self.frames_per_batch
+        time_starts = np.random.randint(0, high=last_frame, size=len(index_array))
+        frames = time_starts[:, None] + np.arange(self.frames_per_batch)
+
+        batch_index = np.asarray(index_array)[:, None]
+        if self.time_axis == 1:
+            batch_x = self.x[batch_index, frames]
+            batch_y = None if self.y is None else self.y[batch_index, frames]
         else:
-            batch_x = np.zeros(tuple([len(index_array), self.frames_per_batch] +
-                                     list(self.x.shape)[2:]))
-            if self.y is not None:
-                batch_y = np.zeros(tuple([len(index_array), self.frames_per_batch] +
-                                         list(self.y.shape)[2:]))
-
-        for i, j in enumerate(index_array):
-            if self.y is not None:
-                y = self.y[j]
-
-            # Sample along the time axis
-            last_frame = self.x.shape[self.time_axis] - self.frames_per_batch
-            time_start = np.random.randint(0, high=last_frame)
-            time_end = time_start + self.frames_per_batch
-            if self.time_axis == 1:
-                x = self.x[j, time_start:time_end, ...]
-                if self.y is not None:
-                    y = self.y[j, time_start:time_end, ...]
-            elif self.time_axis == 2:
-                x = self.x[j, :, time_start:time_end, ...]
-                if self.y is not None:
-                    y = self.y[j, :, time_start:time_end, ...]
-
-            if self.y is not None:
-                x, y = self.movie_data_generator.random_transform(
-                    x.astype(K.floatx()), y=y)
-                x = self.movie_data_generator.standardize(x)
-                batch_y[i] = y
+            batch_x = np.moveaxis(self.x[batch_index, :, frames], -3, 1)
+            if self.y is not None and self.num_classes is None:
+                batch_y = np.moveaxis(self.y[batch_index, :, frames], -3, 1)
+            elif self.y is not None:  # class maps have no channel axis
+                batch_y = self.y[batch_index, frames]
+            else:
+                batch_y = None
+
+        batch_x = batch_x.astype(K.floatx(), copy=False)
+        if batch_y is not None and self.num_classes is not None:
+            batch_y = _class_map_to_one_hot(batch_y, self.num_classes,
+                                            self.channel_axis)
+
+        if _has_random_transform(self.movie_data_generator):
+            if batch_y is None:
+                batch_x = _random_transform_batch(
+                    self.movie_data_generator, batch_x,
+                    data_format=self.data_format)
             else:
-                x = self.movie_data_generator.random_transform(x.astype(K.floatx()))
+                batch_x, batch_y = _random_transform_batch(
+                    self.movie_data_generator, batch_x, batch_y,
+                    data_format=self.data_format)
 
-            batch_x[i] = x
+        batch_x = _standardize_batch(self.movie_data_generator, batch_x)
+        if batch_y is not None:
+            batch_y = batch_y.astype(K.floatx(), copy=False)
 
         if self.save_to_dir:
             time_axis = 2 if self.data_format == 'channels_first' else 1
@@ -1178,7 +1907,7 @@ class MovieArrayIterator(Iterator):
         return self._get_batches_of_transformed_samples(index_array)
 
 
-class SampleMovieArrayIterator(Iterator):
+class SampleMovieArrayIterator(SharedArrayIterator):
     """Iterator yielding data from two 5D Numpy arrays (`X and `y`).
     Sampling will generate a `window_size` voxel classifying the center pixel,
 
@@ -1193,6 +1922,8 @@ class SampleMovieArrayIterator(Iterator):
         max_class_samples: maximum number of samples per class.
         seed: Random seed for data shuffling.
         data_format: String, one of `channels_first`, `channels_last`.
+        compact: Boolean, keep `X` in its own dtype and `y` as integer
+            class maps, converting each batch to floatx and one-hot.
         save_to_dir: Optional directory where to save the pictures
             being yielded, in a viewable format. This is useful
             for visualizing the random transformations being
@@ -1215,6 +1946,7 @@ class SampleMovieArrayIterator(Iterator):
                  window_size=(30, 30, 5),
                  seed=None,
                  data_format='channels_last',
+                 compact=False,
                  save_to_dir=None,
                  save_prefix='',
                  save_format='png'):
@@ -1226,7 +1958,7 @@ class SampleMovieArrayIterator(Iterator):
                                  X.shape, y.shape))
         self.channel_axis = 4 if data_format == 'channels_last' else 1
         self.time_axis = 1 if data_format == 'channels_last' else 2
-        self.x = np.asarray(X, dtype=K.floatx())
+        self.x = np.asarray(X) if compact else np.asarray(X, dtype=K.floatx())
         y = _transform_masks(y, transform,
                              data_format=data_format,
                              **transform_kwargs)
@@ -1261,7 +1993,14 @@ class SampleMovieArrayIterator(Iterator):
 
         self.class_balance(max_class_samples, balance_classes, seed=seed)
 
-        self.y = to_categorical(self.y).astype('int32')
+        if compact:
+            # keep the class of each sample, one-hot encoded per batch
+            self.num_classes = int(np.max(self.y)) + 1
+            dtype = 'uint8' if self.num_classes <= 256 else 'uint16'
+            self.y = self.y.astype(dtype)
+        else:
+            self.num_classes = None
+            self.y = to_categorical(self.y).astype('int32')
         super(SampleMovieArrayIterator, self).__init__(
             len(self.y), batch_size, shuffle, seed)
 
@@ -1325,26 +2064,18 @@ class SampleMovieArrayIterator(Iterator):
         self.y = self.y[balanced_indices]
 
     def _get_batches_of_transformed_samples(self, index_array):
-        if self.channel_axis == 1:
-            batch_x = np.zeros((len(index_array),
-                                self.x.shape[self.channel_axis],
-                                2 * self.win_z + 1,
-                                2 * self.win_x + 1,
-                                2 * self.win_y + 1))
-        else:
-            batch_x = np.zeros((len(index_array),
-                                2 * self.win_z + 1,
-                                2 * self.win_x + 1,
-                                2 * self.win_y + 1,
-                                self.x.shape[self.channel_axis]))
+        batch_x = _gather_windows(
+            self.x, self.batch[index_array],
+            [self.pixels_z[index_array], self.pixels_x[index_array],
+             self.pixels_y[index_array]],
+            (self.win_z, self.win_x, self.win_y), self.channel_axis)
 
-        for i, j in enumerate(index_array):
-            b, pz, px, py = self.batch[j], self.pixels_z[j], self.pixels_x[j], self.pixels_y[j]
-            x = self._sample_image(b, pz, px, py)
-            x = self.movie_data_generator.random_transform(x.astype(K.floatx()))
-            x = self.movie_data_generator.standardize(x)
+        batch_x = batch_x.astype(K.floatx(), copy=False)
 
-            batch_x[i] = x
+        if _has_random_transform(self.movie_data_generator):
+            batch_x = _random_transform_batch(self.movie_data_generator, batch_x,
+                                              data_format=self.data_format)
+        batch_x = _standardize_batch(self.movie_data_generator, batch_x)
 
         if self.save_to_dir:
             time_axis = 2 if self.data_format == 'channels_first' else 1
@@ -1365,6 +2096,8 @@ class SampleMovieArrayIterator(Iterator):
         if self.y is None:
             return batch_x
         batch_y = self.y[index_array]
+        if self.num_classes is not None:
+            batch_y = np.eye(self.num_classes, dtype='int32')[batch_y]
         return batch_x, batch_y
 
     def next(self):
@@ -1448,6 +2181,8 @@ class SampleMovieDataGenerator(MovieDataGenerator):
              balance_classes=False,
              max_class_samples=None,
              seed=None,
+             compact=False,
+             as_dataset=False,
              save_to_dir=None,
              save_prefix='',
              save_format='png'):
@@ -1460,6 +2195,10 @@ class SampleMovieDataGenerator(MovieDataGenerator):
             batch_size: int (default: 1).
             shuffle: boolean (default: True).
             seed: int (default: None).
+            compact: Boolean, keep `X` in its own dtype and `y` as integer
+                class maps, converting each batch to floatx and one-hot.
+            as_dataset: Boolean, return the batches as a `tf.data.Dataset`
+                built by `SharedArrayIterator.to_dataset`.
             save_to_dir: None or str (default: None).
                 This allows you to optionally specify a directory
                 to which to save the augmented pictures being generated
@@ -1473,7 +2212,7 @@ class SampleMovieDataGenerator(MovieDataGenerator):
             An Iterator yielding tuples of `(x, y)` where `x` is a numpy array
             of image data and `y` is a numpy array of labels of the same shape.
         """
-        return SampleMovieArrayIterator(
+        iterator = SampleMovieArrayIterator(
             train_dict,
             self,
             batch_size=batch_size,
@@ -1485,9 +2224,11 @@ class SampleMovieDataGenerator(MovieDataGenerator):
             max_class_samples=max_class_samples,
             seed=seed,
             data_format=self.data_format,
+            compact=compact,
             save_to_dir=save_to_dir,
             save_prefix=save_prefix,
             save_format=save_format)
+        return iterator.to_dataset() if as_dataset else iterator
 
 
 """
@@ -1565,10 +2306,50 @@ class SiameseDataGenerator(ImageDataGenerator):
              batch_size=32,
              shuffle=True,
              seed=None,
+             as_dataset=False,
+             num_workers=None,
+             feature_cache_size=None,
              save_to_dir=None,
              save_prefix='',
              save_format='png'):
-        return SiameseIterator(
+        """Generates batches of pairs of tracked cells and their relationship.
+
+        Arguments:
+            train_dict: dictionary consisting of numpy arrays for `X` and `y`.
+            features: List of Strings, feature names to calculate and yield.
+            crop_dim: Integer, size of the resized `appearance` images
+            min_track_length: Integer, minimum number of frames to track over.
+            neighborhood_scale_size: Integer, size of resized `neighborhood`
+                images
+            neighborhood_true_size: Integer, size of cropped `neighborhood`
+                images
+            sync_transform: Boolean, whether to transform the features.
+            batch_size: Integer, size of a batch.
+            shuffle: Boolean, whether to shuffle the data between epochs.
+            seed: Random seed for data shuffling.
+            as_dataset: Boolean, return the batches as a `tf.data.Dataset`
+                built by `SharedArrayIterator.to_dataset`.
+            num_workers: Integer, number of processes forked to compute the
+                features of the tracks. Defaults to None, computing them in
+                this process. Forking a process that already runs a TF
+                session can deadlock the workers, so only use this before
+                TF or Keras have started a session.
+            feature_cache_size: Integer, if set, the features of a cell are
+                computed when first sampled and at most `feature_cache_size`
+                bytes of features are kept instead of precomputing them.
+            save_to_dir: Optional directory where to save the pictures
+                being yielded, in a viewable format. This is useful
+                for visualizing the random transformations being
+                applied, for debugging purposes.
+            save_prefix: String prefix to use for saving sample
+                images (if `save_to_dir` is set).
+            save_format: Format to use for saving sample images
+                (if `save_to_dir` is set).
+
+        Returns:
+            SiameseIterator, or a `tf.data.Dataset` if `as_dataset`
+        """
+        iterator = SiameseIterator(
             train_dict,
             self,
             features=features,
@@ -1581,12 +2362,28 @@ class SiameseDataGenerator(ImageDataGenerator):
             shuffle=shuffle,
             seed=seed,
             data_format=self.data_format,
+            num_workers=num_workers,
+            feature_cache_size=feature_cache_size,
             save_to_dir=save_to_dir,
             save_prefix=save_prefix,
             save_format=save_format)
+        return iterator.to_dataset() if as_dataset else iterator
+
+
+_SIAMESE_WORKER = {}
+
+
+def _init_siamese_worker(iterator):
+    """Initialize a worker process with the `SiameseIterator`"""
+    _SIAMESE_WORKER['iterator'] = iterator
 
 
-class SiameseIterator(Iterator):
+def _get_siamese_batch_features(batch):
+    """Get the features of the tracks of a movie in a worker process"""
+    return _SIAMESE_WORKER['iterator']._get_batch_features(batch)
+
+
+class SiameseIterator(SharedArrayIterator):
     """Iterator yielding two sets of features (`X`) and the relationship (`y`)
     Features are passed in as a list of feature names, while the y is one of:
         `same`, `different`, or `daughter`
@@ -1605,6 +2402,12 @@ class SiameseIterator(Iterator):
         shuffle: Boolean, whether to shuffle the data between epochs.
         seed: Random seed for data shuffling.
         data_format: String, one of `channels_first`, `channels_last`.
+        num_workers: Integer, number of processes computing the features
+            of the tracks. Defaults to None, computing them in this process.
+        feature_cache_size: Integer, if set, the features of a cell are
+            computed the first time one of its frames is sampled, and at
+            most `feature_cache_size` bytes of features are kept in an
+            LRU cache instead of precomputing the features of all tracks.
         save_to_dir: Optional directory where to save the pictures
             being yielded, in a viewable format. This is useful
             for visualizing the random transformations being
@@ -1627,6 +2430,8 @@ class SiameseIterator(Iterator):
                  shuffle=False,
                  seed=None,
                  data_format='channels_last',
+                 num_workers=None,
+                 feature_cache_size=None,
                  save_to_dir=None,
                  save_prefix='',
                  save_format='png'):
@@ -1649,6 +2454,11 @@ class SiameseIterator(Iterator):
                              'should have rank 5. You passed an array '
                              'with shape', self.x.shape)
 
+        if self.x.shape[0] != self.y.shape[0]:
+            raise ValueError('Training batches and labels should have the same'
+                             'length. Found X.shape: {} y.shape: {}'.format(
+                                 self.x.shape, self.y.shape))
+
         self.crop_dim = crop_dim
         self.min_track_length = min_track_length
         self.features = sorted(features)
@@ -1657,6 +2467,8 @@ class SiameseIterator(Iterator):
         self.neighborhood_true_size = np.int(neighborhood_true_size)
         self.image_data_generator = image_data_generator
         self.data_format = data_format
+        self.num_workers = num_workers
+        self.feature_cache_size = feature_cache_size
         self.save_to_dir = save_to_dir
         self.save_prefix = save_prefix
         self.save_format = save_format
@@ -1668,7 +2480,12 @@ class SiameseIterator(Iterator):
 
         self._remove_bad_images()
         self._create_track_ids()
-        self._create_features()
+        self._create_pair_index()
+        if feature_cache_size is None:
+            self._create_features()
+        else:
+            self._feature_cache = collections.OrderedDict()
+            self._feature_cache_bytes = 0
 
         super(SiameseIterator, self).__init__(
             len(self.track_ids), batch_size, shuffle, seed)
@@ -1676,24 +2493,16 @@ class SiameseIterator(Iterator):
     def _remove_bad_images(self):
         """Iterate over all image batches and remove images with only one cell.
         """
-        good_batches = []
-        for batch in range(self.x.shape[0]):
-            # There should be at least 3 id's - 2 cells and 1 background
-            if len(np.unique(self.y[batch])) > 2:
-                good_batches.append(batch)
-
-        X_new_shape = tuple([len(good_batches)] + list(self.x.shape)[1:])
-        y_new_shape = tuple([len(good_batches)] + list(self.y.shape)[1:])
-
-        X_new = np.zeros(X_new_shape, dtype=K.floatx())
-        y_new = np.zeros(y_new_shape, dtype='int32')
-
-        for k, batch in enumerate(good_batches):
-            X_new[k] = self.x[batch]
-            y_new[k] = self.y[batch]
-
-        self.x = X_new
-        self.y = y_new
+        # There should be at least 3 id's - 2 cells and 1 background,
+        # so some pixel must differ from both the lowest and highest id
+        y_flat = self.y.reshape(self.y.shape[0], -1)
+        lowest = y_flat.min(axis=1, keepdims=True)
+        highest = y_flat.max(axis=1, keepdims=True)
+        is_good = np.any((y_flat != lowest) & (y_flat != highest), axis=1)
+        good_batches = np.flatnonzero(is_good)
+
+        self.x = self.x[good_batches]
+        self.y = self.y[good_batches]
         self.daughters = [self.daughters[i] for i in good_batches]
 
     def _create_track_ids(self):
@@ -1707,57 +2516,53 @@ class SiameseIterator(Iterator):
         track_ids = {}
         for batch in range(self.y.shape[0]):
             y_batch = self.y[batch]
+            if self.data_format == 'channels_first':
+                y_batch = np.moveaxis(y_batch, 0, -1)
             daughters_batch = self.daughters[batch]
-            num_cells = np.amax(y_batch)  # TODO: iterate over np.unique instead
-            for cell in range(1, num_cells + 1):
-                # count number of pixels cell occupies in each frame
-                y_true = np.sum(y_batch == cell, axis=(self.row_axis - 1, self.col_axis - 1))
-                # get indices of frames where cell is present
-                y_index = np.where(y_true > 0)[0]
-                if y_index.size > 3:  # if cell is present at all
-                    # Only include daughters if there are enough frames in their tracks
-                    if self.daughters is not None:
-                        daughter_ids = daughters_batch.get(cell, [])
-                        if daughter_ids:
-                            daughter_track_lengths = []
-                            for did in daughter_ids:
-                                # Screen daughter tracks to make sure they are long enough
-                                # Length currently set to 0
-                                axis = (self.row_axis - 1, self.col_axis - 1)
-                                d_true = np.sum(y_batch == did, axis=axis)
-                                d_track_length = len(np.where(d_true > 0)[0])
-                                daughter_track_lengths.append(d_track_length > 3)
-                            keep_daughters = all(daughter_track_lengths)
-                            daughters = daughter_ids if keep_daughters else []
-                        else:
-                            daughters = []
-                    else:
-                        daughters = []
 
-                    track_ids[track_counter] = {
-                        'batch': batch,
-                        'label': cell,
-                        'frames': y_index,
-                        'daughters': daughters
-                    }
-
-                    track_counter += 1
-
-                else:
-                    y_batch[y_batch == cell] = 0
-                    self.y[batch] = y_batch
+            # count the pixels of every label in every frame in one pass
+            num_frames = y_batch.shape[0]
+            num_labels = int(np.amax(y_batch)) + 1
+            y_flat = y_batch.reshape(num_frames, -1)
+            offsets = np.arange(num_frames)[:, np.newaxis] * num_labels
+            counts = np.bincount((y_flat + offsets).ravel(),
+                                 minlength=num_frames * num_labels)
+            is_present = counts.reshape(num_frames, num_labels) > 0
+            is_present[:, 0] = False  # background is not a cell
+            track_lengths = is_present.sum(axis=0)
+
+            # remove cells that are present in too few frames
+            is_short = (track_lengths > 0) & (track_lengths <= 3)
+            if is_short.any():
+                y_batch[is_short[y_batch]] = 0
+                is_present[:, is_short] = False
+
+            frame_cells = [np.flatnonzero(p).astype(self.y.dtype) for p in is_present]
+
+            for cell in np.flatnonzero(track_lengths > 3):
+                cell = int(cell)
+                # Only include daughters if there are enough frames in their tracks
+                daughter_ids = daughters_batch.get(cell, [])
+                keep_daughters = all(isinstance(did, (int, np.integer)) and
+                                     0 < did < num_labels and track_lengths[did] > 3
+                                     for did in daughter_ids)
+                daughters = daughter_ids if daughter_ids and keep_daughters else []
+
+                # locate all of the different cells in each frame
+                frames = np.flatnonzero(is_present[:, cell])
+                different = {}
+                for frame in frames:
+                    different[frame] = frame_cells[frame][frame_cells[frame] != cell]
+
+                track_ids[track_counter] = {
+                    'batch': batch,
+                    'label': cell,
+                    'frames': frames,
+                    'daughters': daughters,
+                    'different': different
+                }
 
-        # Add a field to the track_ids dict that locates all of the different cells
-        # in each frame
-        for track in track_ids:
-            track_ids[track]['different'] = {}
-            batch = track_ids[track]['batch']
-            cell_label = track_ids[track]['label']
-            for frame in track_ids[track]['frames']:
-                y_unique = np.unique(self.y[batch][frame])
-                y_unique = np.delete(y_unique, np.where(y_unique == 0))
-                y_unique = np.delete(y_unique, np.where(y_unique == cell_label))
-                track_ids[track]['different'][frame] = y_unique
+                track_counter += 1
 
         # We will need to look up the track_ids of cells if we know their batch and label. We will
         # create a dictionary that stores this information
@@ -1780,44 +2585,49 @@ class SiameseIterator(Iterator):
             if self.track_ids[track]['daughters']:
                 self.tracks_with_divisions.append(track)
 
-    def _sub_area(self, X_frame, y_frame, cell_label, num_channels):
-        if self.data_format == 'channels_first':
-            X_frame = np.rollaxis(X_frame, 0, 3)
-            y_frame = np.rollaxis(y_frame, 0, 3)
-
-        pads = ((self.neighborhood_true_size, self.neighborhood_true_size),
-                (self.neighborhood_true_size, self.neighborhood_true_size),
-                (0, 0))
-
-        X_padded = np.pad(X_frame, pads, mode='constant', constant_values=0)
-        y_padded = np.pad(y_frame, pads, mode='constant', constant_values=0)
-        props = regionprops(np.squeeze(np.int32(y_padded == cell_label)))
-        center_x, center_y = props[0].centroid
-        center_x, center_y = np.int(center_x), np.int(center_y)
-        X_reduced = X_padded[
-            center_x - self.neighborhood_true_size:center_x + self.neighborhood_true_size,
-            center_y - self.neighborhood_true_size:center_y + self.neighborhood_true_size,
-            :]
-
-        # Resize X_reduced in case it is used instead of the neighborhood method
-        resize_shape = (2 * self.neighborhood_scale_size + 1,
-                        2 * self.neighborhood_scale_size + 1, num_channels)
-
-        # Resize images from bounding box
-        X_reduced = resize(X_reduced, resize_shape, mode='constant', preserve_range=True)
-
-        if self.data_format == 'channels_first':
-            X_frame = np.rollaxis(X_frame, -1, 0)
-            y_frame = np.rollaxis(y_frame, -1, 0)
-
-        return X_reduced
+    def _create_pair_index(self):
+        """Flattens the track IDs into arrays to draw pairs of a whole batch
+        at once. The frames of every track are concatenated with offsets per
+        track, and the tracks that are different from a track in one of its
+        frames are concatenated with offsets per tracked frame.
+        """
+        num_tracks = len(self.track_ids)
+        track_frames = [self.track_ids[t]['frames'] for t in range(num_tracks)]
+        frame_counts = [len(frames) for frames in track_frames]
+        self._frame_offsets = np.cumsum([0] + frame_counts, dtype='int64')
+        self._track_frames = np.concatenate(
+            [np.zeros(0, dtype='int64')] + track_frames).astype('int64')
+
+        different_tracks = []
+        daughter_tracks = []
+        for track in range(num_tracks):
+            track_id = self.track_ids[track]
+            lookup = self.reverse_track_ids[track_id['batch']]
+            for frame in track_id['frames']:
+                different_tracks.append(
+                    [lookup[label] for label in track_id['different'][frame]])
+            daughter_tracks.append(
+                [lookup[label] for label in track_id['daughters']])
+
+        def flatten(lists):
+            offsets = np.cumsum([0] + [len(l) for l in lists], dtype='int64')
+            values = np.array([v for l in lists for v in l], dtype='int64')
+            return offsets, values
+
+        self._different_offsets, self._different_tracks = flatten(different_tracks)
+        self._daughter_offsets, self._daughter_tracks = flatten(daughter_tracks)
+        self._division_tracks = np.array(self.tracks_with_divisions, dtype='int64')
 
     def _get_features(self, X, y, frames, labels):
         """Gets the features of a list of cells.
            Cells are defined by lists of frames and labels.
            The i'th element of frames and labels is the frame and label of the
-           i'th cell being grabbed.
+           i'th cell being grabbed. The cells of each frame are processed
+           together by `get_frame_features`.
         """
+        frames = np.asarray(frames, dtype='int64')
+        labels = np.asarray(labels)
+
         channel_axis = self.channel_axis - 1
         if self.data_format == 'channels_first':
             appearance_shape = (X.shape[channel_axis],
@@ -1837,68 +2647,91 @@ class SiameseIterator(Iterator):
 
         # future area should not include last frame in movie
         last_frame = self.x.shape[self.time_axis] - 1
-        if last_frame in frames:
-            future_area_len = len(frames) - 1
-        else:
-            future_area_len = len(frames)
+        has_future = frames != last_frame
+        future_index = np.cumsum(has_future) - 1
 
-        future_area_shape = (future_area_len,
+        future_area_shape = (int(has_future.sum()),
                              2 * self.neighborhood_scale_size + 1,
                              2 * self.neighborhood_scale_size + 1,
                              1)
 
         # Initialize storage for appearances and centroids
         appearances = np.zeros(appearance_shape, dtype=K.floatx())
-        centroids = []
-        rprops = []
+        centroids = np.zeros((len(frames), 2), dtype=K.floatx())
+        rprops = np.zeros((len(frames), 3), dtype=K.floatx())
         neighborhoods = np.zeros(neighborhood_shape, dtype=K.floatx())
         future_areas = np.zeros(future_area_shape, dtype=K.floatx())
 
-        for counter, (frame, cell_label) in enumerate(zip(frames, labels)):
-            # Get the bounding box
-            X_frame = X[frame] if self.data_format == 'channels_last' else X[:, frame]
-            y_frame = y[frame] if self.data_format == 'channels_last' else y[:, frame]
-
-            props = regionprops(np.squeeze(np.int32(y_frame == cell_label)))
-            minr, minc, maxr, maxc = props[0].bbox
-            centroids.append(props[0].centroid)
-            rprops.append(np.array([props[0].area, props[0].perimeter, props[0].eccentricity]))
-
-            # Extract images from bounding boxes
+        for frame in np.unique(frames):
+            index = np.flatnonzero(frames == frame)
             if self.data_format == 'channels_first':
-                appearance = np.copy(X[:, frame, minr:maxr, minc:maxc])
-                resize_shape = (X.shape[channel_axis], self.crop_dim, self.crop_dim)
+                X_frame, y_frame = X[:, frame], y[:, frame]
+                X_future_frame = X[:, frame + 1] if frame != last_frame else None
             else:
-                appearance = np.copy(X[frame, minr:maxr, minc:maxc, :])
-                resize_shape = (self.crop_dim, self.crop_dim, X.shape[channel_axis])
+                X_frame, y_frame = X[frame], y[frame]
+                X_future_frame = X[frame + 1] if frame != last_frame else None
+
+            features = get_frame_features(
+                X_frame, y_frame, labels[index],
+                crop_dim=self.crop_dim,
+                neighborhood_scale_size=self.neighborhood_scale_size,
+                neighborhood_true_size=self.neighborhood_true_size,
+                X_future_frame=X_future_frame,
+                data_format=self.data_format)
 
-            # Resize images from bounding box
-            appearance = resize(appearance, resize_shape, mode='constant', preserve_range=True)
             if self.data_format == 'channels_first':
-                appearances[:, counter] = appearance
+                appearances[:, index] = np.moveaxis(features['appearances'], 0, 1)
             else:
-                appearances[counter] = appearance
+                appearances[index] = features['appearances']
+            centroids[index] = features['centroids']
+            rprops[index] = features['regionprops']
+            neighborhoods[index] = features['neighborhoods']
+            if X_future_frame is not None:
+                future_areas[future_index[index]] = features['future_areas']
 
-            neighborhoods[counter] = self._sub_area(
-                X_frame, y_frame, cell_label, X.shape[channel_axis])
-
-            if frame != last_frame:
-                if self.data_format == 'channels_first':
-                    X_future_frame = X[:, frame + 1]
-                else:
-                    X_future_frame = X[frame + 1]
+        return [appearances, centroids, neighborhoods, rprops, future_areas]
 
-                future_areas[counter] = self._sub_area(
-                    X_future_frame, y_frame, cell_label, X.shape[channel_axis])
+    def _get_batch_features(self, batch):
+        """Gets the features of every frame of every track in a movie
 
-        return [appearances, centroids, neighborhoods, rprops, future_areas]
+        Returns:
+            tuple: the track and frame of each cell, and their features
+        """
+        tracks = sorted(self.reverse_track_ids[batch].values())
+        track_frames = [self.track_ids[t]['frames'] for t in tracks]
+        track_index = np.repeat(np.array(tracks, dtype='int64'),
+                                [len(f) for f in track_frames])
+        frames = np.concatenate([np.zeros(0, dtype='int64')] + track_frames)
+        labels = [self.track_ids[t]['label'] for t in track_index]
+        features = self._get_features(self.x[batch], self.y[batch], frames, labels)
+        return track_index, frames.astype('int64'), features
 
     def _create_features(self):
         """Gets the appearances of every cell, crops them out, resizes them,
         and stores them in an matrix. Pre-fetching the appearances should
         significantly speed up the generator. It also gets the centroids and
         neighborhoods.
+
+        The tracks are processed by `num_workers` processes if given, and the
+        features are stored in the transform cache (see `set_transform_cache`)
+        if it is enabled.
         """
+        feature_names = ('all_appearances', 'all_centroids', 'all_regionprops',
+                         'all_neighborhoods', 'all_future_areas')
+
+        cache_dir = _TRANSFORM_CACHE['cache_dir']
+        if cache_dir is not None:
+            params = ('siamese', self.data_format, self.crop_dim,
+                      self.neighborhood_scale_size, self.neighborhood_true_size)
+            key = _get_cache_key([self.x, self.y], params)
+            cache_paths = [os.path.join(cache_dir, '{}_{}.npy'.format(key, name))
+                           for name in feature_names]
+            if all(os.path.isfile(path) for path in cache_paths):
+                for name, path in zip(feature_names, cache_paths):
+                    os.utime(path, None)  # mark as recently used
+                    setattr(self, name, np.load(path, mmap_mode='r'))
+                return
+
         number_of_tracks = len(self.track_ids.keys())
 
         # Initialize the array for the appearances and centroids
@@ -1936,31 +2769,37 @@ class SiameseIterator(Iterator):
                                  1)
         all_future_areas = np.zeros(all_future_area_shape, dtype=K.floatx())
 
-        for track in self.track_ids:
-            batch = self.track_ids[track]['batch']
-            cell_label = self.track_ids[track]['label']
-            frames = self.track_ids[track]['frames']
-
-            # Make an array of labels that the same length as the frames array
-            labels = [cell_label] * len(frames)
-            X = self.x[batch]
-            y = self.y[batch]
+        # forking only when asked, a process running TF may deadlock
+        num_workers = min(self.num_workers or 1, self.y.shape[0])
+
+        batches = list(range(self.y.shape[0]))
+        if num_workers > 1:
+            pool = multiprocessing.Pool(num_workers,
+                                        initializer=_init_siamese_worker,
+                                        initargs=(self,))
+            try:
+                batch_features = list(pool.imap(_get_siamese_batch_features, batches))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            batch_features = [self._get_batch_features(b) for b in batches]
 
-            appearance, centroid, neighborhood, regionprop, future_area = self._get_features(
-                X, y, frames, labels)
+        last_frame = self.x.shape[self.time_axis] - 1
+        for tracks, frames, features in batch_features:
+            appearance, centroid, neighborhood, regionprop, future_area = features
 
-            all_appearances[track] = appearance
-            all_centroids[track, np.array(frames), :] = centroid
-            all_neighborhoods[track, np.array(frames), :, :] = neighborhood
+            if self.data_format == 'channels_first':
+                all_appearances[tracks, :, frames] = np.moveaxis(appearance, 0, 1)
+            else:
+                all_appearances[tracks, frames] = appearance
+            all_centroids[tracks, frames] = centroid
+            all_neighborhoods[tracks, frames] = neighborhood
+            all_regionprops[tracks, frames] = regionprop
 
             # future area should never include last frame
-            last_frame = self.x.shape[self.time_axis] - 1
-            if last_frame in frames:
-                frames_without_last = [f for f in frames if f != last_frame]
-                all_future_areas[track, np.array(frames_without_last), :, :] = future_area
-            else:
-                all_future_areas[track, np.array(frames), :, :] = future_area
-            all_regionprops[track, np.array(frames), :] = regionprop
+            has_future = frames != last_frame
+            all_future_areas[tracks[has_future], frames[has_future]] = future_area
 
         self.all_appearances = all_appearances
         self.all_centroids = all_centroids
@@ -1968,353 +2807,289 @@ class SiameseIterator(Iterator):
         self.all_neighborhoods = all_neighborhoods
         self.all_future_areas = all_future_areas
 
+        if cache_dir is not None:
+            for name, path in zip(feature_names, cache_paths):
+                _write_cache_file(getattr(self, name), path)
+            _evict_transform_cache(cache_dir, _TRANSFORM_CACHE['max_size'])
+            if all(os.path.isfile(path) for path in cache_paths):
+                for name, path in zip(feature_names, cache_paths):
+                    setattr(self, name, np.load(path, mmap_mode='r'))
+
+    def _get_cell_features(self, track, frame):
+        """Gets the features of a track in a single frame from the LRU
+        feature cache. On a miss, the features of every track in the frame
+        are computed in one pass over the frame and cached together.
+        """
+        key = (track, frame)
+        with self.lock:
+            if key in self._feature_cache:
+                self._feature_cache.move_to_end(key)
+                return self._feature_cache[key]
+
+        batch = self.track_ids[track]['batch']
+        tracks = [t for t in sorted(self.reverse_track_ids[batch].values())
+                  if t != track and frame in self.track_ids[t]['frames']]
+        tracks.append(track)  # the requested track is the most recently used
+        labels = [self.track_ids[t]['label'] for t in tracks]
+        features = self._get_features(self.x[batch], self.y[batch],
+                                      [frame] * len(tracks), labels)
+        features = [np.asarray(f, dtype=K.floatx()) for f in features]
+
+        with self.lock:
+            for i, t in enumerate(tracks):
+                # copy each cell so evicting it releases its memory
+                cell_features = [np.array(f[i:i + 1]) for f in features]
+                if self.data_format == 'channels_first':
+                    cell_features[0] = np.array(features[0][:, i:i + 1])
+                cell_features = tuple(cell_features)
+                if (t, frame) not in self._feature_cache:
+                    self._feature_cache[(t, frame)] = cell_features
+                    self._feature_cache_bytes += sum(f.nbytes for f in cell_features)
+                else:
+                    self._feature_cache.move_to_end((t, frame))
+            while (self._feature_cache_bytes > self.feature_cache_size and
+                   len(self._feature_cache) > 1):
+                _, evicted = self._feature_cache.popitem(last=False)
+                self._feature_cache_bytes -= sum(f.nbytes for f in evicted)
+        return cell_features
+
+    def _fetch_cell_features(self, track, frames, index, axis=0):
+        """Stacks one of the lazily computed features of a track"""
+        features = [self._get_cell_features(track, f)[index] for f in frames]
+        return np.concatenate(features, axis=axis)
+
     def _fetch_appearances(self, track, frames):
         """Gets the appearances after they have been cropped out of the image
         """
         # TODO: Check to make sure the frames are acceptable
+        if self.feature_cache_size is not None:
+            axis = 1 if self.data_format == 'channels_first' else 0
+            return self._fetch_cell_features(track, frames, 0, axis=axis)
         if self.data_format == 'channels_first':
-            return self.all_appearances[track, :, np.array(frames), :, :]
+            # index the track first to keep the channel axis first
+            return self.all_appearances[track][:, np.array(frames), :, :]
         return self.all_appearances[track, np.array(frames), :, :, :]
 
     def _fetch_centroids(self, track, frames):
         """Gets the centroids after they have been extracted and stored
         """
         # TODO: Check to make sure the frames are acceptable
+        if self.feature_cache_size is not None:
+            return self._fetch_cell_features(track, frames, 1)
         return self.all_centroids[track, np.array(frames), :]
 
     def _fetch_neighborhoods(self, track, frames):
         """Gets the neighborhoods after they have been extracted and stored
         """
         # TODO: Check to make sure the frames are acceptable
-        if self.data_format == 'channels_first':
-            return self.all_neighborhoods[track, :, np.array(frames), :, :]
+        # stored as channels_last for both data formats
+        if self.feature_cache_size is not None:
+            return self._fetch_cell_features(track, frames, 2)
         return self.all_neighborhoods[track, np.array(frames), :, :, :]
 
     def _fetch_future_areas(self, track, frames):
         """Gets the future areas after they have been extracted and stored
         """
         # TODO: Check to make sure the frames are acceptable
-        if self.data_format == 'channels_first':
-            return self.all_future_areas[track, :, np.array(frames), :, :]
+        # stored as channels_last for both data formats
+        if self.feature_cache_size is not None:
+            return self._fetch_cell_features(track, frames, 4)
         return self.all_future_areas[track, np.array(frames), :, :, :]
 
     def _fetch_regionprops(self, track, frames):
         """Gets the regionprops after they have been extracted and stored
         """
         # TODO: Check to make sure the frames are acceptable
+        if self.feature_cache_size is not None:
+            return self._fetch_cell_features(track, frames, 3)
         return self.all_regionprops[track, np.array(frames)]
 
-    def _fetch_frames(self, track, division=False):
-        """Fetch a random interval of frames given a track:
-
-           If division, grab the last `min_track_length` frames.
-           Otherwise, grab any interval of frames of length `min_track_length`
-           that does not include the last tracked frame.
+    def _gather_features(self, feature, tracks, frames):
+        """Gathers a stored feature of a batch of tracks, each at a row of
+        `frames`, with a leading batch axis.
+        """
+        if self.feature_cache_size is not None:
+            fetch = getattr(self, '_fetch_' + feature)
+            return np.stack([fetch(t, f) for t, f in zip(tracks, frames)])
+        all_features = getattr(self, 'all_' + feature)
+        if feature == 'appearances' and self.data_format == 'channels_first':
+            # keep the channel axis before the time axis
+            return np.moveaxis(all_features[tracks[:, None], :, frames], 2, 1)
+        return all_features[tracks[:, None], frames]
+
+    def _sample_pairs(self, index_array):
+        """Draws a comparison for each track in `index_array` at once.
+
+           The class of each pair is different (0), same (1) or division (2).
+           Divisions compare the last `min_track_length` frames of a track
+           with the first frame of one of its daughters. Otherwise, any interval
+           of `min_track_length` frames that does not include the last tracked
+           frame is compared with the next frame of the track, against the
+           same cell or a different cell in that frame.
 
            Args:
-               track: integer, used to look up track ID
-               division: boolean, is the event being tracked a division
+               index_array: array of track IDs
 
            Returns:
-               list of interval of frames of length `min_track_length`
+               tuple: tracks_1 and frames_1 of shape (n, min_track_length),
+                   tracks_2 and frames_2 of shape (n,) and the class of each pair
         """
-        track_id = self.track_ids[track]
-
-        # convert to list to use python's (+) on lists
-        all_frames = list(track_id['frames'])
-
-        if division:
-            # sanity check
-            if (self.x.shape[self.time_axis] - 1) in all_frames:
-                logging.warning('Track %s is annotated incorrectly. '
-                                'No parent cell should be in the last frame of'
-                                ' any movie.', track_id)
-                raise Exception('Parent cell should not be in last frame of movie')
-
-            candidate_interval = all_frames[-self.min_track_length:]
-        else:
-            # exclude the final frame for comparison purposes
-            candidate_frames = all_frames[:-1]
-
-            # `start` is within [0, len(candidate_frames) - min_track_length]
-            # in order to have at least `min_track_length` preceding frames.
-            # The `max(..., 1)` is because `len(all_frames) <= self.min_track_length`
-            # is possible. If `len(candidate_frames) <= self.min_track_length`,
-            # then the interval will be the entire `candidate_frames`.
-            high = max(len(candidate_frames) - self.min_track_length, 1)
-            start = np.random.randint(0, high)
-            candidate_interval = candidate_frames[start:start + self.min_track_length]
+        num_pairs = len(index_array)
+        tracks_1 = np.array(index_array, dtype='int64')
+        types = np.random.randint(0, 3, num_pairs)
+
+        # If class is division but the track does not divide, randomly choose
+        # a different track that is guaranteed to have a division
+        division = types == 2
+        num_daughters = np.diff(self._daughter_offsets)
+        no_daughters = np.flatnonzero(division & (num_daughters[tracks_1] == 0))
+        tracks_1[no_daughters] = self._division_tracks[
+            np.random.randint(0, len(self._division_tracks), len(no_daughters))]
+
+        starts = self._frame_offsets[tracks_1]
+        lengths = self._frame_offsets[tracks_1 + 1] - starts
+
+        # sanity check
+        last_frames = self._track_frames[starts + lengths - 1]
+        bad_divisions = division & (last_frames == self.x.shape[self.time_axis] - 1)
+        if bad_divisions.any():
+            track_id = self.track_ids[tracks_1[np.argmax(bad_divisions)]]
+            logging.warning('Track %s is annotated incorrectly. '
+                            'No parent cell should be in the last frame of'
+                            ' any movie.', track_id)
+            raise Exception('Parent cell should not be in last frame of movie')
+
+        # Divisions use the last frames, other classes exclude the final frame
+        # for comparison purposes. The `max(..., 1)` is because tracks with no
+        # more than `min_track_length` candidate frames use all of them.
+        num_candidates = np.where(division, lengths, lengths - 1)
+        first = np.random.randint(0, np.maximum(num_candidates - self.min_track_length, 1))
+        first[division] = np.maximum(lengths - self.min_track_length, 0)[division]
+        num_frames = np.minimum(num_candidates - first, self.min_track_length)
 
         # if the interval is too small, pad the interval with the oldest frame.
-        if len(candidate_interval) < self.min_track_length:
-            num_padding = self.min_track_length - len(candidate_interval)
-            candidate_interval = [candidate_interval[0]] * num_padding + candidate_interval
-
-        return candidate_interval
-
-    def _compute_appearances(self, track_1, frames_1, track_2, frames_2, transform):
-        appearance_1 = self._fetch_appearances(track_1, frames_1)
-        appearance_2 = self._fetch_appearances(track_2, frames_2)
-
-        # Apply random transforms
-        new_appearance_1 = np.zeros(appearance_1.shape, dtype=K.floatx())
-        new_appearance_2 = np.zeros(appearance_2.shape, dtype=K.floatx())
-
-        for frame in range(appearance_1.shape[self.time_axis - 1]):
-            if self.data_format == 'channels_first':
-                if transform is not None:
-                    app_temp = self.image_data_generator.apply_transform(
-                        appearance_1[:, frame, :, :], transform)
-                else:
-                    app_temp = self.image_data_generator.random_transform(
-                        appearance_1[:, frame, :, :])
-                app_temp = self.image_data_generator.standardize(app_temp)
-                new_appearance_1[:, frame, :, :] = app_temp
-
-            if self.data_format == 'channels_last':
-                if transform is not None:
-                    app_temp = self.image_data_generator.apply_transform(
-                        appearance_1[frame], transform)
-                else:
-                    self.image_data_generator.random_transform(appearance_1[frame])
-                app_temp = self.image_data_generator.standardize(app_temp)
-                new_appearance_1[frame] = app_temp
-
-        if self.data_format == 'channels_first':
-            if transform is not None:
-                app_temp = self.image_data_generator.apply_transform(
-                    appearance_2[:, 0, :, :], transform)
-            else:
-                app_temp = self.image_data_generator.random_transform(
-                    appearance_2[:, 0, :, :])
-            app_temp = self.image_data_generator.standardize(app_temp)
-            new_appearance_2[:, 0, :, :] = app_temp
-
-        if self.data_format == 'channels_last':
-            if transform is not None:
-                app_temp = self.image_data_generator.apply_transform(
-                    appearance_2[0], transform)
-            else:
-                app_temp = self.image_data_generator.random_transform(appearance_2[0])
-            app_temp = self.image_data_generator.standardize(app_temp)
-            new_appearance_2[0] = app_temp
-
-        return new_appearance_1, new_appearance_2
-
-    def _compute_distances(self, track_1, frames_1, track_2, frames_2, transform):
-        centroid_1 = self._fetch_centroids(track_1, frames_1)
-        centroid_2 = self._fetch_centroids(track_2, frames_2)
-
-        # Compute distances between centroids
-        centroids = np.concatenate([centroid_1, centroid_2], axis=0)
-        distance = np.diff(centroids, axis=0)
-        zero_pad = np.zeros((1, 2), dtype=K.floatx())
-        distance = np.concatenate([zero_pad, distance], axis=0)
-
-        # Randomly rotate and expand all the distances
-        # TODO(enricozb): Investigate effect of rotations, it should be invariant
-
-        distance_1 = distance[0:-1, :]
-        distance_2 = distance[-1, :]
-
-        return distance_1, distance_2
-
-    def _compute_regionprops(self, track_1, frames_1, track_2, frames_2, transform):
-        regionprop_1 = self._fetch_regionprops(track_1, frames_1)
-        regionprop_2 = self._fetch_regionprops(track_2, frames_2)
-        return regionprop_1, regionprop_2
-
-    def _compute_neighborhoods(self, track_1, frames_1, track_2, frames_2, transform):
-        track_2, frames_2 = None, None  # To guarantee we don't use these.
-        neighborhood_1 = self._fetch_neighborhoods(track_1, frames_1)
-        neighborhood_2 = self._fetch_future_areas(track_1, [frames_1[-1]])
-
-        neighborhoods = np.concatenate([neighborhood_1, neighborhood_2], axis=0)
-
-        for frame in range(neighborhoods.shape[self.time_axis - 1]):
-            neigh_temp = neighborhoods[frame]
-            if transform is not None:
-                neigh_temp = self.image_data_generator.apply_transform(
-                    neigh_temp, transform)
-            else:
-                neigh_temp = self.image_data_generator.random_transform(neigh_temp)
-            neighborhoods[frame] = neigh_temp
-
-        neighborhood_1 = neighborhoods[0:-1, :, :, :]
-        neighborhood_2 = neighborhoods[-1, :, :, :]
-
-        return neighborhood_1, neighborhood_2
-
-    def _compute_feature_shape(self, feature, index_array):
-        if feature == 'appearance':
-            if self.data_format == 'channels_first':
-                shape_1 = (len(index_array),
-                           self.x.shape[self.channel_axis],
-                           self.min_track_length,
-                           self.crop_dim,
-                           self.crop_dim)
-                shape_2 = (len(index_array),
-                           self.x.shape[self.channel_axis],
-                           self.crop_dim,
-                           self.crop_dim)
-            else:
-                shape_1 = (len(index_array),
-                           self.min_track_length,
-                           self.crop_dim,
-                           self.crop_dim,
-                           self.x.shape[self.channel_axis])
-                shape_2 = (len(index_array),
-                           1,
-                           self.crop_dim,
-                           self.crop_dim,
-                           self.x.shape[self.channel_axis])
-
-        elif feature == 'distance':
-            shape_1 = (len(index_array), self.min_track_length, 2)
-            shape_2 = (len(index_array), 1, 2)
-
-        elif feature == 'neighborhood':
-            shape_1 = (len(index_array),
-                       self.min_track_length,
-                       2 * self.neighborhood_scale_size + 1,
-                       2 * self.neighborhood_scale_size + 1,
-                       1)
-            shape_2 = (len(index_array),
-                       1,
-                       2 * self.neighborhood_scale_size + 1,
-                       2 * self.neighborhood_scale_size + 1,
-                       1)
-        elif feature == 'regionprop':
-            shape_1 = (len(index_array), self.min_track_length, 3)
-            shape_2 = (len(index_array), 1, 3)
-        else:
-            raise ValueError('_compute_feature_shape: '
-                             'Unknown feature `{}`'.format(feature))
-
-        return shape_1, shape_2
-
-    def _compute_feature(self, feature, *args, **kwargs):
-        if feature == 'appearance':
-            return self._compute_appearances(*args, **kwargs)
-        elif feature == 'distance':
-            return self._compute_distances(*args, **kwargs)
-        elif feature == 'neighborhood':
-            return self._compute_neighborhoods(*args, **kwargs)
-        elif feature == 'regionprop':
-            return self._compute_regionprops(*args, **kwargs)
-        else:
-            raise ValueError('_compute_feature: '
-                             'Unknown feature `{}`'.format(feature))
+        steps = np.arange(self.min_track_length) - (self.min_track_length - num_frames[:, None])
+        positions = starts[:, None] + first[:, None] + np.maximum(steps, 0)
+        frames_1 = self._track_frames[positions]
+
+        # For frame_2, choose the next frame cell 1 appears in
+        next_positions = np.minimum(positions[:, -1] + 1, len(self._track_frames) - 1)
+        frames_2 = self._track_frames[next_positions]
+        tracks_2 = tracks_1.copy()
+
+        # If there are no different cells in the subsequent frame,
+        # we must choose the same cell
+        num_different = np.diff(self._different_offsets)[next_positions]
+        types[(types == 0) & (num_different == 0)] = 1
+        different = np.flatnonzero(types == 0)
+        choices = np.random.randint(0, num_different[different])
+        tracks_2[different] = self._different_tracks[
+            self._different_offsets[next_positions[different]] + choices]
+
+        # Compare the parent with the first frame of a random daughter
+        division = np.flatnonzero(division)
+        choices = np.random.randint(0, num_daughters[tracks_1[division]])
+        daughters = self._daughter_tracks[
+            self._daughter_offsets[tracks_1[division]] + choices]
+        tracks_2[division] = daughters
+        frames_2[division] = self._track_frames[self._frame_offsets[daughters]]
+
+        return tracks_1, frames_1, tracks_2, frames_2, types
+
+    def _transform_features(self, features, params, data_format):
+        """Applies the batch transform `params`, or per frame random transforms"""
+        if params is None:
+            return _random_transform_batch(self.image_data_generator, features,
+                                           data_format=data_format)
+        return _apply_transforms(self.image_data_generator, features, params,
+                                 data_format=data_format)
 
     def _get_batches_of_transformed_samples(self, index_array):
-        # Initialize batch_x_1, batch_x_2, and batch_y, and cell distance
         # Compare cells in neighboring frames.
         # Select a sequence of cells/distances for x1 and 1 cell/distance for x2
+        tracks_1, frames_1, tracks_2, frames_2, types = self._sample_pairs(index_array)
+        frames_2 = frames_2[:, np.newaxis]
+        num_frames = self.min_track_length + 1
+
+        if self.sync_transform:
+            # random angle & flips, shared by all frames of a sample
+            gen = self.image_data_generator
+            num_pairs = len(index_array)
+            transform = {
+                'theta': gen.rotation_range * np.random.uniform(-1, 1, num_pairs),
+                'flip_horizontal': np.logical_and(
+                    np.random.random(num_pairs) < 0.5, gen.horizontal_flip),
+                'flip_vertical': np.logical_and(
+                    np.random.random(num_pairs) < 0.5, gen.vertical_flip)
+            }
+            params = _repeat_transform({}, num_pairs * num_frames)
+            for key, value in transform.items():
+                params[key] = np.repeat(value, num_frames)
+        else:
+            params = None
 
-        # setup zeroed batch arrays for each feature & batch_y
-        batch_features = []
+        batch_list = []
         for feature in self.features:
-            shape_1, shape_2 = self._compute_feature_shape(feature, index_array)
-            batch_features.append([np.zeros(shape_1, dtype=K.floatx()),
-                                   np.zeros(shape_2, dtype=K.floatx())])
+            if feature == 'appearance':
+                appearances = np.concatenate([
+                    self._gather_features('appearances', tracks_1, frames_1),
+                    self._gather_features('appearances', tracks_2, frames_2)
+                ], axis=self.time_axis)
+                appearances = self._transform_features(
+                    appearances, params, self.data_format)
+
+                # standardize each frame
+                appearances = np.moveaxis(appearances, self.time_axis, 1)
+                shape = appearances.shape
+                appearances = _standardize_batch(
+                    self.image_data_generator, appearances.reshape((-1,) + shape[2:]))
+                appearances = np.moveaxis(appearances.reshape(shape), 1, self.time_axis)
 
-        batch_y = np.zeros((len(index_array), 3), dtype='int32')
-
-        for i, j in enumerate(index_array):
-            # Identify which tracks are going to be selected
-            track_id = self.track_ids[j]
-            batch = track_id['batch']
-            label_1 = track_id['label']
-
-            # Choose comparison cell
-            # Determine what class the track will be - different (0), same (1), division (2)
-            division = False
-            type_cell = np.random.choice([0, 1, 2], p=[1 / 3, 1 / 3, 1 / 3])
-
-            # Dealing with edge cases
-            # If class is division, check if the first cell divides. If not, change tracks
-            if type_cell == 2:
-                division = True
-                if not track_id['daughters']:
-                    # No divisions so randomly choose a different track that is
-                    # guaranteed to have a division
-                    new_j = np.random.choice(self.tracks_with_divisions)
-                    j = new_j
-                    track_id = self.track_ids[j]
-                    batch = track_id['batch']
-                    label_1 = track_id['label']
-
-            # Get the frames for cell 1 and frames/label for cell 2
-            frames_1 = self._fetch_frames(j, division=division)
-            if len(frames_1) != self.min_track_length:
-                logging.warning('self._fetch_frames(%s, division=%s) returned'
-                                ' %s frames but %s frames were expected.',
-                                j, division, len(frames_1),
-                                self.min_track_length)
-
-            # If the type is not 2 (not division) then the last frame is not
-            # included in `frames_1`, so we grab that to use for comparison
-            if type_cell != 2:
-                # For frame_2, choose the next frame cell 1 appears in
-                last_frame_1 = np.amax(frames_1)
-
-                # logging.warning('last_frame_1: %s', last_frame_1)
-                # logging.warning('track_id_frames: %s', track_id['frames'])
-
-                frame_2 = np.amin([x for x in track_id['frames'] if x > last_frame_1])
-                frames_2 = [frame_2]
-
-                different_cells = track_id['different'][frame_2]
-
-            if type_cell == 0:
-                # If there are no different cells in the subsequent frame, we must choose
-                # the same cell
-                if len(different_cells) == 0:
-                    type_cell = 1
+                if self.data_format == 'channels_first':
+                    feature_1 = appearances[:, :, :-1]
+                    feature_2 = appearances[:, :, -1]
                 else:
-                    label_2 = np.random.choice(different_cells)
-
-            if type_cell == 1:
-                # If there is only 1 cell in frame_2, we can only choose the class to be same
-                label_2 = label_1
-
-            if type_cell == 2:
-                # There should always be 2 daughters but not always a valid label
-                label_2 = np.int(np.random.choice(track_id['daughters']))
-                daughter_track = self.reverse_track_ids[batch][label_2]
-                frame_2 = np.amin(self.track_ids[daughter_track]['frames'])
-                frames_2 = [frame_2]
-
-            track_1 = j
-            track_2 = self.reverse_track_ids[batch][label_2]
-
-            # compute desired features & save them to the batch arrays
-            if self.sync_transform:
-                # random angle & flips
-                flip_h = self.image_data_generator.horizontal_flip
-                flip_v = self.image_data_generator.vertical_flip
-                transform = {
-                    'theta': self.image_data_generator.rotation_range * np.random.uniform(-1, 1),
-                    'flip_horizontal': (np.random.random() < 0.5) if flip_h else False,
-                    'flip_vertical': (np.random.random() < 0.5) if flip_v else False
-                }
+                    feature_1 = appearances[:, :-1]
+                    feature_2 = appearances[:, -1:]
+
+            elif feature == 'distance':
+                centroids = np.concatenate([
+                    self._gather_features('centroids', tracks_1, frames_1),
+                    self._gather_features('centroids', tracks_2, frames_2)
+                ], axis=1)
+
+                # Compute distances between centroids
+                distances = np.diff(centroids, axis=1)
+                zero_pad = np.zeros((len(distances), 1, 2), dtype=K.floatx())
+                distances = np.concatenate([zero_pad, distances], axis=1)
+
+                # TODO(enricozb): Investigate effect of rotations, it should be invariant
+                feature_1 = distances[:, :-1]
+                feature_2 = distances[:, -1:]
+
+            elif feature == 'neighborhood':
+                # neighborhoods are always channels_last
+                neighborhoods = np.concatenate([
+                    self._gather_features('neighborhoods', tracks_1, frames_1),
+                    self._gather_features('future_areas', tracks_1, frames_1[:, -1:])
+                ], axis=1)
+                neighborhoods = self._transform_features(
+                    neighborhoods, params, 'channels_last')
+
+                feature_1 = neighborhoods[:, :-1]
+                feature_2 = neighborhoods[:, -1:]
+
+            elif feature == 'regionprop':
+                feature_1 = self._gather_features('regionprops', tracks_1, frames_1)
+                feature_2 = self._gather_features('regionprops', tracks_2, frames_2)
 
             else:
-                transform = None
+                raise ValueError('_get_batches_of_transformed_samples: '
+                                 'Unknown feature `{}`'.format(feature))
 
-            for feature_i, feature in enumerate(self.features):
-                feature_1, feature_2 = self._compute_feature(
-                    feature, track_1, frames_1, track_2, frames_2, transform=transform)
+            batch_feature_1 = np.asarray(feature_1, dtype=K.floatx())
+            batch_feature_2 = np.asarray(feature_2, dtype=K.floatx())
 
-                batch_features[feature_i][0][i] = feature_1
-                batch_features[feature_i][1][i] = feature_2
-
-            batch_y[i, type_cell] = 1
-
-        # prepare final batch list
-        batch_list = []
-        for feature_i, feature in enumerate(self.features):
-            batch_feature_1, batch_feature_2 = batch_features[feature_i]
             # Remove singleton dimensions (if min_track_length is 1)
             if self.min_track_length < 2:
                 axis = self.time_axis if feature == 'appearance' else 1
@@ -2324,6 +3099,8 @@ class SiameseIterator(Iterator):
             batch_list.append(batch_feature_1)
             batch_list.append(batch_feature_2)
 
+        batch_y = np.eye(3, dtype='int32')[types]
+
         return batch_list, batch_y
 
     def next(self):
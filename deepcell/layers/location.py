@@ -40,7 +40,12 @@ except ImportError:
 
 
 class Location2D(Layer):
-    def __init__(self, in_shape, data_format=None, **kwargs):
+    """Location layer for 2D data.
+    The spatial dimensions are read from the inputs at runtime,
+    so `in_shape` may contain `None` dimensions.
+    """
+
+    def __init__(self, in_shape=None, data_format=None, **kwargs):
         super(Location2D, self).__init__(**kwargs)
         self.in_shape = in_shape
         self.data_format = conv_utils.normalize_data_format(data_format)
@@ -54,13 +59,13 @@ class Location2D(Layer):
         return tensor_shape.TensorShape(output_shape)
 
     def call(self, inputs):
-        input_shape = self.in_shape
+        input_shape = K.shape(inputs)
         if self.data_format == 'channels_first':
+            x = K.arange(0, input_shape[2], dtype=K.floatx())
+            y = K.arange(0, input_shape[3], dtype=K.floatx())
+        else:
             x = K.arange(0, input_shape[1], dtype=K.floatx())
             y = K.arange(0, input_shape[2], dtype=K.floatx())
-        else:
-            x = K.arange(0, input_shape[0], dtype=K.floatx())
-            y = K.arange(0, input_shape[1], dtype=K.floatx())
 
         x = x / K.max(x)
         y = y / K.max(y)
@@ -93,7 +98,12 @@ class Location2D(Layer):
 
 
 class Location3D(Layer):
-    def __init__(self, in_shape, data_format=None, **kwargs):
+    """Location layer for 3D data.
+    The spatial dimensions are read from the inputs at runtime,
+    so `in_shape` may contain `None` dimensions.
+    """
+
+    def __init__(self, in_shape=None, data_format=None, **kwargs):
         super(Location3D, self).__init__(**kwargs)
         self.in_shape = in_shape
         self.data_format = conv_utils.normalize_data_format(data_format)
@@ -109,16 +119,16 @@ class Location3D(Layer):
         return tensor_shape.TensorShape(output_shape)
 
     def call(self, inputs):
-        input_shape = self.in_shape
+        input_shape = K.shape(inputs)
 
         if self.data_format == 'channels_first':
+            z = K.arange(0, input_shape[2], dtype=K.floatx())
+            x = K.arange(0, input_shape[3], dtype=K.floatx())
+            y = K.arange(0, input_shape[4], dtype=K.floatx())
+        else:
             z = K.arange(0, input_shape[1], dtype=K.floatx())
             x = K.arange(0, input_shape[2], dtype=K.floatx())
             y = K.arange(0, input_shape[3], dtype=K.floatx())
-        else:
-            z = K.arange(0, input_shape[0], dtype=K.floatx())
-            x = K.arange(0, input_shape[1], dtype=K.floatx())
-            y = K.arange(0, input_shape[2], dtype=K.floatx())
 
         x = x / K.max(x)
         y = y / K.max(y)
@@ -145,6 +145,9 @@ def bn_feature_net_2D(receptive_field=61,
             output_shape = x[l].get_shape().as_list()
             target_shape = x[-1].get_shape().as_list()
 
+            if None in output_shape[1:] or None in target_shape[1:]:
+                raise ValueError('`multires` requires a fully defined `input_shape`.')
+
             row_crop = int(output_shape[row_axis] - target_shape[row_axis])
             if row_crop % 2 == 0:
                 row_crop = (row_crop // 2, row_crop // 2)
@@ -351,6 +354,9 @@ def bn_feature_net_3D(receptive_field=61,
             target_shape = x[-1].get_shape().as_list()
             time_crop = (0, 0)
 
+            if None in output_shape[1:] or None in target_shape[1:]:
+                raise ValueError('`multires` requires a fully defined `input_shape`.')
+
             row_crop = int(output_shape[row_axis] - target_shape[row_axis])
 
             if row_crop % 2 == 0:
@@ -463,6 +469,47 @@ def bn_feature_net_81x81_3D(**kwargs):
     return bn_feature_net_3D(receptive_field=81, **kwargs)
 
 
+"""
+Dynamic shape models
+"""
+
+
+def copy_weights(source_model, target_model):
+    """Copy the weights of a trained model into a model of the same
+    architecture built with a different input_shape.
+
+    Dilated feature nets are fully convolutional, so they can be built with
+    `None` spatial dimensions (e.g. `input_shape=(None, None, 1)`) and
+    given the weights of a model trained on a fixed input_shape.
+    The new model can then process images of any size.
+
+    Args:
+        source_model: model with the trained weights
+        target_model: model of the same architecture to copy weights into
+
+    Returns:
+        target_model with the weights of source_model
+
+    Raises:
+        ValueError: the weights of the two models do not match
+    """
+    source_weights = source_model.get_weights()
+    target_weights = target_model.get_weights()
+
+    if len(source_weights) != len(target_weights):
+        raise ValueError('Expected models with the same number of weights. '
+                         'Got {} and {}'.format(len(source_weights),
+                                                len(target_weights)))
+
+    for source, target in zip(source_weights, target_weights):
+        if source.shape != target.shape:
+            raise ValueError('Expected models with the same weight shapes. '
+                             'Got {} and {}'.format(source.shape, target.shape))
+
+    target_model.set_weights(source_weights)
+    return target_model
+
+
 """
 Tracking Model
 """
@@ -0,0 +1,302 @@
+# Copyright 2016-2019 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/deepcell-tf/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Functions for converting model outputs into instance label masks"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import ctypes
+import multiprocessing
+
+import numpy as np
+from skimage.feature import peak_local_max
+from skimage.measure import label
+from skimage.morphology import remove_small_objects
+try:  # skimage v0.15 moves watershed to skimage.segmentation
+    from skimage.segmentation import watershed
+except ImportError:
+    from skimage.morphology import watershed
+from tensorflow.python.keras import backend as K
+
+
+"""
+Per-frame label functions
+"""
+
+
+def deepcell_frame_to_labels(frame, threshold=0.5, min_size=0):
+    """Convert a single `deepcell` transform prediction into instance labels.
+    Connected components of the thresholded interior channel are used as
+    seeds and grown with a watershed into the rest of the foreground.
+    Works for both 2D and 3D frames.
+
+    Args:
+        frame: channels_last prediction of a `deepcell` transform model,
+            with channels [background_edge, interior_edge, interior, background]
+        threshold: probability cutoff for the interior channel
+        min_size: objects smaller than this many pixels are removed
+
+    Returns:
+        numpy.array: int32 label image with the spatial shape of frame
+    """
+    interior = frame[..., 2]
+    foreground = np.argmax(frame, axis=-1) != frame.shape[-1] - 1
+    markers = label(interior > threshold)
+    if min_size:
+        markers = remove_small_objects(markers, min_size=min_size)
+    labels = watershed(-interior, markers, mask=np.logical_or(foreground, markers > 0))
+    return labels.astype('int32')
+
+
+def watershed_frame_to_labels(frame, min_distance=10, threshold=None, min_size=0):
+    """Convert a single `watershed` transform prediction into instance labels.
+    Peaks of the highest distance bin seed a watershed on the expected
+    distance, restricted to pixels predicted to be foreground.
+    Works for both 2D and 3D frames.
+
+    Args:
+        frame: channels_last prediction of a `watershed` transform model,
+            with one channel per distance bin (the last bin is cell centers)
+        min_distance: minimum number of pixels separating two seeds.
+            If None, each connected region of the last bin is one seed.
+        threshold: minimum probability of the last distance bin for a seed.
+            Defaults to requiring the last bin to be the most likely bin.
+        min_size: objects smaller than this many pixels are removed
+
+    Returns:
+        numpy.array: int32 label image with the spatial shape of frame
+    """
+    bins = np.arange(frame.shape[-1], dtype=frame.dtype)
+    distance = np.dot(frame, bins) / np.maximum(frame.sum(axis=-1), 1e-7)
+    class_map = np.argmax(frame, axis=-1)
+    foreground = class_map > 0
+
+    centers = frame[..., -1]
+    if threshold is None:
+        seed_mask = class_map == frame.shape[-1] - 1
+    else:
+        seed_mask = centers > threshold
+
+    if min_distance is None:
+        markers = label(seed_mask)
+    else:
+        # `indices=False` is not available in all versions of skimage,
+        # so build the marker image from the peak coordinates instead.
+        coords = peak_local_max(centers, min_distance=min_distance,
+                                exclude_border=False,
+                                labels=seed_mask.astype('int32'))
+        peaks = np.zeros(centers.shape, dtype='bool')
+        peaks[tuple(np.transpose(coords))] = True
+        markers = label(peaks)
+    labels = watershed(-distance, markers, mask=foreground)
+    if min_size:
+        labels = remove_small_objects(labels, min_size=min_size)
+    return labels.astype('int32')
+
+
+"""
+Parallel batch processing
+"""
+
+_SHARED_ARRAYS = {}
+
+
+def _init_shared_arrays(inputs, input_shape, outputs, output_shape):
+    """Pool initializer that wraps the shared buffers as numpy arrays"""
+    _SHARED_ARRAYS['inputs'] = np.frombuffer(
+        inputs, dtype='float32').reshape(input_shape)
+    _SHARED_ARRAYS['outputs'] = np.frombuffer(
+        outputs, dtype='int32').reshape(output_shape)
+
+
+def _label_shared_frame(args):
+    """Label frame `i` of the shared inputs into the shared outputs"""
+    i, label_fn, kwargs = args
+    frame = _SHARED_ARRAYS['inputs'][i]
+    _SHARED_ARRAYS['outputs'][i] = label_fn(frame, **kwargs)
+
+
+def _label_frames(frames, label_fn, num_workers=None, **kwargs):
+    """Apply `label_fn` to every frame along the first axis of `frames`.
+    The frames are copied once into shared memory so the worker processes
+    can read them and write their labels without pickling any arrays.
+
+    Args:
+        frames: channels_last array of shape (frames, ..., channels)
+        label_fn: module level function that labels a single frame
+        num_workers: number of worker processes, defaults to the CPU count.
+            Values of 1 or less label the frames in the calling process.
+        kwargs: passed to `label_fn`
+
+    Returns:
+        numpy.array: int32 labels of shape frames.shape[:-1]
+    """
+    output_shape = frames.shape[:-1]
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    num_workers = min(num_workers, frames.shape[0])
+
+    if num_workers <= 1:
+        labels = np.zeros(output_shape, dtype='int32')
+        for i, frame in enumerate(frames):
+            labels[i] = label_fn(frame, **kwargs)
+        return labels
+
+    shared_inputs = multiprocessing.RawArray(ctypes.c_float, int(frames.size))
+    shared_outputs = multiprocessing.RawArray(ctypes.c_int32, int(np.prod(output_shape)))
+    inputs = np.frombuffer(shared_inputs, dtype='float32').reshape(frames.shape)
+    inputs[:] = frames
+
+    pool = multiprocessing.Pool(
+        num_workers,
+        initializer=_init_shared_arrays,
+        initargs=(shared_inputs, frames.shape, shared_outputs, output_shape))
+    try:
+        pool.map(_label_shared_frame,
+                 [(i, label_fn, kwargs) for i in range(frames.shape[0])])
+    finally:
+        pool.close()
+        pool.join()
+
+    return np.frombuffer(shared_outputs, dtype='int32').reshape(output_shape)
+
+
+def _label_batch(outputs, label_fn, ndim, data_format=None, num_workers=None, **kwargs):
+    """Validate the batch of model outputs and label each frame in parallel"""
+    outputs = np.asarray(outputs)
+    if outputs.ndim != ndim:
+        raise ValueError('Expected model outputs with {} dimensions, got '
+                         'shape {}'.format(ndim, outputs.shape))
+
+    if data_format is None:
+        data_format = K.image_data_format()
+    if data_format == 'channels_first':
+        outputs = np.moveaxis(outputs, 1, -1)
+
+    labels = _label_frames(outputs, label_fn, num_workers=num_workers, **kwargs)
+
+    channel_axis = 1 if data_format == 'channels_first' else -1
+    return np.expand_dims(labels, axis=channel_axis)
+
+
+"""
+Batch label functions
+"""
+
+
+def deepcell_to_labels_2d(outputs, threshold=0.5, min_size=0,
+                          data_format=None, num_workers=None):
+    """Convert a batch of 2D `deepcell` transform predictions into labels.
+
+    Args:
+        outputs: model output of shape (batch, x, y, 4), channels_last
+        threshold: probability cutoff for the interior channel
+        min_size: objects smaller than this many pixels are removed
+        data_format: 'channels_first' or 'channels_last'
+        num_workers: number of processes used to label the frames
+
+    Returns:
+        numpy.array: int32 label images with a single channel
+
+    Raises:
+        ValueError: outputs is not a 4D array
+    """
+    return _label_batch(outputs, deepcell_frame_to_labels, 4,
+                        data_format=data_format, num_workers=num_workers,
+                        threshold=threshold, min_size=min_size)
+
+
+def deepcell_to_labels_3d(outputs, threshold=0.5, min_size=0,
+                          data_format=None, num_workers=None):
+    """Convert a batch of 3D `deepcell` transform predictions into labels.
+    Each volume is labeled as a whole, so objects span the first spatial axis.
+
+    Args:
+        outputs: model output of shape (batch, z, x, y, 4), channels_last
+        threshold: probability cutoff for the interior channel
+        min_size: objects smaller than this many pixels are removed
+        data_format: 'channels_first' or 'channels_last'
+        num_workers: number of processes used to label the volumes
+
+    Returns:
+        numpy.array: int32 label volumes with a single channel
+
+    Raises:
+        ValueError: outputs is not a 5D array
+    """
+    return _label_batch(outputs, deepcell_frame_to_labels, 5,
+                        data_format=data_format, num_workers=num_workers,
+                        threshold=threshold, min_size=min_size)
+
+
+def watershed_to_labels_2d(outputs, min_distance=10, threshold=None, min_size=0,
+                           data_format=None, num_workers=None):
+    """Convert a batch of 2D `watershed` transform predictions into labels.
+
+    Args:
+        outputs: model output of shape (batch, x, y, distance_bins)
+        min_distance: minimum number of pixels separating two seeds
+        threshold: minimum probability of the last distance bin for a seed
+        min_size: objects smaller than this many pixels are removed
+        data_format: 'channels_first' or 'channels_last'
+        num_workers: number of processes used to label the frames
+
+    Returns:
+        numpy.array: int32 label images with a single channel
+
+    Raises:
+        ValueError: outputs is not a 4D array
+    """
+    return _label_batch(outputs, watershed_frame_to_labels, 4,
+                        data_format=data_format, num_workers=num_workers,
+                        min_distance=min_distance, threshold=threshold,
+                        min_size=min_size)
+
+
+def watershed_to_labels_3d(outputs, min_distance=10, threshold=None, min_size=0,
+                           data_format=None, num_workers=None):
+    """Convert a batch of 3D `watershed` transform predictions into labels.
+    Each volume is labeled as a whole, so objects span the first spatial axis.
+
+    Args:
+        outputs: model output of shape (batch, z, x, y, distance_bins)
+        min_distance: minimum number of pixels separating two seeds
+        threshold: minimum probability of the last distance bin for a seed
+        min_size: objects smaller than this many pixels are removed
+        data_format: 'channels_first' or 'channels_last'
+        num_workers: number of processes used to label the volumes
+
+    Returns:
+        numpy.array: int32 label volumes with a single channel
+
+    Raises:
+        ValueError: outputs is not a 5D array
+    """
+    return _label_batch(outputs, watershed_frame_to_labels, 5,
+                        data_format=data_format, num_workers=num_workers,
+                        min_distance=min_distance, threshold=threshold,
+                        min_size=min_size)
@@ -29,16 +29,332 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import division
 
+import contextlib
+import hashlib
+import json
+import multiprocessing
 import os
+import queue
+import socket
+import threading
+import time
+import timeit
 import warnings
+import weakref
+from collections import deque
+from collections import OrderedDict
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
+import tensorflow as tf
 from skimage.external import tifffile as tiff
 from tensorflow.python.keras import backend as K
 from tensorflow.python.keras.models import Model
 
 from deepcell.utils.data_utils import trim_padding
 from deepcell.utils.io_utils import get_images_from_directory
+from deepcell.utils.io_utils import get_image_paths_from_directory
+from deepcell.utils.io_utils import get_multichannel_image
+from deepcell.utils.transform_utils import get_dihedral_transforms
+
+
+class _CachedModel(object):
+    """A model built in its own graph and session"""
+
+    def __init__(self, model, graph, session):
+        self.model = model
+        self.graph = graph
+        self.session = session
+        self.users = 0
+        self.evicted = False
+
+
+class ModelCache(object):
+    """Least recently used cache of built models.
+
+    Models are keyed by their builder function, input_shape, keyword
+    arguments and weights file, so repeated requests for the same model skip
+    building a new graph and loading its weights.  Each model is built in
+    its own graph and session, which are closed when the model is evicted,
+    so the cache bounds the memory held by the models.
+
+    `get` returns a context manager that makes the graph and session of the
+    model the defaults, and the model can only be used inside it.  A model
+    is shared by every caller with the same arguments and is not evicted
+    while in use.  Callers that set the weights of a model built without
+    `weights_path` see each other's changes.
+
+    Arguments:
+        max_size: maximum number of models to keep in the cache
+    """
+
+    def __init__(self, max_size=4):
+        if max_size < 1:
+            raise ValueError('Expected `max_size` to be a positive integer. '
+                             'Got ', max_size)
+        self.max_size = max_size
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._models)
+
+    def _get_key(self, model_fn, input_shape, weights_path, kwargs):
+        # kwargs may hold unhashable values, so key on their representation
+        kwargs_key = tuple(sorted((k, repr(v)) for k, v in kwargs.items()))
+        # reload the weights if the file is overwritten
+        if weights_path is not None:
+            weights_path = (os.path.abspath(weights_path),
+                            os.path.getmtime(weights_path))
+        return (model_fn, tuple(input_shape), kwargs_key, weights_path)
+
+    def _build(self, model_fn, input_shape, weights_path, kwargs):
+        graph = tf.Graph()
+        with graph.as_default():
+            session = tf.Session(graph=graph)
+            with session.as_default():
+                model = model_fn(input_shape=input_shape, **kwargs)
+                if weights_path is not None:
+                    model.load_weights(weights_path)
+        return _CachedModel(model, graph, session)
+
+    def _evict(self):
+        """Close the least recently used models that are not in use"""
+        for key, entry in list(self._models.items()):
+            if len(self._models) <= self.max_size:
+                break
+            if entry.users == 0:
+                del self._models[key]
+                entry.evicted = True
+                entry.session.close()
+
+    @contextlib.contextmanager
+    def get(self, model_fn, input_shape, weights_path=None, **kwargs):
+        """Get a built model, building it only if it is not cached.
+
+        Args:
+            model_fn: function that builds the model
+            input_shape: input_shape passed to model_fn
+            weights_path: if given, these weights are loaded into the model
+            **kwargs: other keyword arguments passed to model_fn
+
+        Yields:
+            the cached Keras model, with its graph and session as defaults
+        """
+        key = self._get_key(model_fn, input_shape, weights_path, kwargs)
+        with self._lock:
+            entry = self._models.pop(key, None)
+            if entry is None:
+                entry = self._build(model_fn, input_shape, weights_path, kwargs)
+            self._models[key] = entry  # most recently used is last
+            entry.users += 1
+            self._evict()
+
+        try:
+            with entry.graph.as_default(), entry.session.as_default():
+                yield entry.model
+        finally:
+            with self._lock:
+                entry.users -= 1
+                if entry.evicted and entry.users == 0:
+                    entry.session.close()
+                self._evict()
+
+    def clear(self):
+        """Remove all models from the cache, closing their sessions
+        once they are no longer in use"""
+        with self._lock:
+            for entry in self._models.values():
+                entry.evicted = True
+                if entry.users == 0:
+                    entry.session.close()
+            self._models.clear()
+
+
+_MODEL_CACHE = ModelCache()
+
+
+def get_model(model_fn, input_shape, weights_path=None, **kwargs):
+    """Get a model from the process-wide `ModelCache`.
+
+    Args:
+        model_fn: function that builds the model
+        input_shape: input_shape passed to model_fn
+        weights_path: if given, these weights are loaded into the model
+        **kwargs: other keyword arguments passed to model_fn
+
+    Returns:
+        context manager yielding the cached Keras model,
+        see `ModelCache.get`
+    """
+    return _MODEL_CACHE.get(model_fn, input_shape, weights_path, **kwargs)
+
+
+class PredictionService(object):
+    """Merge concurrent prediction requests into batched model.predict calls.
+
+    Requests submitted from any thread are queued, and a background thread
+    groups them into batches of up to `max_batch_size` samples, waiting at
+    most `max_latency` seconds for a batch to fill.  Each batch is predicted
+    with a single call to model.predict, and each request receives its
+    slice of the outputs through a `concurrent.futures.Future`.
+
+    `predict` blocks until the result is ready, and all other attributes are
+    read from the wrapped model, so the service can be used in place of the
+    model (e.g. by `process_whole_image` or `cell_tracker`).
+
+    Arguments:
+        model: model with a predict method, may have multiple inputs and outputs
+        max_batch_size: maximum number of samples to merge into one batch
+        max_latency: maximum seconds to wait for more requests to a batch
+    """
+
+    _STOP = object()
+
+    def __init__(self, model, max_batch_size=32, max_latency=0.005):
+        if max_batch_size < 1:
+            raise ValueError('Expected `max_batch_size` to be a positive integer. '
+                             'Got ', max_batch_size)
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+
+        # build the predict function before it is called from another thread
+        if hasattr(model, '_make_predict_function'):
+            model._make_predict_function()
+        self._graph = tf.get_default_graph()
+        self._session = K.get_session()
+
+        self._queue = queue.Queue()
+        self._closed = False
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def submit(self, inputs):
+        """Queue inputs to be predicted.
+
+        Args:
+            inputs: numpy array, or list of numpy arrays for multiple inputs
+
+        Returns:
+            Future that resolves to the model outputs for the inputs
+
+        Raises:
+            RuntimeError: the service is closed
+        """
+        future = Future()
+        is_list = isinstance(inputs, (list, tuple))
+        inputs = list(inputs) if is_list else [inputs]
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('Cannot submit requests to a closed '
+                                   'PredictionService.')
+            self._queue.put((inputs, is_list, future))
+        return future
+
+    def predict(self, inputs, batch_size=None):
+        """Predict the inputs, blocking until the outputs are ready.
+        `batch_size` is ignored, batches are merged by the service.
+        """
+        return self.submit(inputs).result()
+
+    def close(self):
+        """Finish the queued requests and stop the background thread"""
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                self._queue.put(self._STOP)
+        self._thread.join()
+
+    def _run(self):
+        # a request that did not fit in the previous batch
+        pending = None
+        batch = []
+        try:
+            with self._graph.as_default(), self._session.as_default():
+                while True:
+                    request = self._queue.get() if pending is None else pending
+                    pending = None
+                    if request is self._STOP:
+                        break
+
+                    batch = [request]
+                    n_samples = len(request[0][0])
+                    deadline = time.time() + self.max_latency
+
+                    while n_samples < self.max_batch_size:
+                        timeout = deadline - time.time()
+                        if timeout <= 0:
+                            break
+                        try:
+                            request = self._queue.get(timeout=timeout)
+                        except queue.Empty:
+                            break
+                        size = 0 if request is self._STOP else len(request[0][0])
+                        if request is self._STOP or n_samples + size > self.max_batch_size:
+                            pending = request
+                            break
+                        batch.append(request)
+                        n_samples += size
+
+                    self._predict_batch(batch)
+        finally:
+            # fail the requests left if the thread stops unexpectedly
+            with self._lock:
+                self._closed = True
+            for request in batch + [pending]:
+                if request is not None and request is not self._STOP:
+                    self._fail_request(request)
+            while True:
+                try:
+                    request = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if request is not self._STOP:
+                    self._fail_request(request)
+
+    def _fail_request(self, request):
+        future = request[2]
+        if not future.done():
+            future.set_exception(RuntimeError(
+                'The PredictionService stopped before the request was '
+                'predicted.'))
+
+    def _predict_batch(self, batch):
+        try:
+            n_inputs = len(batch[0][0])
+            inputs = [np.concatenate([r[0][i] for r in batch], axis=0)
+                      for i in range(n_inputs)]
+            is_list = batch[0][1]
+            outputs = self.model.predict(inputs if is_list else inputs[0],
+                                         batch_size=len(inputs[0]))
+
+            # split the outputs back into each request
+            splits = np.cumsum([len(r[0][0]) for r in batch])[:-1]
+            if isinstance(outputs, list):
+                outputs = [np.split(o, splits, axis=0) for o in outputs]
+                results = [list(o) for o in zip(*outputs)]
+            else:
+                results = np.split(outputs, splits, axis=0)
+
+            for (_, _, future), result in zip(batch, results):
+                future.set_result(result)
+        except Exception as err:  # pylint: disable=broad-except
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(err)
 
 
 def get_cropped_input_shape(images, num_crops=4, receptive_field=61, data_format=None):
@@ -98,16 +414,116 @@ def get_padding_layers(model):
     return padding_layers
 
 
-def process_whole_image(model, images, num_crops=4, receptive_field=61, padding=None):
+def predict_with_augmentation(model, images, batch_size=None):
+    """Predict the images using test-time augmentation.
+    The 8 dihedral transforms (rotations and flips) of the images are
+    predicted in a single batch, and the inverse transformed predictions
+    are averaged.  Non-square images only use the 4 transforms which
+    preserve their shape.
+
+    Args:
+        model: model that will process the images, the output of the
+            model must have the same spatial shape as its input
+        images: numpy array of ndim 4 or 5 to process
+        batch_size: batch_size passed to model.predict
+
+    Returns:
+        numpy array of the averaged model outputs
+    """
+    is_channels_first = K.image_data_format() == 'channels_first'
+
+    # the transforms act on the last two axes, so move the channels out of
+    # the way.  Like the transforms themselves, np.moveaxis returns a view.
+    if not is_channels_first:
+        images = np.moveaxis(images, -1, 1)
+
+    is_square = images.shape[-1] == images.shape[-2]
+    transforms = get_dihedral_transforms(include_transpose=is_square)
+
+    variants = [transform(images) for transform, _ in transforms]
+    if not is_channels_first:
+        variants = [np.moveaxis(v, 1, -1) for v in variants]
+
+    predicted = model.predict(np.concatenate(variants, axis=0), batch_size=batch_size)
+
+    # if using skip_connections, get the final model output
+    if isinstance(predicted, list):
+        predicted = predicted[-1]
+
+    output = None
+    predicted = np.split(predicted, len(transforms), axis=0)
+    for (_, inverse), variant_prediction in zip(transforms, predicted):
+        if not is_channels_first:
+            variant_prediction = np.moveaxis(variant_prediction, -1, 1)
+        variant_prediction = inverse(variant_prediction)
+        if output is None:
+            output = variant_prediction.astype(K.floatx())
+        else:
+            output += variant_prediction
+
+    output /= len(transforms)
+
+    if not is_channels_first:
+        output = np.moveaxis(output, 1, -1)
+    return output
+
+
+def _create_output_array(shape, dtype=None, output=None, output_path=None):
+    """Get the array that model outputs will be written into.
+
+    Args:
+        shape: shape of the output array
+        dtype: dtype of the output array, defaults to K.floatx()
+        output: optional existing array (e.g. a np.memmap) to write into
+        output_path: if given, create a np.memmap at this path
+
+    Returns:
+        numpy array or np.memmap with the given shape
+
+    Raises:
+        ValueError: output does not have the given shape
+    """
+    if output is not None:
+        if tuple(output.shape) != tuple(shape):
+            raise ValueError('Expected `output` to have shape {}. Got {}'.format(
+                tuple(shape), output.shape))
+        return output
+
+    if dtype is None:
+        dtype = K.floatx()
+
+    if output_path is not None:
+        return np.memmap(output_path, dtype=dtype, mode='w+', shape=tuple(shape))
+    return np.zeros(shape, dtype=dtype)
+
+
+def process_whole_image(model, images, num_crops='auto', receptive_field=61, padding=None,
+                        tiles_per_batch='auto', batch_size=None, output=None,
+                        output_path=None, dtype=None, augment=False):
     """Slice images into num_crops * num_crops pieces, and use the model to
     process each small image.
 
     Args:
         model: model that will process each small image
         images: numpy array that is too big for model.predict(images)
-        num_crops: number of slices for the x and y axis to create sub-images
+        num_crops: number of slices for the x and y axis to create sub-images.
+            If 'auto', the value saved by `autotune_tiling` for this model,
+            image shape and host is used, otherwise 4.
         receptive_field: receptive field used by model, required to pad images
         padding: type of padding for input images, one of {'reflect', 'zero'}
+        tiles_per_batch: number of crops stacked into a single call to
+            model.predict. If None, all crops are predicted in one call.
+            If 'auto', the saved value is used if it was tuned for
+            `num_crops`, otherwise 1.
+        batch_size: batch_size passed to model.predict, defaults to the
+            model.predict default.
+        output: optional array (e.g. a np.memmap) to write the model
+            outputs into, must have the shape of the model output.
+        output_path: if given, the model outputs are written into a
+            np.memmap created at this path.
+        dtype: dtype of the created output array, defaults to K.floatx()
+        augment: whether to average the predictions of the rotated and
+            flipped crops, see `predict_with_augmentation`.
 
     Returns:
         model_output: numpy array containing model outputs for each sub-image
@@ -130,6 +546,20 @@ def process_whole_image(model, images, num_crops=4, receptive_field=61, padding=
         raise ValueError('Expected `padding_mode` to be either `zero` or '
                          '`reflect`.  Got ', padding)
 
+    if num_crops == 'auto' or tiles_per_batch == 'auto':
+        config = load_tiling_config(model, images.shape)
+        if num_crops == 'auto':
+            num_crops = 4 if config is None else config['num_crops']
+        if tiles_per_batch == 'auto':
+            if config is not None and config['num_crops'] == num_crops:
+                tiles_per_batch = config['tiles_per_batch']
+            else:
+                tiles_per_batch = 1
+
+    if tiles_per_batch is not None and tiles_per_batch < 1:
+        raise ValueError('Expected `tiles_per_batch` to be a positive integer '
+                         'or None.  Got ', tiles_per_batch)
+
     # Split the frames into quarters, as the full image size is too large
     crop_x = images.shape[row_axis] // num_crops
     crop_y = images.shape[col_axis] // num_crops
@@ -140,12 +570,17 @@ def process_whole_image(model, images, num_crops=4, receptive_field=61, padding=
     # instantiate matrix for model output
     model_output_shape = tuple(list(model.layers[-1].output_shape)[1:])
     if channel_axis == 1:
-        output = np.zeros((images.shape[0], model_output_shape[1], *images.shape[2:]))
+        output_shape = (images.shape[0], model_output_shape[1], *images.shape[2:])
     else:
-        output = np.zeros((*images.shape[0:-1], model_output_shape[-1]))
+        output_shape = (*images.shape[0:-1], model_output_shape[-1])
+    output = _create_output_array(output_shape, dtype, output, output_path)
 
+    # models with dynamic (None) dimensions can process any input shape
     expected_input_shape = get_cropped_input_shape(images, num_crops, receptive_field)
-    if expected_input_shape != model.input_shape[1:]:
+    model_input_shape = model.input_shape[1:]
+    if len(model_input_shape) != len(expected_input_shape) or any(
+            m is not None and m != e
+            for m, e in zip(model_input_shape, expected_input_shape)):
         raise ValueError('Expected model.input_shape to be {}. Got {}.  Use '
                          '`get_cropped_input_shape()` to recreate your model '
                          ' with the proper input_shape'.format(
@@ -166,48 +601,703 @@ def process_whole_image(model, images, num_crops=4, receptive_field=61, padding=
     else:
         padded_images = np.pad(images, pad_width, mode='constant', constant_values=0)
 
-    for i in range(num_crops):
-        for j in range(num_crops):
+    def crop_slice(row_slice, col_slice):
+        # index all axes, replacing only the row and column axes
+        slices = [slice(None)] * images.ndim
+        slices[row_axis] = row_slice
+        slices[col_axis] = col_slice
+        return tuple(slices)
+
+    crops = [(i, j) for i in range(num_crops) for j in range(num_crops)]
+    if tiles_per_batch is None:
+        tiles_per_batch = len(crops)
+
+    for start in range(0, len(crops), tiles_per_batch):
+        batch_crops = crops[start:start + tiles_per_batch]
+
+        # stack the padded crops along the batch axis
+        tiles = []
+        for i, j in batch_crops:
             e, f = i * crop_x, (i + 1) * crop_x + 2 * win_x
             g, h = j * crop_y, (j + 1) * crop_y + 2 * win_y
+            tiles.append(padded_images[crop_slice(slice(e, f), slice(g, h))])
 
-            if images.ndim == 5:
-                if channel_axis == 1:
-                    predicted = model.predict(padded_images[:, :, :, e:f, g:h])
-                else:
-                    predicted = model.predict(padded_images[:, :, e:f, g:h, :])
-            else:
-                if channel_axis == 1:
-                    predicted = model.predict(padded_images[:, :, e:f, g:h])
-                else:
-                    predicted = model.predict(padded_images[:, e:f, g:h, :])
+        tiles = np.concatenate(tiles, axis=0)
+        if augment:
+            predicted = predict_with_augmentation(model, tiles, batch_size=batch_size)
+        else:
+            predicted = model.predict(tiles, batch_size=batch_size)
 
-            # if using skip_connections, get the final model output
-            if isinstance(predicted, list):
-                predicted = predicted[-1]
+        # if using skip_connections, get the final model output
+        if isinstance(predicted, list):
+            predicted = predicted[-1]
 
-            # if the model uses padding, trim the output images to proper shape
-            # if model does not use padding, images should already be correct
-            if padding:
-                predicted = trim_padding(predicted, win_x, win_y)
+        # if the model uses padding, trim the output images to proper shape
+        # if model does not use padding, images should already be correct
+        if padding:
+            predicted = trim_padding(predicted, win_x, win_y)
 
+        # scatter each crop's predictions back into the output
+        predicted = np.split(predicted, len(batch_crops), axis=0)
+        for (i, j), crop_prediction in zip(batch_crops, predicted):
             a, b = i * crop_x, (i + 1) * crop_x
             c, d = j * crop_y, (j + 1) * crop_y
-
-            if images.ndim == 5:
-                if channel_axis == 1:
-                    output[:, :, :, a:b, c:d] = predicted
-                else:
-                    output[:, :, a:b, c:d, :] = predicted
-            else:
-                if channel_axis == 1:
-                    output[:, :, a:b, c:d] = predicted
-                else:
-                    output[:, a:b, c:d, :] = predicted
+            output[crop_slice(slice(a, b), slice(c, d))] = crop_prediction
 
     return output
 
 
+def get_blending_window(tile_shape, window='cosine'):
+    """Build a weight window for blending overlapping tile predictions.
+
+    Args:
+        tile_shape: size of each tile, e.g. (rows, cols) or (frames,)
+        window: type of window, one of {'cosine', 'gaussian', None}.
+            If None, every pixel in the tile is weighted equally.
+
+    Returns:
+        numpy array of shape tile_shape with strictly positive weights
+
+    Raises:
+        ValueError: window is not a valid type
+    """
+    def window_1d(size):
+        position = np.arange(size, dtype='float64') + 0.5
+        if window == 'cosine':
+            # Hann window, offset by half a pixel so the edges are non-zero
+            return 0.5 - 0.5 * np.cos(2 * np.pi * position / size)
+        sigma = size / 8
+        return np.exp(-(position - size / 2) ** 2 / (2 * sigma ** 2))
+
+    if window is None:
+        return np.ones(tile_shape, dtype=K.floatx())
+
+    window = str(window).lower()
+    if window not in {'cosine', 'gaussian'}:
+        raise ValueError('Expected `window` to be one of `cosine`, `gaussian` '
+                         'or None.  Got ', window)
+
+    weights = window_1d(tile_shape[0])
+    for size in tile_shape[1:]:
+        weights = np.multiply.outer(weights, window_1d(size))
+    # avoid dividing by (near) zero where only the tile edges overlap
+    weights = np.maximum(weights, 1e-3)
+    return weights.astype(K.floatx())
+
+
+def _get_tile_starts(length, tile, stride):
+    """Get the start index of each tile along an axis of a given length.
+    The final tile is shifted back so that it ends at the edge of the axis.
+    """
+    if length <= tile:
+        return [0]
+    starts = list(range(0, length - tile, stride))
+    starts.append(length - tile)
+    return starts
+
+
+def process_tiled_image(model, images, tile_size=None, overlap=32,
+                        window='cosine', padding='reflect',
+                        tiles_per_batch=16, batch_size=None, output=None,
+                        output_path=None, dtype=None, augment=False):
+    """Predict images of any size using fixed size, overlapping tiles.
+    The predictions of overlapping tiles are blended using a weight window.
+
+    Args:
+        model: model that will process each tile, the output of the
+            model must have the same spatial shape as its input
+        images: numpy array of ndim 4 or 5 to process
+        tile_size: (rows, cols) size of each tile.  If None, the tile size
+            is taken from model.input_shape
+        overlap: number of pixels shared by neighboring tiles
+        window: window used to blend tiles, one of {'cosine', 'gaussian', None}
+        padding: padding applied to images smaller than the tile size,
+            one of {'reflect', 'zero'}
+        tiles_per_batch: number of tiles stacked into a single call to
+            model.predict
+        batch_size: batch_size passed to model.predict
+        output: optional array (e.g. a np.memmap) to write the model
+            outputs into, must have the shape of the model output.
+            Its contents are overwritten.
+        output_path: if given, the model outputs are written into a
+            np.memmap created at this path.
+        dtype: dtype of the created output array, defaults to K.floatx().
+            Overlapping tiles are accumulated in this dtype.
+        augment: whether to average the predictions of the rotated and
+            flipped tiles, see `predict_with_augmentation`.
+
+    Returns:
+        model_output: numpy array of model outputs with the same spatial
+            shape as images
+
+    Raises:
+        ValueError: tile_size is not given and cannot be inferred from model
+        ValueError: overlap is not smaller than tile_size
+    """
+    if K.image_data_format() == 'channels_first':
+        channel_axis = 1
+        row_axis = len(images.shape) - 2
+        col_axis = len(images.shape) - 1
+    else:
+        channel_axis = len(images.shape) - 1
+        row_axis = len(images.shape) - 3
+        col_axis = len(images.shape) - 2
+
+    if images.ndim not in {4, 5}:
+        raise ValueError('Expected `images` to have ndim 4 or 5.  Got ',
+                         images.ndim)
+
+    if str(padding).lower() not in {'reflect', 'zero'}:
+        raise ValueError('Expected `padding` to be either `zero` or '
+                         '`reflect`.  Got ', padding)
+
+    if tile_size is None:
+        tile_size = (model.input_shape[row_axis], model.input_shape[col_axis])
+        if None in tile_size:
+            raise ValueError('Model has a dynamic input shape, `tile_size` '
+                             'must be provided.')
+    elif isinstance(tile_size, int):
+        tile_size = (tile_size, tile_size)
+    tile_x, tile_y = tile_size
+
+    if not 0 <= overlap < min(tile_x, tile_y):
+        raise ValueError('Expected `overlap` to be non-negative and smaller '
+                         'than `tile_size`.  Got ', overlap)
+
+    img_x, img_y = images.shape[row_axis], images.shape[col_axis]
+
+    # pad images smaller than a single tile up to the tile size
+    pad_width = [(0, 0)] * images.ndim
+    pad_width[row_axis] = (0, max(tile_x - img_x, 0))
+    pad_width[col_axis] = (0, max(tile_y - img_y, 0))
+    if str(padding).lower() == 'reflect':
+        padded_images = np.pad(images, pad_width, mode='reflect')
+    else:
+        padded_images = np.pad(images, pad_width, mode='constant', constant_values=0)
+
+    def tile_slice(x, y, size_x=tile_x, size_y=tile_y):
+        # index all axes, replacing only the row and column axes
+        slices = [slice(None)] * images.ndim
+        slices[row_axis] = slice(x, x + size_x)
+        slices[col_axis] = slice(y, y + size_y)
+        return tuple(slices)
+
+    # broadcast the 2D weight window over the other axes
+    weight_shape = [1] * images.ndim
+    weight_shape[row_axis] = tile_x
+    weight_shape[col_axis] = tile_y
+    weights = get_blending_window((tile_x, tile_y), window)
+    weights = np.reshape(weights, weight_shape)
+
+    norm_shape = [1] * images.ndim
+    norm_shape[row_axis] = img_x
+    norm_shape[col_axis] = img_y
+    norm = np.zeros(norm_shape, dtype=K.floatx())
+    output_array = None
+
+    row_starts = _get_tile_starts(padded_images.shape[row_axis], tile_x, tile_x - overlap)
+    col_starts = _get_tile_starts(padded_images.shape[col_axis], tile_y, tile_y - overlap)
+    tiles = [(x, y) for x in row_starts for y in col_starts]
+
+    for start in range(0, len(tiles), tiles_per_batch):
+        batch_tiles = tiles[start:start + tiles_per_batch]
+
+        batch = np.concatenate(
+            [padded_images[tile_slice(x, y)] for x, y in batch_tiles], axis=0)
+        if augment:
+            predicted = predict_with_augmentation(model, batch, batch_size=batch_size)
+        else:
+            predicted = model.predict(batch, batch_size=batch_size)
+
+        # if using skip_connections, get the final model output
+        if isinstance(predicted, list):
+            predicted = predicted[-1]
+
+        if (predicted.shape[row_axis], predicted.shape[col_axis]) != (tile_x, tile_y):
+            raise ValueError('Expected model output to have the same spatial '
+                             'shape as the tile {}.  Got {}'.format(
+                                 (tile_x, tile_y), predicted.shape))
+
+        if output_array is None:
+            output_shape = list(images.shape)
+            output_shape[channel_axis] = predicted.shape[channel_axis]
+            output_array = _create_output_array(output_shape, dtype, output, output_path)
+            if output is not None:
+                for b in range(output_array.shape[0]):
+                    output_array[b] = 0
+
+        predicted = np.split(predicted, len(batch_tiles), axis=0)
+        for (x, y), tile_prediction in zip(batch_tiles, predicted):
+            # only keep the part of the tile inside the original image
+            valid_x = min(tile_x, img_x - x)
+            valid_y = min(tile_y, img_y - y)
+            src = tile_slice(0, 0, valid_x, valid_y)
+            dst = tile_slice(x, y, valid_x, valid_y)
+            output_array[dst] += (tile_prediction * weights)[src]
+            norm[dst] += weights[src]
+
+    # normalize one batch at a time to limit memory use on large outputs
+    for b in range(output_array.shape[0]):
+        output_array[b] /= norm[0]
+
+    return output_array
+
+
+def process_movie(model, movie, frames_per_window=None, overlap=2,
+                  window='cosine', tile_size=None, spatial_overlap=32,
+                  spatial_window='cosine', padding='reflect',
+                  tiles_per_batch=16, batch_size=None, output=None,
+                  output_path=None, dtype=None):
+    """Predict a movie of any length with a sliding window along the time
+    axis. Each window of frames is spatially tiled by `process_tiled_image`,
+    and the predictions of overlapping frames are blended with a weight window.
+
+    Args:
+        model: 3D model that will process each window of frames, the output
+            of the model must have the same shape as its input
+        movie: numpy array of ndim 5 to process
+        frames_per_window: number of frames in each window.  If None,
+            the number of frames is taken from model.input_shape
+        overlap: number of frames shared by neighboring windows
+        window: window used to blend frames, one of {'cosine', 'gaussian', None}
+        tile_size: (rows, cols) size of each spatial tile.  If None, the tile
+            size is taken from model.input_shape
+        spatial_overlap: number of pixels shared by neighboring tiles
+        spatial_window: window used to blend tiles
+        padding: padding applied to movies or images smaller than the window,
+            one of {'reflect', 'zero'}
+        tiles_per_batch: number of tiles stacked into a single call to
+            model.predict
+        batch_size: batch_size passed to model.predict
+        output: optional array (e.g. a np.memmap) to write the model
+            outputs into, must have the shape of the model output.
+            Its contents are overwritten.
+        output_path: if given, the model outputs are written into a
+            np.memmap created at this path.
+        dtype: dtype of the created output array, defaults to K.floatx().
+
+    Returns:
+        model_output: numpy array of model outputs with the same number of
+            frames and spatial shape as movie
+
+    Raises:
+        ValueError: movie is not of ndim 5
+        ValueError: overlap is not smaller than frames_per_window
+    """
+    if movie.ndim != 5:
+        raise ValueError('Expected `movie` to have ndim 5.  Got ', movie.ndim)
+
+    if K.image_data_format() == 'channels_first':
+        channel_axis, time_axis = 1, 2
+    else:
+        channel_axis, time_axis = 4, 1
+
+    if frames_per_window is None:
+        frames_per_window = model.input_shape[time_axis]
+        if frames_per_window is None:
+            raise ValueError('Model has a dynamic number of frames, '
+                             '`frames_per_window` must be provided.')
+
+    if not 0 <= overlap < frames_per_window:
+        raise ValueError('Expected `overlap` to be non-negative and smaller '
+                         'than `frames_per_window`.  Got ', overlap)
+
+    if str(padding).lower() not in {'reflect', 'zero'}:
+        raise ValueError('Expected `padding` to be either `zero` or '
+                         '`reflect`.  Got ', padding)
+
+    n_frames = movie.shape[time_axis]
+
+    # pad movies shorter than a single window up to the window size
+    pad_width = [(0, 0)] * movie.ndim
+    pad_width[time_axis] = (0, max(frames_per_window - n_frames, 0))
+    if str(padding).lower() == 'reflect':
+        padded_movie = np.pad(movie, pad_width, mode='reflect')
+    else:
+        padded_movie = np.pad(movie, pad_width, mode='constant', constant_values=0)
+
+    def frame_slice(t, size):
+        slices = [slice(None)] * movie.ndim
+        slices[time_axis] = slice(t, t + size)
+        return tuple(slices)
+
+    weight_shape = [1] * movie.ndim
+    weight_shape[time_axis] = frames_per_window
+    weights = get_blending_window((frames_per_window,), window)
+    weights = np.reshape(weights, weight_shape)
+    norm = np.zeros(n_frames, dtype=K.floatx())
+    output_array = None
+
+    window_starts = _get_tile_starts(padded_movie.shape[time_axis],
+                                     frames_per_window,
+                                     frames_per_window - overlap)
+
+    for t in window_starts:
+        predicted = process_tiled_image(
+            model, padded_movie[frame_slice(t, frames_per_window)],
+            tile_size=tile_size,
+            overlap=spatial_overlap,
+            window=spatial_window,
+            padding=padding,
+            tiles_per_batch=tiles_per_batch,
+            batch_size=batch_size)
+
+        if output_array is None:
+            output_shape = list(movie.shape)
+            output_shape[channel_axis] = predicted.shape[channel_axis]
+            output_array = _create_output_array(output_shape, dtype, output, output_path)
+            if output is not None:
+                for b in range(output_array.shape[0]):
+                    output_array[b] = 0
+
+        # only keep the frames inside the original movie
+        valid_frames = min(frames_per_window, n_frames - t)
+        src = frame_slice(0, valid_frames)
+        output_array[frame_slice(t, valid_frames)] += (predicted * weights)[src]
+        norm[t:t + valid_frames] += weights.ravel()[:valid_frames]
+
+    # normalize one frame at a time to limit memory use on large outputs
+    for t in range(n_frames):
+        output_array[frame_slice(t, 1)] /= norm[t]
+
+    return output_array
+
+
+def _get_layer_configs(model):
+    """Get the class and config of each layer of the model, without the
+    names that Keras generates for each new layer and model"""
+    layers = []
+    for layer in model.layers:
+        if isinstance(layer, Model):
+            config = _get_layer_configs(layer)
+        else:
+            config = dict(layer.get_config())
+            config.pop('name', None)
+        layers.append([layer.__class__.__name__, config])
+    return layers
+
+
+def _get_architecture_id(model):
+    """Hash the layers and input shape of the model, so the same
+    architecture gets the same id in every process"""
+    def to_json(value):
+        if hasattr(value, 'tolist'):  # numpy values
+            return value.tolist()
+        return type(value).__name__
+
+    architecture = json.dumps([_get_layer_configs(model), model.input_shape],
+                              sort_keys=True, default=to_json)
+    return hashlib.sha1(architecture.encode('utf-8')).hexdigest()
+
+
+def _get_tiling_key(model, image_shape):
+    """Get a key identifying the model architecture, image shape and host"""
+    model_id = '{}_{}'.format(_get_architecture_id(model), model.input_shape)
+    host_id = '{}_{}cpu'.format(socket.gethostname(), multiprocessing.cpu_count())
+    return '{}|{}|{}'.format(model_id, tuple(image_shape), host_id)
+
+
+def _get_tiling_config_path(path=None):
+    if path is None:
+        path = os.path.join(os.path.expanduser('~'), '.deepcell', 'tiling.json')
+    return path
+
+
+# parsed tiling configurations of each path, with the version of the file
+_TILING_CONFIGS = {}
+_TILING_CONFIGS_LOCK = threading.Lock()
+
+
+def _read_tiling_configs(path):
+    """Read the saved tiling configurations, reusing the parsed file until
+    it changes. An unreadable file is treated as having no configurations.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return {}
+    version = (stat.st_mtime_ns, stat.st_size)
+
+    with _TILING_CONFIGS_LOCK:
+        cached = _TILING_CONFIGS.get(path)
+        if cached is not None and cached[0] == version:
+            return dict(cached[1])
+
+        try:
+            with open(path, 'r') as f:
+                configs = json.load(f)
+        except (IOError, ValueError) as err:
+            warnings.warn('Ignoring unreadable tiling configurations in {}: '
+                          '{}'.format(path, err))
+            configs = {}
+        _TILING_CONFIGS[path] = (version, configs)
+        return dict(configs)
+
+
+def load_tiling_config(model, image_shape, path=None):
+    """Load the tiling configuration saved by `autotune_tiling`
+    for the model and image shape on this host.
+
+    Args:
+        model: Keras model
+        image_shape: shape of the images to process
+        path: path to the saved configurations,
+            defaults to ~/.deepcell/tiling.json
+
+    Returns:
+        dictionary of the tiling configuration, or None if not found
+    """
+    path = _get_tiling_config_path(path)
+    configs = _read_tiling_configs(path)
+    return configs.get(_get_tiling_key(model, image_shape))
+
+
+def save_tiling_config(model, image_shape, config, path=None):
+    """Save a tiling configuration for the model and image shape on this host.
+
+    Args:
+        model: Keras model
+        image_shape: shape of the images to process
+        config: dictionary of the tiling configuration
+        path: path to the saved configurations,
+            defaults to ~/.deepcell/tiling.json
+    """
+    path = _get_tiling_config_path(path)
+    configs = _read_tiling_configs(path)
+    configs[_get_tiling_key(model, image_shape)] = config
+
+    if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    # write to a temporary file first so readers never see a partial file
+    temp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    with open(temp_path, 'w') as f:
+        json.dump(configs, f, indent=2, sort_keys=True)
+    os.replace(temp_path, path)
+
+
+# threading configuration of the sessions started by `set_thread_config`
+_SESSION_THREADS = weakref.WeakKeyDictionary()
+
+
+def set_thread_config(intra_op_threads=0, inter_op_threads=0, model=None):
+    """Start a new Keras session with the given number of threads.
+
+    Only the variables of `model` are initialized in the new session. Other
+    models keep theirs in the previous session, which is left open so that
+    it can be restored with `K.set_session`.
+
+    Args:
+        intra_op_threads: threads used within an op, 0 lets TF decide
+        inter_op_threads: threads used across ops, 0 lets TF decide
+        model: if given, the weights of this model are restored
+            in the new session
+
+    Returns:
+        the new session
+    """
+    weights = model.get_weights() if model is not None else None
+    config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                            inter_op_parallelism_threads=inter_op_threads)
+    session = tf.Session(config=config)
+    _SESSION_THREADS[session] = (intra_op_threads, inter_op_threads)
+    K.set_session(session)
+    if weights is not None:
+        model.set_weights(weights)
+    return session
+
+
+@contextlib.contextmanager
+def _thread_config_scope(intra_op_threads=0, inter_op_threads=0, model=None):
+    """Run `model` in a temporary session with the given number of threads,
+    then close it and restore the previous session."""
+    previous = K.get_session()
+    session = set_thread_config(intra_op_threads, inter_op_threads, model=model)
+    try:
+        yield session
+    finally:
+        K.set_session(previous)
+        session.close()
+
+
+def _get_max_channels(model):
+    """Get the largest number of channels output by any layer in the model"""
+    channel_axis = 1 if K.image_data_format() == 'channels_first' else -1
+    max_channels = 1
+    for layer in model.layers:
+        if isinstance(layer, Model):
+            max_channels = max(max_channels, _get_max_channels(layer))
+            continue
+        output_shapes = layer.output_shape
+        if not isinstance(output_shapes, list):
+            output_shapes = [output_shapes]
+        for shape in output_shapes:
+            if shape[channel_axis] is not None:
+                max_channels = max(max_channels, shape[channel_axis])
+    return max_channels
+
+
+def estimate_tiling_memory(model, images, num_crops=4, receptive_field=61,
+                           tiles_per_batch=1):
+    """Estimate the memory in bytes used to predict a batch of tiles,
+    assuming two activations of the widest layer are kept at once.
+
+    Args:
+        model: model that will process each tile
+        images: numpy array of images to process
+        num_crops: number of slices for the x and y axis to create sub-images
+        receptive_field: receptive field used by model
+        tiles_per_batch: number of crops stacked into a single call to
+            model.predict. If None, all crops are predicted in one call.
+
+    Returns:
+        estimated number of bytes
+    """
+    input_shape = get_cropped_input_shape(images, num_crops, receptive_field)
+    n_crops = num_crops * num_crops
+    if tiles_per_batch is not None:
+        n_crops = min(n_crops, tiles_per_batch)
+
+    channel_axis = 0 if K.image_data_format() == 'channels_first' else -1
+    pixels = np.prod(input_shape) // input_shape[channel_axis]
+    n_values = n_crops * images.shape[0] * pixels * _get_max_channels(model)
+    return int(2 * n_values * np.dtype(K.floatx()).itemsize)
+
+
+def autotune_tiling(model, images, receptive_field=61, padding=None,
+                    num_crops_options=(1, 2, 4, 8),
+                    tiles_per_batch_options=(1, 4, 16, None),
+                    thread_options=None,
+                    memory_budget=2 ** 31,
+                    trials=2,
+                    save=True,
+                    path=None):
+    """Time process_whole_image with different tiling and threading
+    configurations and return the fastest.
+
+    The fastest configuration is saved for the model, image shape and host,
+    and its `tiles_per_batch` is used by default by `process_whole_image`.
+    Each threading option is timed in its own session, which is closed
+    afterwards, so the current session is left unchanged.
+    Use `apply_tiling_config` to start a session with the fastest threading
+    configuration.
+
+    Args:
+        model: model that will process each tile.  Models with a fixed
+            input_shape only support the num_crops they were built for.
+        images: representative numpy array of images to process
+        receptive_field: receptive field used by model
+        padding: type of padding for input images, one of {'reflect', 'zero'}
+        num_crops_options: candidate values of num_crops
+        tiles_per_batch_options: candidate values of tiles_per_batch
+        thread_options: list of (intra_op_threads, inter_op_threads) to try.
+            If None, the current session is used.
+        memory_budget: configurations estimated to use more bytes are skipped
+        trials: number of timed runs of each configuration
+        save: whether to save the fastest configuration
+        path: path to the saved configurations,
+            defaults to ~/.deepcell/tiling.json
+
+    Returns:
+        dictionary of the fastest configuration
+
+    Raises:
+        ValueError: no configuration is valid within the memory budget
+    """
+    if K.image_data_format() == 'channels_first':
+        row_axis, col_axis = images.ndim - 2, images.ndim - 1
+    else:
+        row_axis, col_axis = images.ndim - 3, images.ndim - 2
+
+    def is_valid_num_crops(num_crops):
+        # the images must be evenly divided into crops
+        if images.shape[row_axis] % num_crops or images.shape[col_axis] % num_crops:
+            return False
+        # the model must accept the shape of the crops
+        expected = get_cropped_input_shape(images, num_crops, receptive_field)
+        model_input_shape = model.input_shape[1:]
+        return len(model_input_shape) == len(expected) and all(
+            m is None or m == e for m, e in zip(model_input_shape, expected))
+
+    num_crops_options = [n for n in num_crops_options if is_valid_num_crops(n)]
+
+    def time_configs(threads):
+        best = None
+        for num_crops in num_crops_options:
+            for tiles_per_batch in tiles_per_batch_options:
+                memory = estimate_tiling_memory(
+                    model, images, num_crops, receptive_field, tiles_per_batch)
+                if memory > memory_budget:
+                    continue
+
+                def run():
+                    process_whole_image(model, images,
+                                        num_crops=num_crops,
+                                        receptive_field=receptive_field,
+                                        padding=padding,
+                                        tiles_per_batch=tiles_per_batch)
+
+                run()  # warm up before timing
+                seconds = min(timeit.repeat(run, number=1, repeat=trials))
+
+                if best is None or seconds < best['seconds']:
+                    best = {
+                        'num_crops': num_crops,
+                        'tiles_per_batch': tiles_per_batch,
+                        'intra_op_threads': threads[0] if threads else None,
+                        'inter_op_threads': threads[1] if threads else None,
+                        'seconds': seconds,
+                    }
+        return best
+
+    best = None
+    for threads in thread_options or [None]:
+        if threads is None:
+            config = time_configs(threads)
+        else:
+            with _thread_config_scope(threads[0], threads[1], model=model):
+                config = time_configs(threads)
+
+        if best is None or (config and config['seconds'] < best['seconds']):
+            best = config
+
+    if best is None:
+        raise ValueError('No valid tiling configuration within the memory '
+                         'budget of {} bytes.'.format(memory_budget))
+
+    if save:
+        save_tiling_config(model, images.shape, best, path=path)
+    return best
+
+
+def apply_tiling_config(model, image_shape, path=None):
+    """Load the saved tiling configuration for the model and image shape,
+    and start a session with its threading configuration, unless the
+    current session already has it.
+
+    Args:
+        model: Keras model
+        image_shape: shape of the images to process
+        path: path to the saved configurations,
+            defaults to ~/.deepcell/tiling.json
+
+    Returns:
+        dictionary of keyword arguments for `process_whole_image`,
+        empty if no configuration is saved
+    """
+    config = load_tiling_config(model, image_shape, path=path)
+    if config is None:
+        return {}
+
+    threads = (config['intra_op_threads'], config['inter_op_threads'])
+    if threads[0] is not None and _SESSION_THREADS.get(K.get_session()) != threads:
+        set_thread_config(threads[0], threads[1], model=model)
+
+    return {
+        'num_crops': config['num_crops'],
+        'tiles_per_batch': config['tiles_per_batch']
+    }
+
+
 def run_model(image, model, win_x=30, win_y=30, split=True):
     """Runs the chosen model.
 
@@ -269,31 +1359,118 @@ def run_model(image, model, win_x=30, win_y=30, split=True):
     return model_output
 
 
+def _save_features(model_output, output_location, frame, is_channels_first):
+    """Save each feature of a single model output as a tiff image"""
+    n_features = model_output.shape[0 if is_channels_first else -1]
+    for f in range(n_features):
+        feature = model_output[f, :, :] if is_channels_first else model_output[:, :, f]
+        cnnout_name = 'feature_{}_frame_{}.tif'.format(f, frame)
+        tiff.imsave(os.path.join(output_location, cnnout_name), feature)
+
+
 def run_model_on_directory(data_location, channel_names, output_location, model,
                            win_x=30, win_y=30, split=True, save=True):
 
     is_channels_first = K.image_data_format() == 'channels_first'
-    channel_axis = 1 if is_channels_first else -1
-    n_features = model.layers[-1].output_shape[channel_axis]
 
     image_list = get_images_from_directory(data_location, channel_names)
     model_outputs = []
 
     for i, image in enumerate(image_list):
         print('Processing image {} of {}'.format(i + 1, len(image_list)))
+        # use the threading configuration tuned for this image shape
+        apply_tiling_config(model, image.shape)
         model_output = run_model(image, model, win_x=win_x, win_y=win_y, split=split)
         model_outputs.append(model_output)
 
         # Save images
         if save:
-            for f in range(n_features):
-                feature = model_output[f, :, :] if is_channels_first else model_output[:, :, f]
-                cnnout_name = 'feature_{}_frame_{}.tif'.format(f, str(i).zfill(3))
-                tiff.imsave(os.path.join(output_location, cnnout_name), feature)
+            _save_features(model_output, output_location,
+                           str(i).zfill(3), is_channels_first)
 
     return model_outputs
 
 
+def stream_model_on_directory(data_location, channel_names, output_location, model,
+                              win_x=30, win_y=30, split=True, num_readers=2,
+                              num_writers=2, queue_size=4):
+    """Run the model on every image in a directory, overlapping I/O and compute.
+
+    Images are read by a pool of reader threads and prefetched ahead of the
+    model, while the outputs are written by a pool of writer threads.
+    At most `queue_size` images are waiting to be predicted and at most
+    `queue_size` outputs are waiting to be written, so peak memory does not
+    depend on the number of images in the directory.
+    The threading configuration saved by `autotune_tiling` for the shape of
+    the images is applied with `apply_tiling_config`.
+
+    Args:
+        data_location: folder containing image files
+        channel_names: list of wildcards to select filenames
+        output_location: folder to save the model outputs
+        model: model that will process each image
+        win_x: number of row pixels to ignore on either side
+        win_y: number of column pixels to ignore on either side
+        split: whether to split each image into 4 sub-images
+        num_readers: number of threads reading images
+        num_writers: number of threads writing model outputs
+        queue_size: maximum number of prefetched images and pending writes
+
+    Returns:
+        the number of images processed
+    """
+    if queue_size < 1:
+        raise ValueError('Expected `queue_size` to be a positive integer. '
+                         'Got ', queue_size)
+
+    data_format = K.image_data_format()
+    is_channels_first = data_format == 'channels_first'
+
+    image_paths = get_image_paths_from_directory(data_location, channel_names)
+    image_paths = iter(enumerate(image_paths))
+
+    pending_reads = deque()
+    pending_writes = deque()
+    num_images = 0
+
+    with ThreadPoolExecutor(num_readers) as readers, \
+            ThreadPoolExecutor(num_writers) as writers:
+
+        def prefetch():
+            item = next(image_paths, None)
+            if item is not None:
+                i, paths = item
+                future = readers.submit(get_multichannel_image, paths, data_format)
+                pending_reads.append((i, future))
+
+        for _ in range(queue_size):
+            prefetch()
+
+        while pending_reads:
+            i, future = pending_reads.popleft()
+            image = future.result()
+            prefetch()
+
+            print('Processing image {}'.format(i + 1))
+            # use the threading configuration tuned for this image shape
+            apply_tiling_config(model, image.shape)
+            model_output = run_model(image, model, win_x=win_x, win_y=win_y, split=split)
+            pending_writes.append(writers.submit(
+                _save_features, model_output, output_location,
+                str(i).zfill(3), is_channels_first))
+            num_images += 1
+
+            # block on the oldest write to bound the number of outputs in memory
+            while len(pending_writes) > queue_size:
+                pending_writes.popleft().result()
+
+        # raise any errors from the remaining writes
+        while pending_writes:
+            pending_writes.popleft().result()
+
+    return num_images
+
+
 def run_models_on_directory(data_location, channel_names, output_location, model_fn,
                             list_of_weights, n_features=3, win_x=30, win_y=30,
                             image_size_x=1080, image_size_y=1280, save=True, split=True):
@@ -309,36 +1486,43 @@ def run_models_on_directory(data_location, channel_names, output_location, model
     else:
         batch_shape = (1, input_shape[0], input_shape[1], input_shape[2])
 
-    model = model_fn(input_shape=input_shape, n_features=n_features)
-
-    for layer in model.layers:
-        print(layer.name)
-
-    channel_axis = 1 if is_channels_first else -1
-    n_features = model.layers[-1].output_shape[channel_axis]
-
-    model_outputs = []
-    for weights_path in list_of_weights:
-        model.load_weights(weights_path)
-        processed_image_list = run_model_on_directory(
-            data_location, channel_names, output_location, model,
-            win_x=win_x, win_y=win_y, save=False, split=split)
+    def get_member(weights_path):
+        return get_model(model_fn, input_shape=input_shape,
+                         weights_path=weights_path, n_features=n_features)
+
+    with contextlib.ExitStack() as stack:
+        # each set of weights is loaded once into its own cached model,
+        # which stays in use, and so resident, until every image is done
+        for weights_path in list_of_weights:
+            model = stack.enter_context(get_member(weights_path))
+
+        for layer in model.layers:
+            print(layer.name)
+
+        image_paths = get_image_paths_from_directory(data_location, channel_names)
+
+        model_outputs = []
+        for i, paths in enumerate(image_paths):
+            print('Processing image {} of {}'.format(i + 1, len(image_paths)))
+            # each image is read once and shared by every model
+            image = get_multichannel_image(paths)
+
+            # keep a running mean of the outputs of each model
+            mean_output = None
+            for k, weights_path in enumerate(list_of_weights):
+                # enter the graph and session of the model
+                with get_member(weights_path) as model:
+                    output = run_model(image, model, win_x=win_x, win_y=win_y,
+                                       split=split)
+                if mean_output is None:
+                    mean_output = np.copy(output)
+                else:
+                    mean_output += (output - mean_output) / (k + 1)
 
-        model_outputs.append(np.stack(processed_image_list, axis=0))
+            # Save images
+            if save:
+                _save_features(mean_output, output_location, i, is_channels_first)
 
-    # Average all images
-    model_output = np.stack(model_outputs, axis=0)
-    model_output = np.mean(model_output, axis=0)
+            model_outputs.append(mean_output)
 
-    # Save images
-    if save:
-        for i in range(model_output.shape[0]):
-            for f in range(n_features):
-                if is_channels_first:
-                    feature = model_output[i, f, :, :]
-                else:
-                    feature = model_output[i, :, :, f]
-                cnnout_name = 'feature_{}_frame_{}.tif'.format(f, i)
-                tiff.imsave(os.path.join(output_location, cnnout_name), feature)
-
-    return model_output
+    return np.stack(model_outputs, axis=0)
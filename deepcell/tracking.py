@@ -34,11 +34,10 @@ import tempfile
 import numpy as np
 from tensorflow.python.keras import backend as K
 from scipy.optimize import linear_sum_assignment
-from skimage.measure import regionprops
-from skimage.transform import resize
 from pandas import DataFrame
 
 from deepcell.image_generators import MovieDataGenerator
+from deepcell.utils.tracking_utils import get_frame_features
 
 
 class cell_tracker():
@@ -577,50 +576,29 @@ class cell_tracker():
 
         return track_neighborhoods
 
-    def _sub_area(self, X_frame, y_frame, cell_label, num_channels):
-        shape = (2 * self.neighborhood_scale_size + 1,
-                 2 * self.neighborhood_scale_size + 1,
-                 1)
-        neighborhood = np.zeros(shape, dtype=K.floatx())
-
-        pads = ((self.neighborhood_true_size, self.neighborhood_true_size),
-                (self.neighborhood_true_size, self.neighborhood_true_size),
-                (0, 0))
-        X_padded = np.pad(X_frame, pads, mode='constant', constant_values=0)
-        y_padded = np.pad(y_frame, pads, mode='constant', constant_values=0)
-        props = regionprops(np.squeeze(np.int32(y_padded == cell_label)))
-        center_x, center_y = props[0].centroid
-        center_x, center_y = np.int(center_x), np.int(center_y)
-        X_reduced = X_padded[
-            center_x - self.neighborhood_true_size:center_x + self.neighborhood_true_size,
-            center_y - self.neighborhood_true_size:center_y + self.neighborhood_true_size, :]
-
-        # resize to neighborhood_scale_size
-        resize_shape = (2 * self.neighborhood_scale_size + 1,
-                        2 * self.neighborhood_scale_size + 1,
-                        num_channels)
-        X_reduced = resize(X_reduced, resize_shape, mode='constant', preserve_range=True)
-        # X_reduced /= np.amax(X_reduced)
-
-        return X_reduced
-
     def _get_features(self, X, y, frames, labels):
         """Gets the features of a list of cells.
         Cells are defined by lists of frames and labels. The i'th element of
         frames and labels is the frame and label of the i'th cell being grabbed.
+        The cells of each frame are processed together by `get_frame_features`.
         Returns a dictionary with keys as the feature names.
         """
+        frames = np.asarray(frames, dtype='int64')
+        labels = np.asarray(labels)
+
         channel_axis = self.channel_axis
         if self.data_format == 'channels_first':
             appearance_shape = (X.shape[channel_axis],
                                 len(frames),
                                 self.crop_dim,
                                 self.crop_dim)
+            num_frames = X.shape[1]
         else:
             appearance_shape = (len(frames),
                                 self.crop_dim,
                                 self.crop_dim,
                                 X.shape[channel_axis])
+            num_frames = X.shape[0]
 
         centroid_shape = (len(frames), 2)
         regionprop_shape = (len(frames), 3)
@@ -641,52 +619,36 @@ class cell_tracker():
         neighborhoods = np.zeros(neighborhood_shape, dtype=K.floatx())
         future_areas = np.zeros(future_area_shape, dtype=K.floatx())
 
-        for counter, (frame, cell_label) in enumerate(zip(frames, labels)):
-            # Get the bounding box
+        for frame in np.unique(frames):
+            index = np.flatnonzero(frames == frame)
             X_frame = X[frame] if self.data_format == 'channels_last' else X[:, frame]
             y_frame = y[frame] if self.data_format == 'channels_last' else y[:, frame]
-            props = regionprops(np.squeeze(np.int32(y_frame == cell_label)))
-
-            minr, minc, maxr, maxc = props[0].bbox
-            centroids[counter] = props[0].centroid
-            rprops[counter] = np.array([
-                props[0].area,
-                props[0].perimeter,
-                props[0].eccentricity
-            ])
-
-            # Extract images from bounding boxes
-            if self.data_format == 'channels_first':
-                appearance = np.copy(X[:, frame, minr:maxr, minc:maxc])
-                resize_shape = (X.shape[channel_axis], self.crop_dim, self.crop_dim)
-            else:
-                appearance = np.copy(X[frame, minr:maxr, minc:maxc, :])
-                resize_shape = (self.crop_dim, self.crop_dim, X.shape[channel_axis])
-
-            # Resize images from bounding box
-            appearance = resize(appearance, resize_shape, mode="constant", preserve_range=True)
-            # appearance /= np.amax(appearance)
-
-            if self.data_format == 'channels_first':
-                appearances[:, counter] = appearance
-            else:
-                appearances[counter] = appearance
-
-            # Get the neighborhood
-            neighborhoods[counter] = self._sub_area(
-                X_frame, y_frame, cell_label, X.shape[channel_axis])
 
             # Try to assign future areas if future frame is available
             # TODO: We shouldn't grab a future frame if the frame is dark (was padded)
-            try:
+            X_future_frame = None
+            if frame + 1 < num_frames:
                 if self.data_format == 'channels_first':
                     X_future_frame = X[:, frame + 1]
                 else:
                     X_future_frame = X[frame + 1]
-                future_areas[counter] = self._sub_area(
-                    X_future_frame, y_frame, cell_label, X.shape[channel_axis])
-            except IndexError:
-                future_areas[counter] = neighborhoods[counter]
+
+            features = get_frame_features(
+                X_frame, y_frame, labels[index],
+                crop_dim=self.crop_dim,
+                neighborhood_scale_size=self.neighborhood_scale_size,
+                neighborhood_true_size=self.neighborhood_true_size,
+                X_future_frame=X_future_frame,
+                data_format=self.data_format)
+
+            if self.data_format == 'channels_first':
+                appearances[:, index] = np.moveaxis(features['appearances'], 0, 1)
+            else:
+                appearances[index] = features['appearances']
+            centroids[index] = features['centroids']
+            rprops[index] = features['regionprops']
+            neighborhoods[index] = features['neighborhoods']
+            future_areas[index] = features.get('future_areas', features['neighborhoods'])
 
         # future areas are not a feature instead a part of the neighborhood feature
         return {'appearance': appearances,
@@ -68,6 +68,7 @@ def train_model_sample(model,
                        shear=0,
                        zoom_range=0,
                        seed=None,
+                       use_dataset=False,
                        **kwargs):
     is_channels_first = K.image_data_format() == 'channels_first'
 
@@ -154,20 +155,36 @@ def train_model_sample(model,
         balance_classes=False,
         max_class_samples=max_class_samples)
 
-    # fit the model on the batches generated by datagen.flow()
-    loss_history = model.fit_generator(
-        train_data,
-        steps_per_epoch=train_data.y.shape[0] // batch_size,
+    if use_dataset:
+        # the batches of datagen.flow() are prepared by tf.data while the
+        # model trains, one pass over the data per epoch
+        fit = model.fit
+        fit_kwargs = {
+            'x': train_data.to_dataset(),
+            'steps_per_epoch': len(train_data),
+            'validation_data': val_data.to_dataset(),
+            'validation_steps': len(val_data)
+        }
+    else:
+        # fit the model on the batches generated by datagen.flow()
+        fit = model.fit_generator
+        fit_kwargs = {
+            'generator': train_data,
+            'steps_per_epoch': train_data.y.shape[0] // batch_size,
+            'validation_data': val_data,
+            'validation_steps': val_data.y.shape[0] // batch_size
+        }
+
+    loss_history = fit(
         epochs=n_epoch,
-        validation_data=val_data,
-        validation_steps=val_data.y.shape[0] // batch_size,
         callbacks=[
             callbacks.LearningRateScheduler(lr_sched),
             callbacks.ModelCheckpoint(
                 model_path, monitor='val_loss', verbose=1,
                 save_best_only=True, save_weights_only=num_gpus >= 2),
             callbacks.TensorBoard(log_dir=os.path.join(log_dir, model_name))
-        ])
+        ],
+        **fit_kwargs)
 
     np.savez(loss_path, loss_history=loss_history.history)
 
@@ -195,6 +212,7 @@ def train_model_conv(model,
                      shear=0,
                      zoom_range=0,
                      seed=None,
+                     use_dataset=False,
                      **kwargs):
     is_channels_first = K.image_data_format() == 'channels_first'
 
@@ -310,20 +328,36 @@ def train_model_conv(model,
             transform=transform,
             transform_kwargs=kwargs)
 
-    # fit the model on the batches generated by datagen.flow()
-    loss_history = model.fit_generator(
-        train_data,
-        steps_per_epoch=train_data.y.shape[0] // batch_size,
+    if use_dataset:
+        # the batches of datagen.flow() are prepared by tf.data while the
+        # model trains, one pass over the data per epoch
+        fit = model.fit
+        fit_kwargs = {
+            'x': train_data.to_dataset(),
+            'steps_per_epoch': len(train_data),
+            'validation_data': val_data.to_dataset(),
+            'validation_steps': len(val_data)
+        }
+    else:
+        # fit the model on the batches generated by datagen.flow()
+        fit = model.fit_generator
+        fit_kwargs = {
+            'generator': train_data,
+            'steps_per_epoch': train_data.y.shape[0] // batch_size,
+            'validation_data': val_data,
+            'validation_steps': val_data.y.shape[0] // batch_size
+        }
+
+    loss_history = fit(
         epochs=n_epoch,
-        validation_data=val_data,
-        validation_steps=val_data.y.shape[0] // batch_size,
         callbacks=[
             callbacks.LearningRateScheduler(lr_sched),
             callbacks.ModelCheckpoint(
                 model_path, monitor='val_loss', verbose=1,
                 save_best_only=True, save_weights_only=num_gpus >= 2),
             callbacks.TensorBoard(log_dir=os.path.join(log_dir, model_name))
-        ])
+        ],
+        **fit_kwargs)
 
     model.save_weights(model_path)
     np.savez(loss_path, loss_history=loss_history.history)
@@ -52,11 +52,95 @@ from deepcell.utils.misc_utils import sorted_nicely
 from deepcell.utils.tracking_utils import load_trks
 
 
+class MemmapSubset(object):
+    """A subset of the batches of a memory-mapped array.
+
+    Indexing reads only the requested elements from disk, so iterators can
+    sample windows of movies that do not fit in memory.
+    `np.asarray` loads the whole subset.
+
+    Arguments:
+        array: memory-mapped array, e.g. from `np.load(path, mmap_mode='r')`
+        index: indices of the batches in the subset
+    """
+
+    def __init__(self, array, index):
+        self.array = array
+        self.index = np.asarray(index)
+
+    @property
+    def shape(self):
+        return (len(self.index),) + tuple(self.array.shape[1:])
+
+    @property
+    def ndim(self):
+        return self.array.ndim
+
+    @property
+    def dtype(self):
+        return self.array.dtype
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return MemmapSubset(self.array, self.index[key])
+        if not isinstance(key, tuple):
+            key = (key,)
+        return self.array[(self.index[key[0]],) + key[1:]]
+
+    def __array__(self, dtype=None):
+        return np.asarray(self.array[self.index], dtype=dtype)
+
+    def __getstate__(self):
+        # pickle the path of the file instead of its contents
+        state = self.__dict__.copy()
+        if isinstance(self.array, np.memmap) and self.array.filename:
+            state['array'] = self.array.filename
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if isinstance(self.array, str):
+            self.array = np.load(self.array, mmap_mode='r')
+
+
+def convert_npz_to_npy(file_name, directory=None):
+    """Save each array of an NPZ file as an uncompressed `.npy` file, which
+    `get_data` can memory-map instead of loading into memory.
+
+    Args:
+        file_name: path to NPZ file to convert
+        directory: directory for the `.npy` files, defaults to `file_name`
+            without its extension
+
+    Returns:
+        str: the directory of the `.npy` files
+    """
+    if directory is None:
+        directory = os.path.splitext(file_name)[0]
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    with np.load(file_name) as data:
+        for key in data.files:
+            np.save(os.path.join(directory, '{}.npy'.format(key)), data[key])
+    return directory
+
+
 def get_data(file_name, mode='sample', test_size=.1, seed=None):
     """Load data from NPZ file and split into train and test sets
 
     Args:
-        file_name: path to NPZ file to load
+        file_name: path to NPZ file to load, or to a directory of `.npy`
+            files (see `convert_npz_to_npy`) which are memory-mapped.
+            The train and test sets of a directory are `MemmapSubset`s,
+            so only the sampled data is read from disk.
         mode: if 'siamese_daughters', returns lineage information from .trk file
               otherwise, returns the same data that was loaded
         test_size: percent of data to leave as testing holdout
@@ -103,12 +187,22 @@ def get_data(file_name, mode='sample', test_size=.1, seed=None):
         }
         return train_dict, test_dict
 
-    training_data = np.load(file_name)
-    X = training_data['X']
-    y = training_data['y']
+    if os.path.isdir(file_name):
+        X = np.load(os.path.join(file_name, 'X.npy'), mmap_mode='r')
+        y = np.load(os.path.join(file_name, 'y.npy'), mmap_mode='r')
+
+        # split the indices into the same sets as the arrays themselves
+        train_index, test_index = train_test_split(
+            np.arange(X.shape[0]), test_size=test_size, random_state=seed)
+        X_train, X_test = MemmapSubset(X, train_index), MemmapSubset(X, test_index)
+        y_train, y_test = MemmapSubset(y, train_index), MemmapSubset(y, test_index)
+    else:
+        training_data = np.load(file_name)
+        X = training_data['X']
+        y = training_data['y']
 
-    X_train, X_test, y_train, y_test = train_test_split(
-        X, y, test_size=test_size, random_state=seed)
+        X_train, X_test, y_train, y_test = train_test_split(
+            X, y, test_size=test_size, random_state=seed)
 
     train_dict = {
         'X': X_train,
@@ -29,7 +29,10 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import division
 
+import json
 import os
+import queue
+import threading
 
 import numpy as np
 from skimage.io import imread
@@ -128,52 +131,83 @@ def get_image_sizes(data_location, channel_names):
     return img_temp.shape
 
 
-def get_images_from_directory(data_location, channel_names):
-    """Read all images from directory with channel_name in the filename
+def get_image_paths_from_directory(data_location, channel_names):
+    """Get the paths of all images in directory with channel_name in the filename
 
     Args:
         data_location: folder containing image files
         channel_names: list of wildcards to select filenames
 
     Returns:
-        numpy array of each image in the directory
+        list of image paths for each image, with one path per channel
     """
-    data_format = K.image_data_format()
     img_list_channels = []
     for channel in channel_names:
         img_list_channels.append(nikon_getfiles(data_location, channel))
 
-    img_temp = np.asarray(get_image(os.path.join(data_location, img_list_channels[0][0])))
+    image_paths = []
+    for stack_iteration in range(len(img_list_channels[0])):
+        image_paths.append([os.path.join(data_location, img_list[stack_iteration])
+                            for img_list in img_list_channels])
+    return image_paths
 
-    n_channels = len(channel_names)
-    all_images = []
 
-    for stack_iteration in range(len(img_list_channels[0])):
-        if data_format == 'channels_first':
-            shape = (1, n_channels, img_temp.shape[0], img_temp.shape[1])
-        else:
-            shape = (1, img_temp.shape[0], img_temp.shape[1], n_channels)
+def get_multichannel_image(image_paths, data_format=None):
+    """Read an image file for each channel and stack them into one image
+
+    Args:
+        image_paths: list of paths to each channel of the image
+        data_format: `channels_first` or `channels_last`
+
+    Returns:
+        numpy array of the image with a batch dimension of 1
+    """
+    if data_format is None:
+        data_format = K.image_data_format()
 
-        all_channels = np.zeros(shape, dtype=K.floatx())
+    n_channels = len(image_paths)
+    all_channels = None
 
-        for j in range(n_channels):
-            img_path = os.path.join(data_location, img_list_channels[j][stack_iteration])
-            channel_img = get_image(img_path)
+    for j, img_path in enumerate(image_paths):
+        channel_img = get_image(img_path)
+        if all_channels is None:
             if data_format == 'channels_first':
-                all_channels[0, j, :, :] = channel_img
+                shape = (1, n_channels, channel_img.shape[0], channel_img.shape[1])
             else:
-                all_channels[0, :, :, j] = channel_img
+                shape = (1, channel_img.shape[0], channel_img.shape[1], n_channels)
+            all_channels = np.zeros(shape, dtype=K.floatx())
+
+        if data_format == 'channels_first':
+            all_channels[0, j, :, :] = channel_img
+        else:
+            all_channels[0, :, :, j] = channel_img
 
-        all_images.append(all_channels)
+    return all_channels
 
-    return all_images
+
+def get_images_from_directory(data_location, channel_names):
+    """Read all images from directory with channel_name in the filename
+
+    Args:
+        data_location: folder containing image files
+        channel_names: list of wildcards to select filenames
+
+    Returns:
+        numpy array of each image in the directory
+    """
+    data_format = K.image_data_format()
+    image_paths = get_image_paths_from_directory(data_location, channel_names)
+    return [get_multichannel_image(p, data_format) for p in image_paths]
 
 
 def save_model_output(output,
                       output_dir,
                       feature_name='',
                       channel=None,
-                      data_format=None):
+                      data_format=None,
+                      output_format='tif',
+                      compress=0,
+                      frames_per_chunk=16):
     """Save model output as tiff images in the provided directory
 
     Args:
@@ -181,6 +215,19 @@ def save_model_output(output,
         output_dir: directory to save the model output images
         feature_name: optional description to start each output image filename
         channel: if given, only saves this channel
+        data_format: `channels_first` or `channels_last`
+        output_format: 'tif' saves one int32 tiff per frame and channel.
+            'bigtiff' and 'npy' save the whole output with its dtype as a
+            single store, see `ModelOutputWriter`.
+        compress: zlib compression level for the 'bigtiff' and 'npy' formats
+        frames_per_chunk: number of frames per file for the 'npy' format
+
+    Returns:
+        path to the store if output_format is 'bigtiff' or 'npy'
+
+    Raises:
+        ValueError: channel is out of range or output_format is unknown
+        FileNotFoundError: output_dir does not exist
     """
     if data_format is None:
         data_format = K.image_data_format()
@@ -191,10 +238,29 @@ def save_model_output(output,
         raise ValueError('`channel` must be in the range of the output '
                          'channels. Got ', channel)
 
+    if output_format not in {'tif', 'bigtiff', 'npy'}:
+        raise ValueError('`output_format` must be one of "tif", "bigtiff" or '
+                         '"npy". Got ', output_format)
+
     if not os.path.isdir(output_dir):
         raise FileNotFoundError('{} is not a valid output_dir'.format(
             output_dir))
 
+    if output_format != 'tif':
+        if channel is not None:
+            output = np.take(output, [channel], axis=channel_axis)
+        store_path = os.path.join(output_dir, feature_name or 'output')
+        writer = ModelOutputWriter(store_path, output.shape,
+                                   dtype=output.dtype,
+                                   output_format=output_format,
+                                   compress=compress,
+                                   frames_per_chunk=frames_per_chunk,
+                                   data_format=data_format)
+        with writer:
+            writer.write(output)
+        print('Saved output with shape {} to {}'.format(output.shape, store_path))
+        return store_path
+
     for b in range(output.shape[0]):
         # If multiple batches of results, create a numbered subdirectory
         batch_dir = str(b) if output.shape[0] > 1 else ''
@@ -222,3 +288,263 @@ def save_model_output(output,
                 out_file_path = os.path.join(output_dir, batch_dir, cnnout_name)
                 tiff.imsave(out_file_path, feature.astype('int32'))
         print('Saved {} frames to {}'.format(output.shape[1], output_dir))
+
+
+def _save_tiff_page(tif, page, compress=0):
+    """Append a single 2D page to an open TiffWriter"""
+    if hasattr(tif, 'save'):  # tifffile as vendored by skimage
+        tif.save(page, compress=compress)
+    else:  # newer tifffile renamed `save` to `write`
+        tif.write(page, compression='zlib' if compress else None,
+                  compressionargs={'level': compress} if compress else None,
+                  metadata=None)
+
+
+class ModelOutputWriter(object):
+    """Write a model output tensor to a single on-disk store.
+    Frames are written by a background thread, so `write` returns as soon as
+    the data is queued. The store is a directory with a `metadata.json` file
+    and either one multi-page BigTIFF (`data.tif`, one page per frame and
+    channel) or one `.npy` file per chunk of frames (`.npz` if compressed).
+    Use `read_model_output` to read the whole store or a range of frames.
+
+    Arguments:
+        path: directory of the store, created if it does not exist
+        shape: shape of the full output, (batch, [frames,] x, y, channels)
+            for channels_last or (batch, channels, [frames,] x, y)
+        dtype: dtype of the stored data
+        output_format: 'bigtiff' or 'npy'
+        compress: zlib compression level, 0 for no compression
+        frames_per_chunk: number of frames per file for the 'npy' format
+        data_format: `channels_first` or `channels_last`
+        max_queue_size: number of pending writes before `write` blocks
+
+    Raises:
+        ValueError: shape is not 4D or 5D or output_format is unknown
+    """
+
+    def __init__(self,
+                 path,
+                 shape,
+                 dtype=None,
+                 output_format='bigtiff',
+                 compress=0,
+                 frames_per_chunk=16,
+                 data_format=None,
+                 max_queue_size=8):
+        if len(shape) not in {4, 5}:
+            raise ValueError('Expected output shape with 4 or 5 dimensions. '
+                             'Got ', shape)
+        if output_format not in {'bigtiff', 'npy'}:
+            raise ValueError('`output_format` must be "bigtiff" or "npy". '
+                             'Got ', output_format)
+
+        if data_format is None:
+            data_format = K.image_data_format()
+        if dtype is None:
+            dtype = K.floatx()
+
+        self.path = path
+        self.shape = tuple(int(x) for x in shape)
+        self.dtype = np.dtype(dtype)
+        self.output_format = output_format
+        self.compress = compress
+        self.frames_per_chunk = frames_per_chunk
+        self.data_format = data_format
+
+        # every frame is stored as (x, y, channels)
+        channel_axis = 1 if data_format == 'channels_first' else len(shape) - 1
+        spatial = [x for i, x in enumerate(self.shape[1:], 1) if i != channel_axis]
+        self.frame_shape = tuple(spatial[-2:]) + (self.shape[channel_axis],)
+        self.num_frames = self.shape[0] * (spatial[0] if len(shape) == 5 else 1)
+        self.frames_written = 0
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self._chunk = []
+        self._chunk_index = 0
+        self._tif = None
+        if output_format == 'bigtiff':
+            self._tif = tiff.TiffWriter(os.path.join(path, 'data.tif'), bigtiff=True)
+
+        self._error = None
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _to_frames(self, output):
+        """Reshape part of an output tensor into (frames, x, y, channels)"""
+        output = np.asarray(output, dtype=self.dtype)
+        if self.data_format == 'channels_first':
+            output = np.moveaxis(output, 1, -1)
+        return output.reshape((-1,) + self.frame_shape)
+
+    def write(self, output):
+        """Queue the next frames of the output for writing.
+
+        Args:
+            output: the whole output tensor or the next slice of it along
+                the batch axis (or the frame axis, if the batch size is 1).
+                May also be an array of frames shaped (frames, x, y, channels).
+
+        Raises:
+            ValueError: more frames are written than the output shape has
+        """
+        self._raise_error()
+        frames = self._to_frames(output)
+        if self.frames_written + len(frames) > self.num_frames:
+            raise ValueError('Writing {} frames would exceed the {} frames of '
+                             'the output'.format(len(frames), self.num_frames))
+        self.frames_written += len(frames)
+        self._queue.put(frames)
+
+    def _run(self):
+        while True:
+            frames = self._queue.get()
+            try:
+                if frames is None:
+                    self._flush_chunk()
+                    break
+                if self._error is None:
+                    self._write_frames(frames)
+            except Exception as err:  # pylint: disable=broad-except
+                self._error = err
+            finally:
+                self._queue.task_done()
+
+    def _write_frames(self, frames):
+        if self.output_format == 'bigtiff':
+            for frame in frames:
+                for c in range(frame.shape[-1]):
+                    _save_tiff_page(self._tif, frame[..., c], self.compress)
+            return
+
+        for frame in frames:
+            self._chunk.append(frame)
+            if len(self._chunk) == self.frames_per_chunk:
+                self._flush_chunk()
+
+    def _flush_chunk(self):
+        if not self._chunk:
+            return
+        chunk = np.stack(self._chunk)
+        name = os.path.join(self.path, 'chunk_{:06d}'.format(self._chunk_index))
+        if self.compress:
+            np.savez_compressed(name, data=chunk)
+        else:
+            np.save(name, chunk)
+        self._chunk = []
+        self._chunk_index += 1
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _stop(self):
+        """Wait for the queued frames to be written and close the tiff file"""
+        try:
+            if self._thread.is_alive():
+                self._queue.put(None)
+                self._thread.join()
+        finally:
+            if self._tif is not None:
+                self._tif.close()
+                self._tif = None
+
+    def close(self):
+        """Wait for all frames to be written and write the metadata.
+
+        Raises:
+            ValueError: fewer frames were written than the output shape has
+        """
+        self._stop()
+        self._raise_error()
+
+        if self.frames_written != self.num_frames:
+            raise ValueError('Only {} of {} frames were written to {}'.format(
+                self.frames_written, self.num_frames, self.path))
+
+        metadata = {
+            'shape': self.shape,
+            'frame_shape': self.frame_shape,
+            'dtype': self.dtype.str,
+            'output_format': self.output_format,
+            'compress': self.compress,
+            'frames_per_chunk': self.frames_per_chunk,
+            'data_format': self.data_format,
+        }
+        with open(os.path.join(self.path, 'metadata.json'), 'w') as f:
+            json.dump(metadata, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:  # the output is incomplete, so it gets no metadata
+            self._stop()
+
+
+def read_model_output(path, start=None, stop=None):
+    """Read a store written by `ModelOutputWriter` or `save_model_output`.
+    Only the files (or tiff pages) holding the requested frames are read.
+
+    Args:
+        path: directory of the store
+        start: index of the first frame to read. Frames are counted across
+            the batch, so for 3D outputs frame `f` of batch `b` has the index
+            `b * frames + f`.
+        stop: index after the last frame to read
+
+    Returns:
+        numpy array with the original output shape if no range is given,
+        otherwise the frames in the range as (frames, x, y, channels) or
+        (frames, channels, x, y) for channels_first.
+    """
+    with open(os.path.join(path, 'metadata.json')) as f:
+        metadata = json.load(f)
+
+    shape = tuple(metadata['shape'])
+    frame_shape = tuple(metadata['frame_shape'])
+    channels = frame_shape[-1]
+    data_format = metadata['data_format']
+    num_frames = int(np.prod(shape)) // int(np.prod(frame_shape))
+
+    is_range = start is not None or stop is not None
+    start, stop, _ = slice(start, stop).indices(num_frames)
+    frames = np.zeros((max(stop - start, 0),) + frame_shape,
+                      dtype=np.dtype(metadata['dtype']))
+
+    if metadata['output_format'] == 'bigtiff':
+        with TiffFile(os.path.join(path, 'data.tif')) as tif:
+            for i in range(start, stop):
+                for c in range(channels):
+                    page = tif.pages[i * channels + c]
+                    frames[i - start, ..., c] = page.asarray()
+    else:
+        chunk_size = metadata['frames_per_chunk']
+        for chunk_index in range(start // chunk_size, -(-stop // chunk_size)):
+            name = os.path.join(path, 'chunk_{:06d}'.format(chunk_index))
+            if metadata['compress']:
+                with np.load(name + '.npz') as npz:
+                    chunk = npz['data']
+            else:
+                chunk = np.load(name + '.npy', mmap_mode='r')
+            first = chunk_index * chunk_size
+            lo, hi = max(start, first), min(stop, first + len(chunk))
+            frames[lo - start:hi - start] = chunk[lo - first:hi - first]
+
+    if data_format == 'channels_first':
+        frames = np.moveaxis(frames, -1, 1)
+    if is_range:
+        return frames
+
+    if data_format == 'channels_first':
+        if len(shape) == 5:
+            frames = frames.reshape((shape[0], shape[2]) + frames.shape[1:])
+            return np.moveaxis(frames, 2, 1)
+        return frames
+    return frames.reshape(shape)
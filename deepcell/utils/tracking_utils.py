@@ -37,6 +37,7 @@ import tempfile
 from io import BytesIO
 
 import numpy as np
+from skimage.measure import regionprops
 from tensorflow.python.keras import backend as K
 
 from deepcell.utils.misc_utils import sorted_nicely
@@ -236,3 +237,163 @@ def trks_stats(trks_file_name):
     print('Total number of unique tracks (cells) - ', total_tracks)
     print('Total number of divisions             - ', total_divisions)
     print('Average number of frames per track    - ', int(avg_num_frames_per_track))
+
+
+def _linear_weights(sizes, output_size):
+    """Find the bilinear interpolation taps of a batch of windows along one
+    axis, sampling pixel centers like `skimage.transform.resize`.
+    Samples beyond the edges of a window are blended with zeros.
+
+    Args:
+        sizes: array of the size of each window
+        output_size: size of the resized windows
+
+    Returns:
+        tuple: the indices and weights of the 2 pixels interpolated by each
+            output pixel, both of shape (len(sizes), output_size, 2)
+    """
+    sizes = np.asarray(sizes, dtype='int64')[:, np.newaxis, np.newaxis]
+    coords = (np.arange(output_size) + 0.5) * (sizes[..., 0] / output_size) - 0.5
+    lower = np.floor(coords)
+    upper_weight = coords - lower
+    indices = lower.astype('int64')[..., np.newaxis] + np.arange(2)
+    weights = np.stack([1 - upper_weight, upper_weight], axis=-1)
+    outside = (indices < 0) | (indices >= sizes)
+    weights[outside] = 0
+    indices[outside] = 0
+    return indices, weights
+
+
+def crop_and_resize(image, starts, sizes, output_size):
+    """Crop many windows out of an image and resize them to the same shape
+    with bilinear interpolation, all at once.
+
+    Windows may extend past the image, in which case they are implicitly
+    padded with zeros. Like `skimage.transform.resize` with
+    `mode='constant'` and `preserve_range=True`, each resized window is
+    clipped to the range of its original values.
+
+    Args:
+        image: channels_last image of shape (rows, cols, channels)
+        starts: (n, 2) array of the first row and column of each window
+        sizes: (n, 2) array of the number of rows and columns of each window
+        output_size: rows and columns of the resized windows
+
+    Returns:
+        numpy.array: resized windows of shape
+            (n, output_size, output_size, channels)
+    """
+    starts = np.asarray(starts, dtype='int64').reshape(-1, 2)
+    sizes = np.asarray(sizes, dtype='int64').reshape(-1, 2)
+    num_windows, channels = len(starts), image.shape[-1]
+    if num_windows == 0:
+        return np.zeros((0, output_size, output_size, channels), dtype=K.floatx())
+
+    # gather every window into a block of the size of the largest window
+    max_rows, max_cols = sizes.max(axis=0)
+    rows = starts[:, 0, np.newaxis] + np.arange(max_rows)
+    cols = starts[:, 1, np.newaxis] + np.arange(max_cols)
+    in_rows = np.arange(max_rows) < sizes[:, 0, np.newaxis]
+    in_cols = np.arange(max_cols) < sizes[:, 1, np.newaxis]
+    valid_rows = in_rows & (rows >= 0) & (rows < image.shape[0])
+    valid_cols = in_cols & (cols >= 0) & (cols < image.shape[1])
+
+    windows = image[np.clip(rows, 0, image.shape[0] - 1)[:, :, np.newaxis],
+                    np.clip(cols, 0, image.shape[1] - 1)[:, np.newaxis, :]]
+    is_valid = valid_rows[:, :, np.newaxis] & valid_cols[:, np.newaxis, :]
+    windows = np.where(is_valid[..., np.newaxis], windows, 0).astype(K.floatx())
+
+    in_window = (in_rows[:, :, np.newaxis] & in_cols[:, np.newaxis, :])[..., np.newaxis]
+    low = np.where(in_window, windows, np.inf).min(axis=(1, 2, 3))
+    high = np.where(in_window, windows, -np.inf).max(axis=(1, 2, 3))
+
+    # interpolate the rows, then the columns, of all windows at once
+    batch = np.arange(num_windows)[:, np.newaxis, np.newaxis]
+    for axis in (0, 1):
+        indices, weights = _linear_weights(sizes[:, axis], output_size)
+        windows = np.moveaxis(windows, axis + 1, 1)[batch, indices]
+        windows = np.sum(windows * weights[..., np.newaxis, np.newaxis], axis=2)
+        windows = np.moveaxis(windows, 1, axis + 1)
+    resized = windows
+
+    resized = np.clip(resized, low[:, None, None, None], high[:, None, None, None])
+    return resized.astype(K.floatx())
+
+
+def get_frame_features(X_frame, y_frame, labels, crop_dim=32,
+                       neighborhood_scale_size=10, neighborhood_true_size=100,
+                       X_future_frame=None, data_format=None):
+    """Compute the tracking features of many cells in a single frame.
+
+    The bounding boxes, centroids and regionprops of all cells are found in
+    one pass over the label image. The appearances are the bounding boxes of
+    the cells, and the neighborhoods are the windows of
+    `2 * neighborhood_true_size` pixels around the centroids, zero padded
+    past the image. Both are resized with `crop_and_resize`.
+
+    Args:
+        X_frame: image of the frame, (rows, cols, channels) or
+            (channels, rows, cols) for channels_first
+        y_frame: label image of the frame, with the same layout as `X_frame`
+        labels: list of the labels of the cells
+        crop_dim: size of the resized appearances
+        neighborhood_scale_size: the resized neighborhoods have
+            `2 * neighborhood_scale_size + 1` rows and columns
+        neighborhood_true_size: half size of the neighborhoods in the image
+        X_future_frame: image of the next frame, optional
+        data_format: `channels_first` or `channels_last`
+
+    Returns:
+        dict: the appearances, centroids, regionprops (area, perimeter and
+            eccentricity), neighborhoods and, if `X_future_frame` is given,
+            the future areas of each cell. Appearances are (n, channels,
+            rows, cols) for channels_first, all other images are channels_last.
+
+    Raises:
+        ValueError: a label is not in `y_frame`
+    """
+    if data_format is None:
+        data_format = K.image_data_format()
+
+    if data_format == 'channels_first':
+        X_frame = np.moveaxis(X_frame, 0, -1)
+        y_frame = np.moveaxis(y_frame, 0, -1)
+        if X_future_frame is not None:
+            X_future_frame = np.moveaxis(X_future_frame, 0, -1)
+
+    y_frame = np.squeeze(np.asarray(y_frame, dtype='int32'), axis=-1)
+    props = {prop.label: prop for prop in regionprops(y_frame)}
+
+    num_cells = len(labels)
+    bboxes = np.zeros((num_cells, 4), dtype='int64')
+    centroids = np.zeros((num_cells, 2))
+    rprops = np.zeros((num_cells, 3), dtype=K.floatx())
+    for i, cell_label in enumerate(labels):
+        if cell_label not in props:
+            raise ValueError('Label {} is not in the frame.'.format(cell_label))
+        prop = props[cell_label]
+        bboxes[i] = prop.bbox
+        centroids[i] = prop.centroid
+        rprops[i] = [prop.area, prop.perimeter, prop.eccentricity]
+
+    # Extract images from bounding boxes
+    appearances = crop_and_resize(X_frame, bboxes[:, :2],
+                                  bboxes[:, 2:] - bboxes[:, :2], crop_dim)
+    if data_format == 'channels_first':
+        appearances = np.moveaxis(appearances, -1, 1)
+
+    # Get the neighborhoods around the centroids
+    starts = centroids.astype('int64') - neighborhood_true_size
+    sizes = np.full((num_cells, 2), 2 * neighborhood_true_size)
+    neighborhood_dim = 2 * neighborhood_scale_size + 1
+
+    features = {
+        'appearances': appearances,
+        'centroids': centroids.astype(K.floatx()),
+        'regionprops': rprops,
+        'neighborhoods': crop_and_resize(X_frame, starts, sizes, neighborhood_dim)
+    }
+    if X_future_frame is not None:
+        features['future_areas'] = crop_and_resize(
+            X_future_frame, starts, sizes, neighborhood_dim)
+    return features
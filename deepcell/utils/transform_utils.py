@@ -267,6 +267,46 @@ def rotate_array_270(arr):
     return arr[tuple(slices)].transpose(axes_order)
 
 
+def flip_array(arr):
+    slices = [slice(None) for _ in range(arr.ndim - 1)] + [slice(None, None, -1)]
+    return arr[tuple(slices)]
+
+
+def get_dihedral_transforms(include_transpose=True):
+    """Get each of the 8 dihedral transforms of the last two axes of an array,
+    as pairs of (transform, inverse_transform) functions.
+    Every transform returns a strided view of the array, not a copy.
+
+    Args:
+        include_transpose: if False, only the 4 transforms that do not
+            swap the last two axes are returned (for non-square arrays).
+
+    Returns:
+        list of (transform, inverse_transform) tuples
+    """
+    rotations = [
+        (rotate_array_0, rotate_array_0),
+        (rotate_array_180, rotate_array_180),
+    ]
+    if include_transpose:
+        rotations.extend([
+            (rotate_array_90, rotate_array_270),
+            (rotate_array_270, rotate_array_90),
+        ])
+
+    def flip_then(rotate):
+        return lambda arr: rotate(flip_array(arr))
+
+    def then_flip(rotate):
+        return lambda arr: flip_array(rotate(arr))
+
+    transforms = []
+    for rotate, inverse in rotations:
+        transforms.append((rotate, inverse))
+        transforms.append((flip_then(rotate), then_flip(inverse)))
+    return transforms
+
+
 def to_categorical(y, num_classes=None):
     """Converts a class vector (integers) to binary class matrix.
     E.g. for use with categorical_crossentropy.
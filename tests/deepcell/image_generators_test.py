@@ -31,6 +31,11 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import gc
+import multiprocessing
+import os
+import pickle
+
 import numpy as np
 
 from tensorflow.python.keras.preprocessing.image import array_to_img
@@ -38,6 +43,7 @@ from tensorflow.python.keras.preprocessing.image import img_to_array
 from tensorflow.python.platform import test
 
 from deepcell import image_generators
+from deepcell.utils.data_utils import MemmapSubset
 
 
 def _generate_test_images():
@@ -208,6 +214,40 @@ class TestTransformMasks(test.TestCase):
             data_format='channels_first')
         self.assertEqual(mask_transform.shape, (5, classes, 10, 30, 30))
 
+    def test_transform_cache(self):
+        cache_dir = os.path.join(self.get_temp_dir(), 'transform_cache')
+        image_generators.set_transform_cache(cache_dir)
+        self.addCleanup(image_generators.set_transform_cache, None)
+
+        mask = np.random.randint(3, size=(5, 30, 30, 1))
+        expected = image_generators._transform_masks(
+            mask, 'watershed', distance_bins=4, erosion_width=1,
+            data_format='channels_last')
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+        # reused results are memory mapped and stored compactly
+        cached = image_generators._transform_masks(
+            mask, 'watershed', distance_bins=4, erosion_width=1,
+            data_format='channels_last')
+        self.assertIsInstance(cached, np.memmap)
+        self.assertEqual(cached.dtype, np.uint8)
+        self.assertAllEqual(cached, expected)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+        # kwargs and transforms are part of the key
+        image_generators._transform_masks(
+            mask, 'watershed', distance_bins=3, erosion_width=1,
+            data_format='channels_last')
+        image_generators._transform_masks(
+            mask, 'fgbg', data_format='channels_last')
+        self.assertEqual(len(os.listdir(cache_dir)), 3)
+
+        # least recently used results are evicted
+        image_generators.set_transform_cache(cache_dir, max_size=1)
+        image_generators._transform_masks(
+            mask, 'deepcell', data_format='channels_last')
+        self.assertEqual(len(os.listdir(cache_dir)), 0)
+
     def test_bad_mask(self):
         # test bad transform
         with self.assertRaises(ValueError):
@@ -235,6 +275,202 @@ class TestTransformMasks(test.TestCase):
             image_generators._transform_masks(mask, transform=None)
 
 
+class TestBatchTransforms(test.TestCase):
+
+    def test_apply_transforms(self):
+        for data_format in ('channels_last', 'channels_first'):
+            generator = image_generators.ImageFullyConvDataGenerator(
+                rotation_range=30.,
+                width_shift_range=0.1,
+                height_shift_range=3,
+                shear_range=10.,
+                zoom_range=0.2,
+                channel_shift_range=0.3,
+                fill_mode='reflect',
+                horizontal_flip=True,
+                vertical_flip=True,
+                data_format=data_format)
+
+            x = np.random.random((6, 17, 19, 2))
+            y = np.random.random((6, 17, 19, 3))
+            if data_format == 'channels_first':
+                x = np.moveaxis(x, -1, 1)
+                y = np.moveaxis(y, -1, 1)
+
+            params = image_generators._get_random_transforms(generator, 6, (17, 19))
+            batch_x, batch_y = image_generators._apply_transforms(
+                generator, x, params, y=y)
+
+            # each image matches `apply_transform` with the same parameters
+            for i in range(6):
+                transform = {k: None if v is None else v[i]
+                             for k, v in params.items()}
+                self.assertAllClose(batch_x[i], generator.apply_transform(
+                    x[i].astype('float32'), transform), atol=1e-5)
+                transform['channel_shift_intensity'] = None
+                self.assertAllClose(batch_y[i], generator.apply_transform(
+                    y[i].astype('float32'), transform), atol=1e-5)
+
+    def test_random_transform_batch(self):
+        generator = image_generators.MovieDataGenerator(
+            rotation_range=90.,
+            zoom_range=0.2,
+            horizontal_flip=True,
+            data_format='channels_last')
+
+        # x and y share the parameters of each frame
+        x = np.random.random((2, 3, 10, 12, 1))
+        batch_x, batch_y = image_generators._random_transform_batch(
+            generator, x, np.copy(x))
+        self.assertEqual(batch_x.shape, x.shape)
+        self.assertAllClose(batch_x, batch_y)
+
+        # a single parameter dict applies to every image
+        params = image_generators._repeat_transform(
+            {'theta': 90, 'flip_horizontal': True}, 4)
+        batch_x = image_generators._apply_transforms(
+            generator, x[0, 0:1].repeat(4, axis=0), params)
+        for i in range(1, 4):
+            self.assertAllClose(batch_x[i], batch_x[0])
+
+        # the batches share one thread pool
+        executor = image_generators._get_transform_executor()
+        image_generators._random_transform_batch(generator, x)
+        self.assertIs(image_generators._get_transform_executor(), executor)
+
+
+def _get_worker_batch(iterator, idx):
+    """Build batch `idx` of a pickled iterator in a worker process"""
+    return os.getpid(), iterator[idx]
+
+
+class TestSharedArrayIterator(test.TestCase):
+
+    def test_share_memory(self):
+        X = np.random.random((4, 12, 12, 2))
+        y = np.random.randint(3, size=(4, 12, 12, 1))
+        generator = image_generators.ImageFullyConvDataGenerator(
+            rotation_range=90., horizontal_flip=True,
+            data_format='channels_last')
+        iterator = generator.flow({'X': X, 'y': y}, batch_size=2,
+                                  transform='deepcell', shuffle=True)
+        expected_y = np.array(iterator.y)
+
+        temp_dir = self.get_temp_dir()
+        self.assertIs(iterator.share_memory(temp_dir), iterator)
+        self.assertIsInstance(iterator.x, np.memmap)
+        self.assertIsInstance(iterator.y, np.memmap)
+        self.assertAllClose(iterator.x, X)
+        self.assertAllEqual(iterator.y, expected_y)
+        self.assertIsNotNone(iterator.index_array)
+
+        # pickled iterators attach to the same files
+        worker = pickle.loads(pickle.dumps(iterator))
+        other_worker = pickle.loads(pickle.dumps(iterator))
+        self.assertIsInstance(worker.x, np.memmap)
+        self.assertEqual(worker.x.filename, iterator.x.filename)
+        self.assertAllEqual(worker.index_array, iterator.index_array)
+
+        # batches built in worker processes only depend on the batch index
+        worker._owner_pid = other_worker._owner_pid = -1
+        np.random.seed(0)
+        batch_x, batch_y = worker[1]
+        np.random.seed(1)
+        other_x, other_y = other_worker[1]
+        self.assertAllEqual(batch_x, other_x)
+        self.assertAllEqual(batch_y, other_y)
+        self.assertFalse(np.allclose(worker[0][0], worker[1][0]))
+
+        # and change between epochs
+        worker.on_epoch_end()
+        self.assertFalse(np.allclose(worker[1][0], batch_x))
+
+        # the default directory is removed with the iterator
+        iterator = generator.flow({'X': X, 'y': y}).share_memory()
+        shared_dir = iterator.shared_dir
+        self.assertTrue(os.path.isdir(shared_dir))
+        del iterator
+        gc.collect()
+        self.assertFalse(os.path.exists(shared_dir))
+
+    def test_worker_without_share_memory(self):
+        X = np.random.random((4, 12, 12, 2))
+        y = np.random.randint(3, size=(4, 12, 12, 1))
+        generator = image_generators.ImageFullyConvDataGenerator(
+            rotation_range=90., horizontal_flip=True,
+            data_format='channels_last')
+        iterator = generator.flow({'X': X, 'y': y}, batch_size=2,
+                                  transform='deepcell', shuffle=True)
+        self.assertIsNone(iterator.index_array)
+
+        # the workers shuffle the first epoch themselves, in the same order
+        pool = multiprocessing.Pool(2)
+        try:
+            results = [pool.apply(_get_worker_batch, (iterator, 1))
+                       for _ in range(2)]
+        finally:
+            pool.close()
+            pool.join()
+
+        for pid, (batch_x, batch_y) in results:
+            self.assertNotEqual(pid, iterator._owner_pid)
+            self.assertEqual(batch_x.shape, (2, 12, 12, 2))
+            self.assertAllEqual(batch_x, results[0][1][0])
+            self.assertAllEqual(batch_y, results[0][1][1])
+
+    def test_to_dataset(self):
+        X = np.random.random((5, 12, 12, 2)).astype('float32')
+        y = np.random.randint(3, size=(5, 12, 12, 1))
+        generator = image_generators.ImageFullyConvDataGenerator(
+            data_format='channels_last')
+        dataset = generator.flow({'X': X, 'y': y}, batch_size=2, skip=1,
+                                 transform='deepcell', shuffle=False,
+                                 as_dataset=True)
+        batch = dataset.make_one_shot_iterator().get_next()
+        self.assertEqual(batch[0].shape.as_list(), [None, 12, 12, 2])
+        self.assertEqual(len(batch[1]), 2)
+
+        with self.test_session() as sess:
+            # the dataset repeats, keeping the last partial batch
+            for start, stop in [(0, 2), (2, 4), (4, 5), (0, 2)]:
+                batch_x, batch_y = sess.run(batch)
+                self.assertAllClose(batch_x, X[start:stop])
+                self.assertEqual(batch_y[0].shape[:-1], (stop - start, 12, 12))
+                self.assertAllEqual(batch_y[0], batch_y[1])
+
+    def test_to_dataset_seeded(self):
+        X = np.random.random((6, 12, 12, 2)).astype('float32')
+        y = np.random.randint(3, size=(6, 12, 12, 1))
+        generator = image_generators.ImageFullyConvDataGenerator(
+            rotation_range=90., horizontal_flip=True,
+            data_format='channels_last')
+
+        # batches built by parallel map calls only depend on their position
+        results = []
+        for num_parallel_calls in (1, 4):
+            iterator = generator.flow({'X': X, 'y': y}, batch_size=2,
+                                      transform='deepcell', seed=1)
+            self.assertEqual(len(iterator), 3)
+            dataset = iterator.to_dataset(num_parallel_calls=num_parallel_calls)
+            batch = dataset.make_one_shot_iterator().get_next()
+            with self.test_session() as sess:
+                results.append([sess.run(batch) for _ in range(6)])
+
+        for (x_1, y_1), (x_2, y_2) in zip(*results):
+            self.assertAllEqual(x_1, x_2)
+            self.assertAllEqual(y_1, y_2)
+        # and the passes over the data are augmented differently
+        self.assertFalse(np.allclose(np.sort(results[0][0][0], axis=None),
+                                     np.sort(results[0][3][0], axis=None)))
+
+        # building a batch leaves the global random state alone
+        np.random.seed(0)
+        expected = np.random.random()
+        np.random.seed(0)
+        iterator._get_seeded_batch(np.arange(2), [1, 0, 0])
+        self.assertEqual(np.random.random(), expected)
+
+
 class TestSampleDataGenerator(test.TestCase):
 
     def test_sample_data_generator(self):
@@ -348,6 +584,67 @@ class TestSampleDataGenerator(test.TestCase):
                 self.assertEqual(x.shape[1:], (x.shape[1], 2 * win_x + 1, 2 * win_y + 1))
                 break
 
+    def test_sample_data_generator_no_augmentation(self):
+        img_w, img_h = 21, 21
+        win_x, win_y = 2, 3
+        X = np.random.random((3, img_w, img_h, 2))
+        y = np.random.randint(2, size=(3, img_w, img_h, 1))
+
+        for data_format in ('channels_last', 'channels_first'):
+            if data_format == 'channels_first':
+                train_dict = {'X': np.moveaxis(X, -1, 1),
+                              'y': np.moveaxis(y, -1, 1)}
+            else:
+                train_dict = {'X': X, 'y': y}
+
+            generator = image_generators.SampleDataGenerator(
+                rescale=2., data_format=data_format)
+            iterator = generator.flow(train_dict, window_size=(win_x, win_y),
+                                      batch_size=16, shuffle=False)
+
+            # all windows are gathered at once without augmentation
+            index_array = np.arange(16)
+            batch_x, _ = iterator._get_batches_of_transformed_samples(index_array)
+            expected = np.stack([
+                iterator._sample_image(iterator.batch[j],
+                                       iterator.pixels_x[j],
+                                       iterator.pixels_y[j])
+                for j in index_array])
+            self.assertEqual(batch_x.dtype, np.float32)
+            self.assertAllClose(batch_x, expected * 2)
+
+    def test_sample_data_generator_compact(self):
+        img_w, img_h = 21, 21
+        win_x, win_y = 2, 3
+        X = np.random.randint(256, size=(3, img_w, img_h, 2)).astype('uint8')
+        y = np.random.randint(3, size=(3, img_w, img_h, 1))
+        train_dict = {'X': X, 'y': y}
+
+        generator = image_generators.SampleDataGenerator(
+            rescale=1. / 255, data_format='channels_last')
+        kwargs = {'window_size': (win_x, win_y), 'batch_size': 16,
+                  'shuffle': False, 'seed': 1}
+        np.random.seed(1)
+        iterator = generator.flow(train_dict, **kwargs)
+        np.random.seed(1)
+        compact_iterator = generator.flow(train_dict, compact=True, **kwargs)
+
+        # X and y are stored in their compact dtypes
+        self.assertEqual(compact_iterator.x.dtype, np.uint8)
+        self.assertEqual(compact_iterator.y.dtype, np.uint8)
+        self.assertEqual(compact_iterator.y.ndim, 1)
+
+        # batches match those of the floatx iterator
+        index_array = np.arange(16)
+        batch_x, batch_y = iterator._get_batches_of_transformed_samples(
+            index_array)
+        compact_x, compact_y = \
+            compact_iterator._get_batches_of_transformed_samples(index_array)
+        self.assertEqual(compact_x.dtype, np.float32)
+        self.assertAllClose(compact_x, batch_x)
+        self.assertEqual(compact_y.dtype, batch_y.dtype)
+        self.assertAllEqual(compact_y, batch_y)
+
     def test_sample_data_generator_invalid_data(self):
         generator = image_generators.SampleDataGenerator(
             featurewise_center=True,
@@ -528,6 +825,37 @@ class TestSampleMovieDataGenerator(test.TestCase):
                 self.assertEqual(x.shape[1:], shape)
                 break
 
+    def test_sample_movie_data_generator_no_augmentation(self):
+        frames, img_w, img_h = 7, 21, 21
+        win_x, win_y, win_z = 2, 3, 1
+        X = np.random.random((3, frames, img_w, img_h, 2))
+        y = np.random.randint(2, size=(3, frames, img_w, img_h, 1))
+
+        for data_format in ('channels_last', 'channels_first'):
+            if data_format == 'channels_first':
+                train_dict = {'X': np.moveaxis(X, -1, 1),
+                              'y': np.moveaxis(y, -1, 1)}
+            else:
+                train_dict = {'X': X, 'y': y}
+
+            generator = image_generators.SampleMovieDataGenerator(
+                rescale=2., data_format=data_format)
+            iterator = generator.flow(train_dict,
+                                      window_size=(win_x, win_y, win_z),
+                                      batch_size=16, shuffle=False)
+
+            # all windows are gathered at once without augmentation
+            index_array = np.arange(16)
+            batch_x, _ = iterator._get_batches_of_transformed_samples(index_array)
+            expected = np.stack([
+                iterator._sample_image(iterator.batch[j],
+                                       iterator.pixels_z[j],
+                                       iterator.pixels_x[j],
+                                       iterator.pixels_y[j])
+                for j in index_array])
+            self.assertEqual(batch_x.dtype, np.float32)
+            self.assertAllClose(batch_x, expected * 2)
+
     def test_sample_movie_data_generator_invalid_data(self):
         generator = image_generators.SampleMovieDataGenerator(
             featurewise_center=True,
@@ -682,6 +1010,42 @@ class TestFullyConvDataGenerator(test.TestCase):
                 self.assertEqual(y[-1].shape[1:], y_shape[1:])
                 break
 
+    def test_fully_conv_data_generator_compact(self):
+        X = np.random.randint(256, size=(4, 12, 12, 2)).astype('uint8')
+        y = np.random.randint(3, size=(4, 12, 12, 1))
+
+        for data_format in ('channels_last', 'channels_first'):
+            if data_format == 'channels_first':
+                train_dict = {'X': np.moveaxis(X, -1, 1),
+                              'y': np.moveaxis(y, -1, 1)}
+            else:
+                train_dict = {'X': X, 'y': y}
+
+            generator = image_generators.ImageFullyConvDataGenerator(
+                rescale=1. / 255, data_format=data_format)
+            iterator = generator.flow(train_dict, transform='deepcell',
+                                      shuffle=False)
+            compact_iterator = generator.flow(train_dict, transform='deepcell',
+                                              shuffle=False, compact=True)
+
+            # one-hot masks are stored as class maps
+            self.assertEqual(compact_iterator.x.dtype, np.uint8)
+            self.assertEqual(compact_iterator.y.dtype, np.uint8)
+            self.assertEqual(compact_iterator.y.ndim, 3)
+
+            index_array = np.arange(4)
+            batch_x, batch_y = iterator._get_batches_of_transformed_samples(
+                index_array)
+            compact_x, compact_y = \
+                compact_iterator._get_batches_of_transformed_samples(index_array)
+            self.assertEqual(compact_x.dtype, np.float32)
+            self.assertEqual(compact_y.dtype, np.float32)
+            self.assertAllClose(compact_x, batch_x)
+            self.assertAllEqual(compact_y, batch_y)
+            channel_axis = 1 if data_format == 'channels_first' else -1
+            self.assertEqual(compact_iterator.num_classes,
+                             batch_y.shape[channel_axis])
+
     def test_fully_conv_data_generator_invalid_data(self):
         generator = image_generators.ImageFullyConvDataGenerator(
             featurewise_center=True,
@@ -915,6 +1279,67 @@ class TestMovieDataGenerator(test.TestCase):
                 self.assertEqual(y[-1].shape[1:], batch_y_shape)
                 break
 
+    def test_movie_data_generator_compact(self):
+        X = np.random.randint(256, size=(3, 6, 10, 10, 1)).astype('uint8')
+        y = np.random.randint(3, size=(3, 6, 10, 10, 1))
+
+        for data_format in ('channels_last', 'channels_first'):
+            if data_format == 'channels_first':
+                train_dict = {'X': np.moveaxis(X, -1, 1),
+                              'y': np.moveaxis(y, -1, 1)}
+            else:
+                train_dict = {'X': X, 'y': y}
+
+            generator = image_generators.MovieDataGenerator(
+                rescale=1. / 255, data_format=data_format)
+            iterator = generator.flow(train_dict, transform='deepcell',
+                                      frames_per_batch=3, shuffle=False)
+            compact_iterator = generator.flow(train_dict, transform='deepcell',
+                                              frames_per_batch=3,
+                                              shuffle=False, compact=True)
+            self.assertEqual(compact_iterator.x.dtype, np.uint8)
+            self.assertEqual(compact_iterator.y.ndim, 4)
+
+            # the same frames are sampled from both iterators
+            index_array = np.arange(3)
+            np.random.seed(1)
+            batch_x, batch_y = iterator._get_batches_of_transformed_samples(
+                index_array)
+            np.random.seed(1)
+            compact_x, compact_y = \
+                compact_iterator._get_batches_of_transformed_samples(index_array)
+            self.assertEqual(compact_x.dtype, np.float32)
+            self.assertEqual(compact_y.dtype, np.float32)
+            self.assertAllClose(compact_x, batch_x)
+            self.assertAllEqual(compact_y, batch_y)
+
+    def test_movie_data_generator_memmap(self):
+        X = np.random.random((4, 6, 10, 10, 1)).astype('float32')
+        y = np.random.randint(3, size=(4, 6, 10, 10, 1))
+        temp_dir = self.get_temp_dir()
+        np.save(os.path.join(temp_dir, 'X.npy'), X)
+        X_mmap = np.load(os.path.join(temp_dir, 'X.npy'), mmap_mode='r')
+        index = np.array([3, 1, 2])
+        lazy_dict = {'X': MemmapSubset(X_mmap, index), 'y': y[index]}
+        train_dict = {'X': X[index], 'y': y[index]}
+
+        generator = image_generators.MovieDataGenerator(
+            data_format='channels_last')
+        iterator = generator.flow(train_dict, frames_per_batch=3)
+        lazy_iterator = generator.flow(lazy_dict, frames_per_batch=3)
+        self.assertIs(lazy_iterator.x, lazy_dict['X'])
+
+        index_array = np.array([2, 0])
+        np.random.seed(1)
+        batch_x, batch_y = iterator._get_batches_of_transformed_samples(
+            index_array)
+        np.random.seed(1)
+        lazy_x, lazy_y = lazy_iterator._get_batches_of_transformed_samples(
+            index_array)
+        self.assertEqual(lazy_x.dtype, np.float32)
+        self.assertAllEqual(lazy_x, batch_x)
+        self.assertAllEqual(lazy_y, batch_y)
+
     def test_movie_data_generator_invalid_data(self):
         generator = image_generators.MovieDataGenerator(
             featurewise_center=True,
@@ -1161,6 +1586,210 @@ class TestSiamsesDataGenerator(test.TestCase):
             #         shuffle=True):
             #     break
 
+    def test_siamese_track_ids(self):
+        frames = 6
+        y = np.zeros((2, frames, 12, 12, 1), dtype='int32')
+        y[0, :, 0:3, 0:3] = 1  # present in every frame
+        y[0, :4, 5:8, 5:8] = 2  # divides into 3 and 4
+        y[0, 4:, 4:6, 4:6] = 3
+        y[0, 2:, 8:10, 8:10] = 4
+        y[0, :2, 10:12, 0:2] = 5  # too short to be a track
+        y[1] = 0  # only background
+        daughters = [{2: [3, 4], 4: [5]}, {}]
+
+        for data_format in ('channels_last', 'channels_first'):
+            labels = y if data_format == 'channels_last' else np.moveaxis(y, -1, 1)
+            train_dict = {'X': np.random.random(labels.shape),
+                          'y': labels, 'daughters': daughters}
+            generator = image_generators.SiameseDataGenerator(
+                data_format=data_format)
+            iterator = generator.flow(train_dict, features=['distance'])
+
+            # the second movie has a single id and is removed
+            self.assertEqual(iterator.y.shape[0], 1)
+            # short tracks are removed from the labels
+            self.assertNotIn(5, iterator.y)
+
+            self.assertEqual(len(iterator.track_ids), 3)
+            self.assertEqual(iterator.reverse_track_ids, {0: {1: 0, 2: 1, 4: 2}})
+            self.assertEqual(iterator.tracks_with_divisions, [])
+
+            track = iterator.track_ids[1]
+            self.assertEqual(track['label'], 2)
+            self.assertAllEqual(track['frames'], [0, 1, 2, 3])
+            # daughter 3 is only present in 2 frames
+            self.assertEqual(track['daughters'], [])
+            self.assertAllEqual(track['different'][0], [1])
+            self.assertAllEqual(track['different'][2], [1, 4])
+
+            track = iterator.track_ids[2]
+            self.assertAllEqual(track['frames'], [2, 3, 4, 5])
+            self.assertAllEqual(track['different'][4], [1])
+
+    def test_siamese_pair_sampler(self):
+        frames = 8
+        y = np.zeros((1, frames, 16, 16, 1), dtype='int32')
+        y[0, :, 0:3, 0:3] = 1  # present in every frame
+        y[0, :4, 5:8, 5:8] = 2  # divides into 3 and 4
+        y[0, 4:, 4:6, 4:6] = 3
+        y[0, 4:, 8:10, 8:10] = 4
+        train_dict = {'X': np.random.random(y.shape), 'y': y,
+                      'daughters': [{2: [3, 4]}]}
+
+        generator = image_generators.SiameseDataGenerator(
+            rotation_range=90, horizontal_flip=True,
+            data_format='channels_last')
+        iterator = generator.flow(train_dict, batch_size=4, crop_dim=8,
+                                  min_track_length=3,
+                                  neighborhood_scale_size=4,
+                                  neighborhood_true_size=8,
+                                  features=['appearance', 'distance',
+                                            'neighborhood', 'regionprop'])
+        self.assertEqual(iterator.tracks_with_divisions, [1])
+
+        tracks_1, frames_1, tracks_2, frames_2, types = \
+            iterator._sample_pairs(np.arange(len(iterator.track_ids)).repeat(50))
+        self.assertEqual(frames_1.shape, (200, 3))
+        self.assertAllEqual(np.unique(types), [0, 1, 2])
+        for t1, f1, t2, f2, label in zip(tracks_1, frames_1, tracks_2, frames_2, types):
+            track_id = iterator.track_ids[t1]
+            self.assertTrue(np.all(np.isin(f1, track_id['frames'])))
+            self.assertTrue(np.all(np.diff(f1) >= 0))
+            if label == 2:
+                self.assertEqual(t1, 1)
+                self.assertIn(t2, [2, 3])
+                self.assertAllEqual(f1, [1, 2, 3])
+                self.assertEqual(f2, 4)
+            else:
+                # the next frame of the track is compared
+                next_frames = track_id['frames'][track_id['frames'] > f1[-1]]
+                self.assertEqual(f2, next_frames[0])
+                if label == 1:
+                    self.assertEqual(t2, t1)
+                else:
+                    label_2 = iterator.track_ids[t2]['label']
+                    self.assertIn(label_2, track_id['different'][f2])
+
+        batch_x, batch_y = next(iterator)
+        self.assertEqual(batch_x[0].shape, (4, 3, 8, 8, 1))
+        self.assertEqual(batch_x[1].shape, (4, 1, 8, 8, 1))
+        self.assertEqual(batch_x[2].shape, (4, 3, 2))
+        self.assertEqual(batch_x[3].shape, (4, 1, 2))
+        self.assertEqual(batch_x[4].shape, (4, 3, 9, 9, 1))
+        self.assertEqual(batch_x[5].shape, (4, 1, 9, 9, 1))
+        self.assertAllEqual(batch_x[2][:, 0], np.zeros((4, 2)))
+        self.assertAllEqual(batch_y.sum(axis=1), np.ones(4))
+
+    def test_siamese_features(self):
+        train_dict = {
+            'X': np.random.random((2, 5, 30, 30, 1)),
+            'y': np.zeros((2, 5, 30, 30, 1), dtype='int32'),
+            'daughters': [{}, {}]
+        }
+        for label, (r, c) in enumerate([(2, 2), (2, 15), (15, 5), (20, 20)]):
+            train_dict['y'][:, :, r:r + 6, c:c + 6] = label + 1
+
+        features = ['appearance', 'distance', 'neighborhood', 'regionprop']
+        feature_names = ['all_appearances', 'all_centroids', 'all_regionprops',
+                         'all_neighborhoods', 'all_future_areas']
+        generator = image_generators.SiameseDataGenerator(
+            data_format='channels_last')
+        kwargs = {'features': features, 'crop_dim': 8,
+                  'neighborhood_scale_size': 4, 'neighborhood_true_size': 8}
+        iterator = generator.flow(train_dict, num_workers=1, **kwargs)
+
+        # features are computed in this process by default
+        with test.mock.patch.object(image_generators.multiprocessing, 'Pool',
+                                    side_effect=AssertionError('forked')):
+            default_iterator = generator.flow(train_dict, **kwargs)
+        for name in feature_names:
+            self.assertAllEqual(getattr(default_iterator, name),
+                                getattr(iterator, name))
+
+        # features computed in worker processes are identical
+        parallel_iterator = generator.flow(train_dict, num_workers=2, **kwargs)
+        for name in feature_names:
+            self.assertAllEqual(getattr(parallel_iterator, name),
+                                getattr(iterator, name))
+
+        # features are cached on disk and memory mapped when reused
+        cache_dir = os.path.join(self.get_temp_dir(), 'feature_cache')
+        image_generators.set_transform_cache(cache_dir)
+        self.addCleanup(image_generators.set_transform_cache, None)
+        generator.flow(train_dict, num_workers=1, **kwargs)
+        self.assertEqual(len(os.listdir(cache_dir)), len(feature_names))
+
+        cached_iterator = generator.flow(train_dict, num_workers=1, **kwargs)
+        for name in feature_names:
+            self.assertIsInstance(getattr(cached_iterator, name), np.memmap)
+            self.assertAllEqual(getattr(cached_iterator, name),
+                                getattr(iterator, name))
+
+        # the sizes of the features are part of the key
+        kwargs['crop_dim'] = 6
+        generator.flow(train_dict, num_workers=1, **kwargs)
+        self.assertEqual(len(os.listdir(cache_dir)), 2 * len(feature_names))
+
+    def test_siamese_lazy_features(self):
+        train_dict = {
+            'X': np.random.random((2, 5, 30, 30, 1)),
+            'y': np.zeros((2, 5, 30, 30, 1), dtype='int32'),
+            'daughters': [{}, {}]
+        }
+        for label, (r, c) in enumerate([(2, 2), (2, 15), (15, 5), (20, 20)]):
+            train_dict['y'][:, :, r:r + 6, c:c + 6] = label + 1
+        train_dict['y'][:, 4, 20:26, 20:26] = 0  # a track with a missing frame
+
+        features = ['appearance', 'distance', 'neighborhood', 'regionprop']
+        kwargs = {'features': features, 'crop_dim': 8, 'min_track_length': 2,
+                  'neighborhood_scale_size': 4, 'neighborhood_true_size': 8}
+
+        for data_format in ('channels_last', 'channels_first'):
+            if data_format == 'channels_first':
+                data = {'X': np.moveaxis(train_dict['X'], -1, 1),
+                        'y': np.moveaxis(train_dict['y'], -1, 1),
+                        'daughters': train_dict['daughters']}
+            else:
+                data = train_dict
+            generator = image_generators.SiameseDataGenerator(
+                data_format=data_format)
+            iterator = generator.flow(data, num_workers=1, **kwargs)
+            lazy_iterator = generator.flow(data, feature_cache_size=2 ** 20,
+                                           **kwargs)
+            self.assertFalse(hasattr(lazy_iterator, 'all_appearances'))
+
+            # a miss computes every cell of the frame in one pass
+            with test.mock.patch.object(
+                    lazy_iterator, '_get_features',
+                    wraps=lazy_iterator._get_features) as get_features:
+                lazy_iterator._fetch_centroids(0, [0])
+                lazy_iterator._fetch_centroids(1, [0])
+            self.assertEqual(get_features.call_count, 1)
+            self.assertEqual(len(lazy_iterator._feature_cache), 4)
+
+            # lazy features match the precomputed features
+            fetches = ['_fetch_appearances', '_fetch_centroids',
+                       '_fetch_neighborhoods', '_fetch_regionprops']
+            for track, track_id in iterator.track_ids.items():
+                frames = track_id['frames']
+                for fetch in fetches:
+                    self.assertAllClose(getattr(lazy_iterator, fetch)(track, frames),
+                                        getattr(iterator, fetch)(track, frames))
+                self.assertAllClose(
+                    lazy_iterator._fetch_future_areas(track, frames[:-1]),
+                    iterator._fetch_future_areas(track, frames[:-1]))
+
+            # cached features are bounded by the cache size
+            size = lazy_iterator._feature_cache_bytes
+            num_cached = len(lazy_iterator._feature_cache)
+            self.assertEqual(num_cached, 2 * (4 * 5 - 1))  # one per cell-frame
+            lazy_iterator = generator.flow(data, feature_cache_size=size // 2,
+                                           **kwargs)
+            for track, track_id in iterator.track_ids.items():
+                lazy_iterator._fetch_centroids(track, track_id['frames'])
+            self.assertLessEqual(lazy_iterator._feature_cache_bytes, size // 2)
+            self.assertLess(len(lazy_iterator._feature_cache), num_cached)
+
     def test_siamese_data_generator_invalid_data(self):
         generator = image_generators.SiameseDataGenerator(
             featurewise_center=True,
@@ -28,6 +28,7 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import division
 
+import numpy as np
 from tensorflow.python.framework import test_util as tf_test_util
 from tensorflow.python.platform import test
 
@@ -52,6 +53,14 @@ class LocationTest(test.TestCase):
                         'data_format': 'channels_first'},
                 custom_objects={'Location2D': layers.Location2D},
                 input_shape=(3, 4, 5, 6))
+            # test dynamic spatial dimensions
+            testing_utils.layer_test(
+                layers.Location2D,
+                kwargs={'in_shape': (None, None, 4),
+                        'data_format': 'channels_last'},
+                custom_objects={'Location2D': layers.Location2D},
+                input_shape=(3, None, None, 4),
+                input_data=np.random.random((3, 5, 6, 4)))
 
     @tf_test_util.run_in_graph_and_eager_modes()
     def test_location_3d(self):
@@ -68,3 +77,11 @@ class LocationTest(test.TestCase):
                         'data_format': 'channels_first'},
                 custom_objects={'Location3D': layers.Location3D},
                 input_shape=(3, 4, 11, 12, 10))
+            # test dynamic spatial dimensions
+            testing_utils.layer_test(
+                layers.Location3D,
+                kwargs={'in_shape': (11, None, None, 4),
+                        'data_format': 'channels_last'},
+                custom_objects={'Location3D': layers.Location3D},
+                input_shape=(3, 11, None, None, 4),
+                input_data=np.random.random((3, 11, 12, 10, 4)))
@@ -0,0 +1,164 @@
+# Copyright 2016-2019 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/deepcell-tf/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Tests for postprocessing functions"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import numpy as np
+from tensorflow.python.platform import test
+
+from deepcell import postprocessing
+
+
+def _get_mask(ndim=2):
+    shape = (5, 32, 32) if ndim == 3 else (32, 32)
+    mask = np.zeros(shape, dtype='int32')
+    mask[..., 2:13, 2:13] = 1
+    mask[..., 18:31, 16:29] = 2
+    return mask
+
+
+def _get_deepcell_output(mask):
+    interior = np.zeros(mask.shape, dtype='bool')
+    for i in np.unique(mask[mask > 0]):
+        cell = mask == i
+        pad = [slice(None)] * (mask.ndim - 2)
+        rows, cols = np.where(cell.reshape(-1, *mask.shape[-2:]).any(axis=0))
+        inner = tuple(pad + [slice(rows.min() + 1, rows.max()),
+                             slice(cols.min() + 1, cols.max())])
+        interior[inner] = True
+    output = np.zeros(mask.shape + (4,), dtype='float32')
+    output[..., 3] = mask == 0
+    output[..., 2] = interior
+    output[..., 1] = np.logical_and(mask > 0, ~interior)
+    return output
+
+
+def _get_watershed_output(mask, bins=4):
+    output = np.zeros(mask.shape + (bins,), dtype='float32')
+    output[..., 0] = mask == 0
+    for i in np.unique(mask[mask > 0]):
+        cell = mask == i
+        rows, cols = np.where(cell.reshape(-1, *mask.shape[-2:]).any(axis=0))
+        row_dist = np.minimum(np.arange(mask.shape[-2]) - rows.min(),
+                              rows.max() - np.arange(mask.shape[-2]))
+        col_dist = np.minimum(np.arange(mask.shape[-1]) - cols.min(),
+                              cols.max() - np.arange(mask.shape[-1]))
+        dist = np.broadcast_to(np.minimum.outer(row_dist, col_dist), mask.shape)
+        binned = np.clip(dist * bins // (dist.max() + 1), 0, bins - 2) + 1
+        for b in range(1, bins):
+            output[..., b] += np.logical_and(cell, binned == b)
+        # cell centers are most confident in the middle of the cell
+        center = dist / dist.max()
+        if mask.ndim == 3:
+            z = np.arange(mask.shape[0]) - mask.shape[0] // 2
+            center = center * (1 - np.abs(z) / mask.shape[0])[:, None, None]
+        output[..., -1] += cell * 0.1 * center
+    return output
+
+
+class PostprocessingTest(test.TestCase):
+
+    def test_deepcell_frame_to_labels(self):
+        mask = _get_mask()
+        labels = postprocessing.deepcell_frame_to_labels(
+            _get_deepcell_output(mask))
+        self.assertEqual(labels.shape, mask.shape)
+        self.assertEqual(labels.dtype, np.dtype('int32'))
+        self.assertEqual(len(np.unique(labels[labels > 0])), 2)
+        self.assertAllEqual(labels > 0, mask > 0)
+
+        # small objects are removed
+        labels = postprocessing.deepcell_frame_to_labels(
+            _get_deepcell_output(mask), min_size=90)
+        self.assertEqual(len(np.unique(labels[labels > 0])), 1)
+
+    def test_watershed_frame_to_labels(self):
+        mask = _get_mask()
+        labels = postprocessing.watershed_frame_to_labels(
+            _get_watershed_output(mask), min_distance=3)
+        self.assertEqual(labels.shape, mask.shape)
+        self.assertEqual(len(np.unique(labels[labels > 0])), 2)
+        self.assertAllEqual(labels > 0, mask > 0)
+
+        # seed with connected regions of the last distance bin
+        labels = postprocessing.watershed_frame_to_labels(
+            _get_watershed_output(mask), min_distance=None)
+        self.assertEqual(len(np.unique(labels[labels > 0])), 2)
+
+    def test_deepcell_to_labels(self):
+        mask = _get_mask()
+        outputs = np.stack([_get_deepcell_output(mask)] * 3)
+        for num_workers in (1, 2):
+            labels = postprocessing.deepcell_to_labels_2d(
+                outputs, data_format='channels_last', num_workers=num_workers)
+            self.assertEqual(labels.shape, (3, 32, 32, 1))
+            for frame in labels:
+                self.assertEqual(len(np.unique(frame[frame > 0])), 2)
+
+        labels = postprocessing.deepcell_to_labels_2d(
+            np.moveaxis(outputs, -1, 1), data_format='channels_first')
+        self.assertEqual(labels.shape, (3, 1, 32, 32))
+
+        mask = _get_mask(ndim=3)
+        outputs = np.stack([_get_deepcell_output(mask)] * 2)
+        labels = postprocessing.deepcell_to_labels_3d(
+            outputs, data_format='channels_last', num_workers=2)
+        self.assertEqual(labels.shape, (2, 5, 32, 32, 1))
+        for volume in labels:
+            self.assertEqual(len(np.unique(volume[volume > 0])), 2)
+
+        with self.assertRaises(ValueError):
+            postprocessing.deepcell_to_labels_3d(outputs[0])
+
+    def test_watershed_to_labels(self):
+        mask = _get_mask()
+        outputs = np.stack([_get_watershed_output(mask)] * 3)
+        for num_workers in (1, 2):
+            labels = postprocessing.watershed_to_labels_2d(
+                outputs, min_distance=3, data_format='channels_last',
+                num_workers=num_workers)
+            self.assertEqual(labels.shape, (3, 32, 32, 1))
+            for frame in labels:
+                self.assertEqual(len(np.unique(frame[frame > 0])), 2)
+
+        mask = _get_mask(ndim=3)
+        outputs = np.stack([_get_watershed_output(mask)] * 2)
+        labels = postprocessing.watershed_to_labels_3d(
+            outputs, min_distance=3, data_format='channels_last',
+            num_workers=2)
+        self.assertEqual(labels.shape, (2, 5, 32, 32, 1))
+        for volume in labels:
+            self.assertEqual(len(np.unique(volume[volume > 0])), 2)
+
+        with self.assertRaises(ValueError):
+            postprocessing.watershed_to_labels_2d(outputs)
+
+
+if __name__ == '__main__':
+    test.main()
@@ -29,7 +29,11 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
+import threading
+
 import numpy as np
+from skimage.external import tifffile as tiff
 
 from tensorflow.python import keras
 from tensorflow.python.platform import test
@@ -39,8 +43,176 @@ from deepcell import model_zoo
 from deepcell import running
 
 
+class _CountingModel(object):
+    """Record the batch sizes passed to `model.predict`"""
+
+    def __init__(self, model):
+        self.model = model
+        self.batch_sizes = []
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def predict(self, x, **kwargs):
+        self.batch_sizes.append(len(x))
+        return self.model.predict(x, **kwargs)
+
+
 class RunningTests(test.TestCase):
 
+    def test_model_cache(self):
+        built = []
+
+        def model_fn(input_shape, n_features=1):
+            built.append(input_shape)
+            model = keras.models.Sequential()
+            model.add(keras.layers.Dense(n_features, input_shape=input_shape))
+            return model
+
+        cache = running.ModelCache(max_size=2)
+
+        # the same arguments should return the cached model
+        with cache.get(model_fn, (8,), n_features=2) as model:
+            with cache.get(model_fn, (8,), n_features=2) as same_model:
+                self.assertIs(same_model, model)
+            self.assertEqual(len(built), 1)
+            # the model is used in its own graph and session
+            self.assertIs(model.outputs[0].graph,
+                          keras.backend.get_session().graph)
+            self.assertEqual(model.predict(np.zeros((1, 8))).shape, (1, 2))
+
+        # different arguments should build a new model
+        with cache.get(model_fn, (8,), n_features=3) as other:
+            self.assertIsNot(other, model)
+        self.assertEqual(len(built), 2)
+
+        # the least recently used model should be evicted and its session
+        # closed, but not while it is in use
+        with cache.get(model_fn, (8,), n_features=2) as model:
+            with cache.get(model_fn, (4,), n_features=2):
+                with cache.get(model_fn, (2,), n_features=2):
+                    session = keras.backend.get_session()
+                    self.assertEqual(len(cache), 3)
+                    self.assertEqual(model.predict(np.zeros((1, 8))).shape,
+                                     (1, 2))
+                self.assertTrue(session._closed)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(len(built), 4)
+        with cache.get(model_fn, (2,), n_features=2):
+            pass
+        self.assertEqual(len(built), 5)
+
+        # models are keyed by their weights file
+        weights = []
+        for k in range(2):
+            with cache.get(model_fn, (8,), n_features=2) as model:
+                model.set_weights([np.full(w.shape, k, dtype=w.dtype)
+                                   for w in model.get_weights()])
+                path = os.path.join(self.get_temp_dir(),
+                                    'cache_weights_{}.h5'.format(k))
+                model.save_weights(path)
+                weights.append(path)
+
+        with cache.get(model_fn, (8,), weights[0], n_features=2) as first:
+            with cache.get(model_fn, (8,), weights[1], n_features=2) as second:
+                self.assertIsNot(first, second)
+                self.assertAllEqual(second.get_weights()[1], [1, 1])
+            self.assertAllEqual(first.get_weights()[1], [0, 0])
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+        with self.assertRaises(ValueError):
+            running.ModelCache(max_size=0)
+
+    def test_prediction_service(self):
+        class DummyModel(object):
+            input_shape = (None, 3)
+
+            def __init__(self):
+                self.batch_sizes = []
+
+            def predict(self, x, batch_size=None):
+                if isinstance(x, list):
+                    self.batch_sizes.append(len(x[0]))
+                    return [x[0] * 2, x[1] + 1]
+                self.batch_sizes.append(len(x))
+                return x * 2
+
+        model = DummyModel()
+        service = running.PredictionService(
+            model, max_batch_size=16, max_latency=0.5)
+        # attributes are read from the wrapped model
+        self.assertEqual(service.input_shape, model.input_shape)
+
+        n_threads = 8
+        barrier = threading.Barrier(n_threads)
+        results = {}
+
+        def request(i):
+            x = np.full((i + 1, 3), i, dtype='float32')
+            barrier.wait()
+            results[i] = (x, service.predict(x))
+
+        threads = [threading.Thread(target=request, args=(i,))
+                   for i in range(n_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # each request gets its own outputs
+        for x, result in results.values():
+            self.assertAllEqual(result, x * 2)
+        # requests are merged into batches no larger than max_batch_size
+        self.assertLess(len(model.batch_sizes), n_threads)
+        self.assertLessEqual(max(model.batch_sizes), 16)
+        self.assertEqual(sum(model.batch_sizes), sum(range(1, n_threads + 1)))
+
+        # test multiple inputs and outputs
+        future = service.submit([np.ones((2, 3)), np.zeros((2, 1))])
+        out_1, out_2 = future.result()
+        self.assertAllEqual(out_1, np.full((2, 3), 2))
+        self.assertAllEqual(out_2, np.ones((2, 1)))
+        service.close()
+
+        # errors are raised by the requesting thread
+        class BadModel(object):
+            def predict(self, x, batch_size=None):
+                raise RuntimeError('bad model')
+
+        with running.PredictionService(BadModel()) as bad_service:
+            with self.assertRaises(RuntimeError):
+                bad_service.predict(np.ones((1, 1)))
+
+        # closed services refuse new requests
+        with self.assertRaises(RuntimeError):
+            service.submit(np.ones((1, 3)))
+        service.close()
+
+        # requests left when the thread stops are failed
+        started = threading.Event()
+        release = threading.Event()
+
+        class StoppingModel(object):
+            def predict(self, x, batch_size=None):
+                started.set()
+                release.wait()
+                raise SystemExit()
+
+        stopping_service = running.PredictionService(
+            StoppingModel(), max_batch_size=1)
+        first = stopping_service.submit(np.ones((1, 1)))
+        started.wait()
+        second = stopping_service.submit(np.ones((1, 1)))
+        release.set()
+        for future in (first, second):
+            with self.assertRaises(RuntimeError):
+                future.result(timeout=5)
+        with self.assertRaises(RuntimeError):
+            stopping_service.predict(np.ones((1, 1)))
+        stopping_service.close()
+
     def test_get_cropped_input_shape(self):
         # test 2D images
         img_w, img_h = 30, 30
@@ -122,6 +294,369 @@ class RunningTests(test.TestCase):
         padded = running.get_padding_layers(model)
         self.assertEqual(len(padded), 0)
 
+    def test_process_whole_image(self):
+        keras.backend.set_image_data_format('channels_last')
+        num_crops, field = 4, 11
+        X = np.random.random((2, 40, 40, 1))
+        shape = running.get_cropped_input_shape(X, num_crops, field)
+
+        # an identity model should reproduce the original image
+        model = keras.models.Sequential()
+        model.add(keras.layers.Activation('linear', input_shape=shape))
+
+        for tiles_per_batch in (1, 3, None):
+            output = running.process_whole_image(
+                model, X,
+                num_crops=num_crops,
+                receptive_field=field,
+                padding='reflect',
+                tiles_per_batch=tiles_per_batch)
+            self.assertEqual(output.shape, X.shape)
+            self.assertAllClose(output, X)
+
+        with self.assertRaises(ValueError):
+            running.process_whole_image(
+                model, X,
+                num_crops=num_crops,
+                receptive_field=field,
+                padding='reflect',
+                tiles_per_batch=0)
+
+        # test writing into a memory-mapped array
+        output_path = os.path.join(self.get_temp_dir(), 'output.dat')
+        output = running.process_whole_image(
+            model, X,
+            num_crops=num_crops,
+            receptive_field=field,
+            padding='reflect',
+            output_path=output_path,
+            dtype='float16')
+        self.assertIsInstance(output, np.memmap)
+        self.assertEqual(output.dtype, np.float16)
+        self.assertAllClose(output, X, atol=1e-2)
+
+        # test writing into an existing array
+        output = np.zeros(X.shape, dtype='float32')
+        running.process_whole_image(
+            model, X,
+            num_crops=num_crops,
+            receptive_field=field,
+            padding='reflect',
+            output=output)
+        self.assertAllClose(output, X)
+
+        with self.assertRaises(ValueError):
+            running.process_whole_image(
+                model, X,
+                num_crops=num_crops,
+                receptive_field=field,
+                padding='reflect',
+                output=np.zeros((1, 40, 40, 1)))
+
+    def test_process_whole_image_dynamic_shape(self):
+        keras.backend.set_image_data_format('channels_last')
+        num_crops, field = 2, 11
+        X = np.random.random((1, 32, 32, 1))
+        shape = running.get_cropped_input_shape(X, num_crops, field)
+
+        kwargs = {
+            'receptive_field': field,
+            'n_features': 3,
+            'n_conv_filters': 4,
+            'n_dense_filters': 4,
+            'dilated': True
+        }
+        trained = model_zoo.bn_feature_net_2D(input_shape=shape, **kwargs)
+        dynamic = model_zoo.bn_feature_net_2D(input_shape=(None, None, 1), **kwargs)
+        model_zoo.copy_weights(trained, dynamic)
+
+        expected = running.process_whole_image(trained, X, num_crops, field)
+        output = running.process_whole_image(dynamic, X, num_crops, field)
+        self.assertAllClose(output, expected)
+
+        # the dynamic model can process crops of any size
+        output = running.process_whole_image(dynamic, X, 4, field)
+        self.assertEqual(output.shape, (1, 32, 32, 3))
+
+        # weights must match the target architecture
+        with self.assertRaises(ValueError):
+            kwargs['n_features'] = 4
+            other = model_zoo.bn_feature_net_2D(input_shape=(None, None, 1), **kwargs)
+            model_zoo.copy_weights(trained, other)
+
+    def test_process_movie(self):
+        keras.backend.set_image_data_format('channels_last')
+        frames, tile_size = 5, 16
+
+        # an identity model should reproduce the original movie
+        model = keras.models.Sequential()
+        model.add(keras.layers.Activation(
+            'linear', input_shape=(frames, tile_size, tile_size, 1)))
+
+        # test movies longer and shorter than the window of frames
+        for n_frames in (3, 12):
+            X = np.random.random((1, n_frames, 20, 20, 1))
+            for window in ('cosine', None):
+                output = running.process_movie(
+                    model, X, overlap=2, window=window, spatial_overlap=4)
+                self.assertEqual(output.shape, X.shape)
+                self.assertAllClose(output, X)
+
+        # overlap must be smaller than the window
+        with self.assertRaises(ValueError):
+            running.process_movie(model, X, overlap=frames)
+
+        # only movies are supported
+        with self.assertRaises(ValueError):
+            running.process_movie(model, X[:, 0])
+
+    def test_autotune_tiling(self):
+        keras.backend.set_image_data_format('channels_last')
+        X = np.random.random((1, 32, 32, 1))
+        path = os.path.join(self.get_temp_dir(), 'tiling.json')
+
+        model = keras.models.Sequential()
+        model.add(keras.layers.Activation('linear', input_shape=(None, None, 1)))
+
+        config = running.autotune_tiling(
+            model, X,
+            receptive_field=11,
+            padding='reflect',
+            num_crops_options=(1, 2, 3),
+            tiles_per_batch_options=(1, None),
+            trials=1,
+            path=path)
+        # 3 crops does not evenly divide the image
+        self.assertIn(config['num_crops'], (1, 2))
+        self.assertIn(config['tiles_per_batch'], (1, None))
+
+        # the configuration should be saved for this model and shape
+        saved = running.load_tiling_config(model, X.shape, path=path)
+        self.assertDictEqual(saved, config)
+        self.assertIsNone(running.load_tiling_config(model, (2, 32, 32, 1), path=path))
+
+        kwargs = running.apply_tiling_config(model, X.shape, path=path)
+        self.assertEqual(kwargs['num_crops'], config['num_crops'])
+        output = running.process_whole_image(
+            model, X, receptive_field=11, padding='reflect', **kwargs)
+        self.assertAllClose(output, X)
+
+        # threading options are timed in sessions that are closed afterwards
+        session = keras.backend.get_session()
+        config = running.autotune_tiling(
+            model, X,
+            receptive_field=11,
+            padding='reflect',
+            num_crops_options=(2,),
+            tiles_per_batch_options=(1,),
+            thread_options=[(1, 1), (2, 1)],
+            trials=1,
+            save=False)
+        self.assertIn(config['intra_op_threads'], (1, 2))
+        self.assertIs(keras.backend.get_session(), session)
+
+        # the saved tiles_per_batch is used by default for the same num_crops
+        counting_model = _CountingModel(model)
+        running.save_tiling_config(model, X.shape, {
+            'num_crops': 2,
+            'tiles_per_batch': None,
+            'intra_op_threads': None,
+            'inter_op_threads': None,
+        }, path=path)
+        default_path = path
+        with test.mock.patch.object(running, '_get_tiling_config_path',
+                                    lambda path=None: path or default_path):
+            for num_crops, batch_sizes in [(2, [4]), (4, [1] * 16)]:
+                counting_model.batch_sizes = []
+                output = running.process_whole_image(
+                    counting_model, X, num_crops=num_crops,
+                    receptive_field=11, padding='reflect')
+                self.assertEqual(counting_model.batch_sizes, batch_sizes)
+                self.assertAllClose(output, X)
+
+            # and so is the saved num_crops
+            counting_model.batch_sizes = []
+            running.process_whole_image(
+                counting_model, X, receptive_field=11, padding='reflect')
+            self.assertEqual(counting_model.batch_sizes, [4])
+
+        # the saved threading configuration starts one session
+        session = keras.backend.get_session()
+        running.save_tiling_config(model, X.shape, {
+            'num_crops': 2,
+            'tiles_per_batch': None,
+            'intra_op_threads': 1,
+            'inter_op_threads': 1,
+        }, path=path)
+        running.apply_tiling_config(model, X.shape, path=path)
+        tuned_session = keras.backend.get_session()
+        self.assertIsNot(tuned_session, session)
+        running.apply_tiling_config(model, X.shape, path=path)
+        self.assertIs(keras.backend.get_session(), tuned_session)
+        keras.backend.set_session(session)
+        tuned_session.close()
+
+        # unreadable files have no configurations
+        with open(path, 'w') as f:
+            f.write('{"truncated')
+        self.assertIsNone(running.load_tiling_config(model, X.shape, path=path))
+        running.save_tiling_config(model, X.shape, config, path=path)
+        self.assertDictEqual(
+            running.load_tiling_config(model, X.shape, path=path), config)
+        temp_files = [f for f in os.listdir(os.path.dirname(path))
+                      if f.startswith('tiling.json.')]
+        self.assertEqual(temp_files, [])
+
+        # no configuration fits in the memory budget
+        with self.assertRaises(ValueError):
+            running.autotune_tiling(model, X, receptive_field=11,
+                                    padding='reflect', memory_budget=1,
+                                    save=False)
+
+    def test_tiling_key(self):
+        def build(n_features):
+            model = keras.models.Sequential()
+            model.add(keras.layers.Conv2D(n_features, (3, 3),
+                                          input_shape=(None, None, 1)))
+            return model
+
+        # keys depend on the architecture, not on the generated names
+        model, same_model, other_model = build(2), build(2), build(3)
+        self.assertNotEqual(model.name, same_model.name)
+        key = running._get_tiling_key(model, (1, 32, 32, 1))
+        self.assertEqual(running._get_tiling_key(same_model, (1, 32, 32, 1)), key)
+        self.assertNotEqual(running._get_tiling_key(other_model, (1, 32, 32, 1)), key)
+        self.assertNotEqual(running._get_tiling_key(model, (2, 32, 32, 1)), key)
+
+    def test_predict_with_augmentation(self):
+        keras.backend.set_image_data_format('channels_last')
+        # an identity model should reproduce the original image
+        for shape in ((16, 16, 2), (16, 20, 2)):
+            model = keras.models.Sequential()
+            model.add(keras.layers.Activation('linear', input_shape=shape))
+            X = np.random.random((3, *shape))
+            output = running.predict_with_augmentation(model, X)
+            self.assertEqual(output.shape, X.shape)
+            self.assertAllClose(output, X)
+
+    def test_get_blending_window(self):
+        for window in ('cosine', 'gaussian', None):
+            weights = running.get_blending_window((16, 20), window=window)
+            self.assertEqual(weights.shape, (16, 20))
+            self.assertTrue(np.all(weights > 0))
+
+        with self.assertRaises(ValueError):
+            running.get_blending_window((16, 16), window='invalid')
+
+    def test_process_tiled_image(self):
+        keras.backend.set_image_data_format('channels_last')
+        tile_size = (16, 16)
+
+        # an identity model should reproduce the original image
+        model = keras.models.Sequential()
+        model.add(keras.layers.Activation('linear', input_shape=(*tile_size, 1)))
+
+        # test image sizes that do not divide evenly, and are too small
+        for shape in ((2, 37, 45, 1), (1, 10, 12, 1)):
+            X = np.random.random(shape)
+            for window in ('cosine', 'gaussian', None):
+                output = running.process_tiled_image(
+                    model, X, overlap=4, window=window)
+                self.assertEqual(output.shape, X.shape)
+                self.assertAllClose(output, X)
+
+        # test with test-time augmentation
+        output = running.process_tiled_image(model, X, overlap=4, augment=True)
+        self.assertAllClose(output, X)
+
+        # test writing into a memory-mapped array
+        output_path = os.path.join(self.get_temp_dir(), 'tiled.dat')
+        output = running.process_tiled_image(
+            model, X, overlap=4, output_path=output_path)
+        self.assertIsInstance(output, np.memmap)
+        self.assertAllClose(output, X)
+
+        # overlap must be smaller than the tile
+        with self.assertRaises(ValueError):
+            running.process_tiled_image(model, X, overlap=16)
+
+    def test_stream_model_on_directory(self):
+        keras.backend.set_image_data_format('channels_last')
+        data_dir = os.path.join(self.get_temp_dir(), 'data')
+        output_dir = os.path.join(self.get_temp_dir(), 'output')
+        os.makedirs(data_dir)
+        os.makedirs(output_dir)
+
+        n_images = 5
+        images = np.random.random((n_images, 30, 30)).astype('float32')
+        for i, img in enumerate(images):
+            tiff.imsave(os.path.join(data_dir, 'nuc_{}.tif'.format(i)), img)
+
+        # an identity model should reproduce the original images
+        model = keras.models.Sequential()
+        model.add(keras.layers.Activation('linear', input_shape=(30, 30, 1)))
+
+        processed = running.stream_model_on_directory(
+            data_dir, ['nuc'], output_dir, model,
+            split=False, num_readers=2, num_writers=2, queue_size=2)
+        self.assertEqual(processed, n_images)
+
+        for i, img in enumerate(images):
+            output_file = 'feature_0_frame_{}.tif'.format(str(i).zfill(3))
+            output = tiff.imread(os.path.join(output_dir, output_file))
+            self.assertAllClose(output, img)
+
+    def test_run_models_on_directory(self):
+        keras.backend.set_image_data_format('channels_last')
+        data_dir = os.path.join(self.get_temp_dir(), 'ensemble_data')
+        output_dir = os.path.join(self.get_temp_dir(), 'ensemble_output')
+        os.makedirs(data_dir)
+        os.makedirs(output_dir)
+
+        images = np.random.random((3, 30, 30)).astype('float32')
+        for i, img in enumerate(images):
+            tiff.imsave(os.path.join(data_dir, 'nuc_{}.tif'.format(i)), img)
+
+        def model_fn(input_shape, n_features=3):
+            model = keras.models.Sequential()
+            model.add(keras.layers.Conv2D(n_features, (1, 1),
+                                          input_shape=input_shape))
+            return model
+
+        # run each model separately on the directory
+        list_of_weights, all_weights, expected = [], [], []
+        for k in range(2):
+            model = model_fn((30, 30, 1), n_features=2)
+            weights_path = os.path.join(self.get_temp_dir(),
+                                        'weights_{}.h5'.format(k))
+            model.save_weights(weights_path)
+            list_of_weights.append(weights_path)
+            all_weights.append(model.get_weights())
+            expected.append(running.run_model_on_directory(
+                data_dir, ['nuc'], output_dir, model,
+                split=False, save=False))
+        expected = np.mean(expected, axis=0)
+
+        output = running.run_models_on_directory(
+            data_dir, ['nuc'], output_dir, model_fn, list_of_weights,
+            n_features=2, image_size_x=30, image_size_y=30, split=False)
+        self.assertEqual(output.shape, (3, 30, 30, 2))
+        self.assertAllClose(output, expected)
+
+        for i in range(len(images)):
+            for f in range(2):
+                output_file = 'feature_{}_frame_{}.tif'.format(f, i)
+                saved = tiff.imread(os.path.join(output_dir, output_file))
+                self.assertAllClose(saved, expected[i, ..., f])
+
+        # each model keeps its own weights in the cache
+        for weights_path, weights in zip(list_of_weights, all_weights):
+            with running.get_model(model_fn, input_shape=(30, 30, 1),
+                                   weights_path=weights_path,
+                                   n_features=2) as model:
+                for cached, saved in zip(model.get_weights(), weights):
+                    self.assertAllClose(cached, saved)
+
 
 if __name__ == '__main__':
     test.main()
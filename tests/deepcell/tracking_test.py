@@ -0,0 +1,110 @@
+# Copyright 2016-2019 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/deepcell-tf/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Tests for the cell tracker"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+from skimage.measure import regionprops
+from skimage.transform import resize
+from tensorflow.python.platform import test
+
+from deepcell import tracking
+
+
+def _get_cell_features(X, y, frame, cell_label, crop_dim, scale_size, true_size):
+    """Compute the features of one cell with `skimage.transform.resize`,
+    padding the whole frame for the neighborhoods"""
+    props = regionprops(np.squeeze(np.int32(y[frame] == cell_label)))[0]
+    minr, minc, maxr, maxc = props.bbox
+    channels = X.shape[-1]
+
+    appearance = resize(X[frame, minr:maxr, minc:maxc], (crop_dim, crop_dim, channels),
+                        mode='constant', preserve_range=True, anti_aliasing=False)
+
+    def sub_area(X_frame):
+        pads = ((true_size, true_size), (true_size, true_size), (0, 0))
+        X_padded = np.pad(X_frame, pads, mode='constant')
+        center_x, center_y = [int(c) + true_size for c in props.centroid]
+        X_reduced = X_padded[center_x - true_size:center_x + true_size,
+                             center_y - true_size:center_y + true_size]
+        shape = (2 * scale_size + 1, 2 * scale_size + 1, channels)
+        return resize(X_reduced, shape, mode='constant',
+                      preserve_range=True, anti_aliasing=False)
+
+    neighborhood = sub_area(X[frame])
+    if frame + 1 < X.shape[0]:
+        future_area = sub_area(X[frame + 1])
+    else:
+        future_area = neighborhood
+
+    return {
+        'appearance': appearance,
+        'distance': props.centroid,
+        'neighborhood': neighborhood,
+        'regionprop': [props.area, props.perimeter, props.eccentricity],
+        '~future area': future_area
+    }
+
+
+class CellTrackerTests(test.TestCase):
+
+    def test_get_features(self):
+        X = np.random.random((2, 40, 40, 1))
+        y = np.zeros((2, 40, 40, 1), dtype='int32')
+        y[0, 2:8, 3:12] = 1
+        y[0, 15:27, 20:26] = 2
+        y[1, 4:10, 3:14] = 1
+        y[1, 30:39, 25:37] = 2
+
+        tracker = tracking.cell_tracker(
+            X, y, model=None, features=['appearance', 'neighborhood'],
+            crop_dim=8, neighborhood_scale_size=3,
+            neighborhood_true_size=6, data_format='channels_last')
+
+        # cells of both frames, the last frame has no future frame
+        frames, labels = [], []
+        for frame in range(2):
+            for cell_label in np.unique(tracker.y[frame])[1:]:
+                frames.append(frame)
+                labels.append(cell_label)
+
+        features = tracker._get_features(tracker.x, tracker.y, frames, labels)
+        self.assertEqual(features['appearance'].shape, (4, 8, 8, 1))
+        self.assertEqual(features['neighborhood'].shape, (4, 7, 7, 1))
+
+        # the features match resizing each cell on its own
+        for i, (frame, cell_label) in enumerate(zip(frames, labels)):
+            expected = _get_cell_features(
+                tracker.x, tracker.y, frame, cell_label,
+                crop_dim=8, scale_size=3, true_size=6)
+            for name, value in expected.items():
+                self.assertAllClose(features[name][i], value, atol=1e-5)
+
+
+if __name__ == '__main__':
+    test.main()
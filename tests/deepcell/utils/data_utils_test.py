@@ -87,6 +87,23 @@ class TestDataUtils(test.TestCase):
         self.assertIsInstance(test_dict, dict)
         self.assertAlmostEqual(X_test.size / (X_test.size + X_train.size), test_size)
 
+        # test memory-mapped directory of .npy files
+        npy_dir = data_utils.convert_npz_to_npy(good_file)
+        self.assertTrue(os.path.isfile(os.path.join(npy_dir, 'X.npy')))
+        train_dict, test_dict = data_utils.get_data(
+            good_file, test_size=test_size, seed=1)
+        lazy_train, lazy_test = data_utils.get_data(
+            npy_dir, test_size=test_size, seed=1)
+        self.assertIsInstance(lazy_train['X'], data_utils.MemmapSubset)
+        self.assertEqual(lazy_train['X'].shape, train_dict['X'].shape)
+        self.assertAllEqual(np.asarray(lazy_train['X']), train_dict['X'])
+        self.assertAllEqual(np.asarray(lazy_test['y']), test_dict['y'])
+        # only the indexed elements are read
+        self.assertAllEqual(lazy_train['X'][[2, 0], 5:7],
+                            train_dict['X'][[2, 0], 5:7])
+        self.assertAllEqual(np.asarray(lazy_train['y'][:3]),
+                            train_dict['y'][:3])
+
         # test bad filepath
         bad_file = os.path.join(temp_dir, 'bad.npz')
         np.savez(bad_file, X_bad=X, y_bad=y)
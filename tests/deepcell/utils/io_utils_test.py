@@ -141,6 +141,34 @@ class TestIOUtils(test.TestCase):
         sizes = io_utils.get_image_sizes(temp_dir, ['image1', 'image2'])
         self.assertEqual(sizes, (300, 300))
 
+    def test_get_image_paths_from_directory(self):
+        temp_dir = self.get_temp_dir()
+        for i in range(3):
+            _write_image(os.path.join(temp_dir, 'nuc_{}.png'.format(i)), 30, 30)
+            _write_image(os.path.join(temp_dir, 'cyto_{}.png'.format(i)), 30, 30)
+
+        paths = io_utils.get_image_paths_from_directory(temp_dir, ['nuc', 'cyto'])
+        self.assertEqual(len(paths), 3)
+        for i, image_paths in enumerate(paths):
+            self.assertListEqual(image_paths, [
+                os.path.join(temp_dir, 'nuc_{}.png'.format(i)),
+                os.path.join(temp_dir, 'cyto_{}.png'.format(i))
+            ])
+
+    def test_get_multichannel_image(self):
+        temp_dir = self.get_temp_dir()
+        paths = [os.path.join(temp_dir, 'nuc.tif'),
+                 os.path.join(temp_dir, 'cyto.tif')]
+        for path in paths:
+            _write_image(path, 30, 40)
+
+        img = io_utils.get_multichannel_image(paths, 'channels_last')
+        self.assertEqual(img.shape, (1, 30, 40, 2))
+        self.assertAllEqual(img[0, ..., 1], io_utils.get_image(paths[1]))
+
+        img = io_utils.get_multichannel_image(paths, 'channels_first')
+        self.assertEqual(img.shape, (1, 2, 30, 40))
+
     def test_get_images_from_directory(self):
         temp_dir = self.get_temp_dir()
         _write_image(os.path.join(temp_dir, 'image.png'), 300, 300)
@@ -189,6 +217,20 @@ class TestIOUtils(test.TestCase):
         io_utils.save_model_output(output, temp_dir, 'test', channel=None,
                                    data_format='channels_first')
 
+        # test single file stores
+        output = np.random.random((batches, frames, img_w, img_h, features))
+        for output_format in ('bigtiff', 'npy'):
+            path = io_utils.save_model_output(
+                output, temp_dir, output_format, channel=1,
+                data_format='channels_last', output_format=output_format)
+            self.assertAllEqual(io_utils.read_model_output(path),
+                                output[..., 1:2])
+
+        # test bad output_format
+        with self.assertRaises(ValueError):
+            io_utils.save_model_output(output, temp_dir, 'test',
+                                       output_format='zarr')
+
         # test bad channel
         with self.assertRaises(ValueError):
             output = np.random.random((batches, features, img_w, img_h))
@@ -201,5 +243,87 @@ class TestIOUtils(test.TestCase):
             bad_dir = os.path.join(temp_dir, 'test')
             io_utils.save_model_output(output, bad_dir, 'test', channel=None)
 
+    def test_model_output_writer(self):
+        temp_dir = self.get_temp_dir()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        batches, frames, features = 2, 5, 3
+        img_w, img_h = 10, 12
+
+        for output_format in ('bigtiff', 'npy'):
+            for compress in (0, 6):
+                # test channels_last 3D, writing one batch at a time
+                output = np.random.random(
+                    (batches, frames, img_w, img_h, features))
+                path = os.path.join(temp_dir, '{}_{}'.format(
+                    output_format, compress))
+                writer = io_utils.ModelOutputWriter(
+                    path, output.shape, dtype=output.dtype,
+                    output_format=output_format, compress=compress,
+                    frames_per_chunk=3, data_format='channels_last')
+                with writer:
+                    for b in range(batches):
+                        writer.write(output[b:b + 1])
+
+                self.assertAllEqual(io_utils.read_model_output(path), output)
+                # test reading a range of frames across batches
+                frame_range = io_utils.read_model_output(path, 4, 8)
+                self.assertAllEqual(frame_range, np.concatenate(
+                    [output[0, 4:], output[1, :3]]))
+
+                # test channels_first 3D and 2D
+                for shape in [(batches, features, frames, img_w, img_h),
+                              (batches, features, img_w, img_h)]:
+                    output = np.random.random(shape).astype('float32')
+                    path = os.path.join(temp_dir, 'cf_{}_{}_{}'.format(
+                        output_format, compress, len(shape)))
+                    with io_utils.ModelOutputWriter(
+                            path, output.shape, dtype='float32',
+                            output_format=output_format, compress=compress,
+                            data_format='channels_first') as writer:
+                        writer.write(output)
+                    self.assertAllEqual(
+                        io_utils.read_model_output(path), output)
+                    self.assertAllEqual(
+                        io_utils.read_model_output(path, 1, 2),
+                        output[:1, :, 1] if len(shape) == 5 else output[1:2])
+
+        # test writing too many or too few frames
+        output = np.random.random((1, img_w, img_h, features))
+        path = os.path.join(temp_dir, 'bad')
+        writer = io_utils.ModelOutputWriter(path, output.shape,
+                                            output_format='npy',
+                                            data_format='channels_last')
+        writer.write(output)
+        with self.assertRaises(ValueError):
+            writer.write(output)
+        writer.close()
+
+        writer = io_utils.ModelOutputWriter(path, (2,) + output.shape[1:],
+                                            output_format='npy',
+                                            data_format='channels_last')
+        writer.write(output)
+        with self.assertRaises(ValueError):
+            writer.close()
+
+        # errors close the tiff file, but write no metadata
+        path = os.path.join(temp_dir, 'interrupted')
+        with self.assertRaises(RuntimeError):
+            with io_utils.ModelOutputWriter(
+                    path, (2,) + output.shape[1:], output_format='bigtiff',
+                    data_format='channels_last') as writer:
+                writer.write(output)
+                raise RuntimeError('interrupted')
+        self.assertIsNone(writer._tif)
+        self.assertFalse(os.path.exists(os.path.join(path, 'metadata.json')))
+        with tiff.TiffFile(os.path.join(path, 'data.tif')) as tif:
+            self.assertEqual(len(tif.pages), features)
+
+        # test bad shape and output_format
+        with self.assertRaises(ValueError):
+            io_utils.ModelOutputWriter(path, (img_w, img_h, features))
+        with self.assertRaises(ValueError):
+            io_utils.ModelOutputWriter(path, output.shape, output_format='tif')
+
+
 if __name__ == '__main__':
     test.main()
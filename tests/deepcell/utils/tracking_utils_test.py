@@ -29,6 +29,7 @@ from __future__ import division
 from __future__ import print_function
 
 import numpy as np
+from skimage.transform import resize
 from tensorflow.python.platform import test
 
 from deepcell.utils import tracking_utils
@@ -62,3 +63,83 @@ class TrackingUtilsTests(test.TestCase):
         pairs = tracking_utils.count_pairs(
             y, same_probability=prob, data_format='channels_first')
         self.assertEqual(pairs, expected)
+
+    def test_crop_and_resize(self):
+        img = np.random.random((30, 40, 2))
+        starts = [[0, 0], [10, 5], [-4, 35], [28, 38]]
+        sizes = [[30, 40], [5, 20], [8, 10], [6, 6]]
+        crops = tracking_utils.crop_and_resize(img, starts, sizes, 8)
+        self.assertEqual(crops.shape, (4, 8, 8, 2))
+
+        # windows are resized to the range of their own values
+        self.assertGreaterEqual(crops[1].min(), img[10:15, 5:25].min())
+        self.assertLessEqual(crops[1].max(), img[10:15, 5:25].max())
+
+        # same size windows are copied
+        crop = tracking_utils.crop_and_resize(img, [[3, 4]], [[8, 8]], 8)
+        self.assertAllClose(crop[0], img[3:11, 4:12])
+
+        # windows are zero padded past the image
+        padded = np.pad(img, ((4, 4), (4, 4), (0, 0)), mode='constant')
+        crop = tracking_utils.crop_and_resize(img, [[-4, 36]], [[8, 8]], 8)
+        self.assertAllClose(crop[0], padded[0:8, 40:48])
+
+        # no windows
+        crops = tracking_utils.crop_and_resize(img, [], [], 8)
+        self.assertEqual(crops.shape, (0, 8, 8, 2))
+
+    def test_crop_and_resize_matches_resize(self):
+        img = np.random.random((30, 40, 2))
+        pad = 10
+        padded = np.pad(img, ((pad, pad), (pad, pad), (0, 0)), mode='constant')
+
+        # downscaled, upscaled, and hanging off the top right and
+        # the bottom right corners of the image
+        starts = [[2, 3], [10, 5], [-4, 35], [28, 38]]
+        sizes = [[24, 30], [5, 6], [9, 12], [5, 4]]
+        crops = tracking_utils.crop_and_resize(img, starts, sizes, 8)
+
+        for crop, (row, col), (rows, cols) in zip(crops, starts, sizes):
+            window = padded[row + pad:row + pad + rows,
+                            col + pad:col + pad + cols]
+            expected = resize(window, (8, 8, 2), mode='constant',
+                              preserve_range=True, anti_aliasing=False)
+            self.assertAllClose(crop, expected, atol=1e-5)
+
+    def test_get_frame_features(self):
+        img = np.random.random((30, 30, 1))
+        y = np.zeros((30, 30, 1), dtype='int32')
+        y[2:6, 3:9] = 1
+        y[20:30, 10:16] = 2
+        future_img = np.random.random((30, 30, 1))
+
+        features = tracking_utils.get_frame_features(
+            img, y, [2, 1], crop_dim=4, neighborhood_scale_size=3,
+            neighborhood_true_size=5, X_future_frame=future_img,
+            data_format='channels_last')
+
+        self.assertEqual(features['appearances'].shape, (2, 4, 4, 1))
+        self.assertEqual(features['neighborhoods'].shape, (2, 7, 7, 1))
+        self.assertEqual(features['future_areas'].shape, (2, 7, 7, 1))
+        self.assertAllClose(features['centroids'], [[24.5, 12.5], [3.5, 5.5]])
+        self.assertAllClose(features['regionprops'][:, 0], [60, 24])
+
+        # the resized bounding box of cell 1
+        box = tracking_utils.crop_and_resize(img, [[2, 3]], [[4, 6]], 4)
+        self.assertAllClose(features['appearances'][1], box[0])
+
+        # channels_first
+        features_cf = tracking_utils.get_frame_features(
+            np.moveaxis(img, -1, 0), np.moveaxis(y, -1, 0), [2, 1],
+            crop_dim=4, neighborhood_scale_size=3, neighborhood_true_size=5,
+            data_format='channels_first')
+        self.assertEqual(features_cf['appearances'].shape, (2, 1, 4, 4))
+        self.assertAllClose(np.moveaxis(features_cf['appearances'], 1, -1),
+                            features['appearances'])
+        self.assertAllClose(features_cf['neighborhoods'],
+                            features['neighborhoods'])
+        self.assertNotIn('future_areas', features_cf)
+
+        # missing label
+        with self.assertRaises(ValueError):
+            tracking_utils.get_frame_features(img, y, [3])
@@ -258,5 +258,35 @@ class TransformUtilsTest(test.TestCase):
         rotated_image2 = transform_utils.rotate_array_180(img)
         self.assertAllEqual(rotated_image1, rotated_image2)
 
+    def test_flip_array(self):
+        img = _get_image()
+        flipped_image = transform_utils.flip_array(img)
+        self.assertAllEqual(flipped_image, np.fliplr(img))
+
+    def test_get_dihedral_transforms(self):
+        img = _get_image()
+        transforms = transform_utils.get_dihedral_transforms()
+        self.assertEqual(len(transforms), 8)
+
+        transformed = [transform(img) for transform, _ in transforms]
+        # each transform should be unique
+        for i, t1 in enumerate(transformed):
+            for t2 in transformed[i + 1:]:
+                self.assertFalse(np.array_equal(t1, t2))
+        # each transform should be a view, not a copy
+        for t in transformed:
+            self.assertTrue(np.shares_memory(t, img))
+        # each inverse transform should recover the original image
+        for t, (_, inverse) in zip(transformed, transforms):
+            self.assertAllEqual(inverse(t), img)
+
+        # test without transposed transforms
+        img = np.random.random((300, 200))
+        transforms = transform_utils.get_dihedral_transforms(False)
+        self.assertEqual(len(transforms), 4)
+        for transform, inverse in transforms:
+            self.assertEqual(transform(img).shape, img.shape)
+            self.assertAllEqual(inverse(transform(img)), img)
+
 if __name__ == '__main__':
     test.main()